@@ -4,12 +4,28 @@ Bluetti Monitor API Server
 Provides REST API endpoints and notification system
 """
 
+import io
+import csv
 import json
 import time
+import hashlib
+import itertools
+import contextlib
 import smtplib
 import requests
 import os
-import sqlite3
+import battery_db
+import battery_settings
+import telemetry_ring
+import snapshot_archive
+import battery_analytics
+import energy_ledger
+import quantile_sketch
+import pack_monitor
+import live_status
+import response_cache
+import live_stream
+from discharge_analysis import DischargeAnalysisEngine, format_duration, format_duration_short
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from flask import Flask, jsonify, request
@@ -52,6 +68,69 @@ NOTIFICATION_CONFIG = {
     }
 }
 
+# Settings persisted in the database, shared with the logger
+settings_cache = battery_settings.SettingsCache()
+
+def get_notification_config():
+    """Environment notification config with saved overrides applied"""
+    config = {channel: dict(values) for channel, values in NOTIFICATION_CONFIG.items()}
+    for channel, values in settings_cache.notification_config().items():
+        if isinstance(values, dict) and isinstance(config.get(channel), dict):
+            config[channel].update(values)
+        else:
+            config[channel] = values
+    return config
+
+# Recent snapshots published by the battery logger, read without SQLite
+telemetry = telemetry_ring.TelemetryRingReader()
+
+# Time-remaining analysis, recomputed only when the logger commits new data
+discharge_engine = DischargeAnalysisEngine()
+
+def _open_charge_session():
+    """The charge session still open in the database, if any"""
+    if not os.path.exists(BATTERY_DB_PATH):
+        return None
+    try:
+        with battery_db.connection() as conn:
+            session = conn.execute('''
+                SELECT start_time, start_percent, charge_type
+                FROM charge_sessions 
+                WHERE end_time IS NULL 
+                ORDER BY start_time DESC 
+                LIMIT 1
+            ''').fetchone()
+    except Exception as e:
+        logger.warning(f"Error checking current session: {e}")
+        return None
+    if not session:
+        return None
+    return {
+        'started_at': battery_db.ms_to_iso(session[0]),
+        'start_percent': session[1],
+        'charge_type': session[2]
+    }
+
+# History and stats responses, reused until the database changes
+responses = response_cache.ResponseCache()
+
+# Status payloads rebuilt at MQTT ingest, served as pre-encoded bytes
+current_status = live_status.LiveStatus(discharge_engine, _open_charge_session)
+
+# Server-Sent Events to connected dashboards; new clients start from a snapshot
+def _stream_snapshot():
+    messages = [('fields', dict(latest_bluetti_data))]
+    status = current_status.current
+    if status.activity_json is not None:
+        messages.append(('status', status.activity_body()))
+    messages.append(('discharge', _discharge_payload(discharge_engine.result)))
+    return messages
+
+stream_hub = live_stream.StreamHub(_stream_snapshot)
+
+# Pack imbalance, drift and sag detection on live telemetry
+pack_health = pack_monitor.PackMonitor()
+
 # Battery level thresholds
 BATTERY_THRESHOLDS = [100, 50, 40, 39, 38, 37, 30, 15, 10, 5]
 NOTIFICATION_COOLDOWN = 300  # 5 minutes between notifications for same level
@@ -62,7 +141,24 @@ device_id = None
 last_notifications = {}
 
 # Battery activity database path
-BATTERY_DB_PATH = "/home/pi/bluetti-monitor/battery_activity.db"
+BATTERY_DB_PATH = battery_db.DB_PATH
+STATS_MAX_BUCKETS = 2000
+EXTENDED_STATS_MAX_DAYS = 366  # Longest range (days query parameter) /api/activity/stats/extended accepts
+
+# /api/dashboard sections, returned by default unless include= says otherwise
+DASHBOARD_SECTIONS = ('current', 'charge_sessions', 'history', 'stats', 'discharge',
+                      'discharge_history', 'discharge_stats', 'sections')
+DASHBOARD_OPTIONAL_SECTIONS = ('packs', 'capacity')
+
+# History pagination and export
+SNAPSHOT_COLUMNS = ('timestamp',) + snapshot_archive.ARCHIVE_FIELDS
+DISCHARGE_COLUMNS = ('timestamp', 'battery_percent', 'discharge_rate_percent_per_hour',
+                     'estimated_hours_remaining', 'estimated_days_remaining',
+                     'avg_power_consumption', 'total_output_power')
+DISCHARGE_HISTORY_MAX_ROWS = 200  # per page; later pages via the cursor
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_PAGE_ROWS = 1000  # rows read per query while streaming an export
+EXPORT_CHUNK_BYTES = 65536  # streamed output is written in chunks of about this size
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -73,6 +169,9 @@ class MQTTHandler:
         self.client = mqtt.Client()
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
+        self.streamed_status = None
+        self.streamed_analysis = None
+        pack_health.on_event = self._send_pack_notification
         self.client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
         self.client.loop_start()
         logger.info(f"Connected to MQTT broker at {MQTT_BROKER_HOST}:{MQTT_BROKER_PORT}")
@@ -97,10 +196,35 @@ class MQTTHandler:
                 value = msg.payload.decode()
             
             latest_bluetti_data[key] = value
+            status = current_status.update(key, value)
+            self._publish_live_updates(key, value, status)
             
             # Check for battery level notifications
             if key == 'total_battery_percent':
                 self._check_battery_notifications(value)
+            elif key in ('ac_output_power', 'dc_output_power'):
+                pack_health.update(key, value, output_power=self._output_power())
+            elif key in pack_monitor.PACK_FIELDS:
+                pack_health.update(key, value)
+
+    def _publish_live_updates(self, key, value, status):
+        """Push the field, and any status or discharge change it caused, to stream clients"""
+        if not stream_hub.client_count:
+            return
+        stream_hub.publish_field(key, value)
+        if status.version != self.streamed_status and status.activity_json is not None:
+            stream_hub.publish('status', status.activity_body())
+            self.streamed_status = status.version
+        analysis = discharge_engine.result
+        if analysis is not self.streamed_analysis:
+            stream_hub.publish('discharge', _discharge_payload(analysis))
+            self.streamed_analysis = analysis
+
+    def _output_power(self):
+        try:
+            return float(latest_bluetti_data.get('ac_output_power', 0)) + float(latest_bluetti_data.get('dc_output_power', 0))
+        except (ValueError, TypeError):
+            return None
 
     def _check_battery_notifications(self, battery_percent):
         """Check if we should send battery level notifications"""
@@ -135,11 +259,12 @@ class MQTTHandler:
             message = self._create_battery_message(battery_percent, threshold, power_input, ac_input)
             
             # Send email notification
-            if NOTIFICATION_CONFIG["email"]["enabled"]:
+            config = get_notification_config()
+            if config["email"]["enabled"]:
                 self._send_email_notification(message, battery_percent)
             
             # Send SMS notification
-            if NOTIFICATION_CONFIG["sms"]["enabled"]:
+            if config["sms"]["enabled"]:
                 self._send_sms_notification(message)
                 
             logger.info(f"Sent battery notification for {battery_percent}%")
@@ -169,10 +294,40 @@ class MQTTHandler:
         else:
             return f"🔋 Bluetti AC200M - Battery at {battery_percent}% - {timestamp}"
 
-    def _send_email_notification(self, message, battery_percent):
+    def _send_pack_notification(self, event):
+        """Send a pack health alert without holding up the MQTT thread"""
+        message = self._create_pack_message(event)
+        config = get_notification_config()
+        if not (config["email"]["enabled"] or config["sms"]["enabled"]):
+            return
+        
+        def send():
+            if config["email"]["enabled"]:
+                self._send_email_notification(message, subject=f"⚠️ Pack {event['pack']} {event['kind']} - Bluetti AC200M Battery Alert")
+            if config["sms"]["enabled"]:
+                self._send_sms_notification(message)
+            logger.info(f"Sent pack {event['kind']} notification for pack {event['pack']}")
+        
+        threading.Thread(target=send, daemon=True).start()
+
+    def _create_pack_message(self, event):
+        """Create pack health notification message"""
+        timestamp = datetime.fromtimestamp(event['timestamp']).strftime("%Y-%m-%d %H:%M:%S")
+        
+        if event['kind'] == 'sag':
+            return (f"⚠️ Bluetti AC200M - Pack {event['pack']} voltage sagged {event['sag_volts']}V to {event['volts']}V "
+                    f"under {event['output_power']:.0f}W load - {timestamp}")
+        elif event['kind'] == 'imbalance':
+            return (f"⚠️ Bluetti AC200M - Pack imbalance: {event['mean_spread_volts']}V average spread, "
+                    f"pack {event['pack']} lowest - {timestamp}")
+        else:
+            return (f"⚠️ Bluetti AC200M - Pack {event['pack']} drifting from the others "
+                    f"({event['offset_volts']:+}V, z-score {event['zscore']}) - {timestamp}")
+
+    def _send_email_notification(self, message, battery_percent=None, subject=None):
         """Send email notification"""
         try:
-            config = NOTIFICATION_CONFIG["email"]
+            config = get_notification_config()["email"]
             
             # Split email addresses if multiple are provided
             email_addresses = [email.strip() for email in config["to_email"].split(',')]
@@ -183,12 +338,12 @@ class MQTTHandler:
             
             # Send to each email address separately
             for email_address in email_addresses:
-                msg = MimeMultipart()
+                msg = MIMEMultipart()
                 msg['From'] = config["from_email"]
                 msg['To'] = email_address
-                msg['Subject'] = f"🔋 {battery_percent}% - Bluetti AC200M Battery Alert"
+                msg['Subject'] = subject or f"🔋 {battery_percent}% - Bluetti AC200M Battery Alert"
                 
-                msg.attach(MimeText(message, 'plain'))
+                msg.attach(MIMEText(message, 'plain'))
                 
                 text = msg.as_string()
                 server.sendmail(config["from_email"], email_address, text)
@@ -203,7 +358,7 @@ class MQTTHandler:
     def _send_sms_notification(self, message):
         """Send SMS notification"""
         try:
-            config = NOTIFICATION_CONFIG["sms"]
+            config = get_notification_config()["sms"]
             
             if config["provider"] == "twilio":
                 # Twilio SMS (requires Twilio account)
@@ -232,27 +387,27 @@ def get_bluetti_data():
 @app.route('/api/bluetti/battery', methods=['GET'])
 def get_battery_status():
     """Get battery status only"""
-    battery_data = {
-        'total_battery_percent': latest_bluetti_data.get('total_battery_percent', 'N/A'),
-        'total_battery_voltage': latest_bluetti_data.get('total_battery_voltage', 'N/A'),
-        'dc_input_power': latest_bluetti_data.get('dc_input_power', 'N/A'),
-        'ac_input_power': latest_bluetti_data.get('ac_input_power', 'N/A'),
-        'last_updated': datetime.now().isoformat()
-    }
-    return jsonify(battery_data)
+    return app.response_class(current_status.current.battery_json, mimetype='application/json')
 
 @app.route('/api/bluetti/power', methods=['GET'])
 def get_power_status():
     """Get power status only"""
-    power_data = {
-        'ac_output_power': latest_bluetti_data.get('ac_output_power', 'N/A'),
-        'dc_output_power': latest_bluetti_data.get('dc_output_power', 'N/A'),
-        'ac_input_power': latest_bluetti_data.get('ac_input_power', 'N/A'),
-        'dc_input_power': latest_bluetti_data.get('dc_input_power', 'N/A'),
-        'power_generation': latest_bluetti_data.get('power_generation', 'N/A'),
-        'last_updated': datetime.now().isoformat()
-    }
-    return jsonify(power_data)
+    return app.response_class(current_status.current.power_json, mimetype='application/json')
+
+@app.route('/api/stream', methods=['GET'])
+def stream_live_updates():
+    """Server-Sent Events: 'fields' deltas from MQTT plus 'status' and 'discharge' updates"""
+    subscriber = stream_hub.subscribe()
+    if subscriber is None:
+        return jsonify({'error': 'Too many stream clients'}), 503
+    
+    response = app.response_class(stream_hub.stream(subscriber), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # The generator's own cleanup never runs if the client leaves before its first chunk
+    response.call_on_close(lambda: stream_hub.unsubscribe(subscriber))
+    return response
 
 @app.route('/api/bluetti/status', methods=['GET'])
 def get_device_status():
@@ -276,10 +431,11 @@ def test_notifications():
         message = f"🧪 TEST: Bluetti Battery Alert - {test_level}% - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
         
         # Send test notifications
-        if NOTIFICATION_CONFIG["email"]["enabled"]:
+        config = get_notification_config()
+        if config["email"]["enabled"]:
             mqtt_handler._send_email_notification(message, test_level)
         
-        if NOTIFICATION_CONFIG["sms"]["enabled"]:
+        if config["sms"]["enabled"]:
             mqtt_handler._send_sms_notification(message)
         
         return jsonify({'success': True, 'message': 'Test notifications sent'})
@@ -291,16 +447,39 @@ def test_notifications():
 def notification_config():
     """Get or update notification configuration"""
     if request.method == 'GET':
-        return jsonify(NOTIFICATION_CONFIG)
+        return jsonify(get_notification_config())
     
     elif request.method == 'POST':
         try:
             data = request.get_json()
-            NOTIFICATION_CONFIG.update(data)
+            with battery_db.transaction() as conn:
+                battery_settings.save_notification_config(conn, data)
+            settings_cache.invalidate()
             return jsonify({'success': True, 'message': 'Configuration updated'})
         except Exception as e:
             return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/system/status', methods=['GET'])
+def get_system_status():
+    """Get the logger's status as of its last flush, the response cache figures and stream clients"""
+    try:
+        logger_status = None
+        if os.path.exists(BATTERY_DB_PATH):
+            with battery_db.connection() as conn:
+                row = conn.execute("SELECT state, updated_at FROM estimator_state WHERE name = 'logger_status'").fetchone()
+            if row:
+                logger_status = dict(json.loads(row[0]), updated_at=battery_db.ms_to_iso(row[1]))
+        
+        return jsonify({
+            'logger': logger_status,
+            'response_cache': responses.stats(),
+            'stream_clients': stream_hub.client_count
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting system status: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -311,245 +490,341 @@ def health_check():
         'data_available': len(latest_bluetti_data) > 0
     })
 
+def _keyed_desc(rows, before=None):
+    """Key newest-first rows that have no id by their place among rows sharing a timestamp
+
+    The first row at a timestamp gets 0, the next -1 and so on, so
+    (timestamp, key) pages them like read_page's (timestamp, id); keys of
+    0 and below never clash with SQLite ids. Rows at or after the key
+    before are skipped.
+    """
+    last_ts = key = None
+    for row in rows:
+        key = key - 1 if row[0] == last_ts else 0
+        last_ts = row[0]
+        if before is not None and (row[0], key) >= tuple(before):
+            continue
+        yield tuple(row) + (key,)
+
+def _ring_history(cutoff_ms, limit, before=None):
+    """Newest-first snapshot rows from the telemetry ring, keyed like _snapshot_rows
+
+    Returns None when the ring is unavailable or doesn't reach back to
+    cutoff_ms, in which case the caller reads SQLite instead.
+    """
+    result = telemetry.records(cutoff_ms)
+    if result is None:
+        return None
+    
+    records, oldest = result
+    if oldest is None or oldest > cutoff_ms:
+        return None
+    if before is not None and before[1] > 0:
+        return None  # the cursor holds a SQLite id, so carry on paging SQLite
+    
+    if before is not None:
+        records = [record for record in records if record[0] <= before[0]]
+    return list(itertools.islice(_keyed_desc(reversed(records), before), max(limit, 0)))
+
+def _snapshot_rows(start_ms, limit, before=None):
+    """Up to limit snapshot rows from start_ms on that sort before the (timestamp, id) key before, newest first
+
+    Rows end with their key: the SQLite id, or for archived rows (which
+    have none) their place among rows sharing a timestamp. A position key
+    from the ring or the archive is turned into the id at that position,
+    since the ring holds tied rows in the order they were inserted.
+    """
+    with battery_db.connection() as conn:
+        live_before = before
+        if before is not None and before[1] <= 0:
+            live_before = (before[0], battery_db.id_at_position(conn, 'battery_snapshots', before[0], -before[1]))
+        rows = battery_db.read_page(
+            conn, 'battery_snapshots', ', '.join(SNAPSHOT_COLUMNS), start_ms, limit, live_before
+        )
+        live_start = snapshot_archive.oldest_live_ms(conn)
+    
+    # Older than the oldest live partition, continue from the archive
+    if len(rows) < limit and (live_start is None or start_ms < live_start):
+        end_ms = min((ms for ms in (before[0] + 1 if before else None, live_start) if ms is not None), default=None)
+        archived = _keyed_desc(snapshot_archive.iter_rows_desc(start_ms, end_ms), before)
+        rows += itertools.islice(archived, limit - len(rows))
+    return rows
+
+def _snapshot_entry(row):
+    """History dict for a (timestamp, *ARCHIVE_FIELDS, key) row from SQLite, the ring or the archive"""
+    entry = dict(zip(SNAPSHOT_COLUMNS, row[:-1]))
+    entry['timestamp'] = battery_db.ms_to_iso(row[0])
+    return entry
+
+def _parse_cursor(cursor):
+    """The (timestamp, key) keyset bound in a cursor, or None for the first page
+
+    Cursors are 'timestamp:id' after a SQLite row and 'timestamp:p<n>'
+    after a row from the ring or the archive, n places down among the rows
+    sharing its timestamp (see _keyed_desc).
+    """
+    if cursor is None:
+        return None
+    timestamp, _, key = cursor.partition(':')
+    position = key.startswith('p')
+    if position:
+        key = key[1:]
+    if not timestamp.isdigit() or not key.isdigit() or (not position and int(key) == 0):
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return int(timestamp), -int(key) if position else int(key)
+
+def _next_cursor(rows, limit):
+    """Keyset cursor for the page after rows, from the oldest row's key; None on the last page"""
+    if not rows or len(rows) < limit:
+        return None
+    timestamp, key = rows[-1][0], rows[-1][-1]
+    return f'{timestamp}:{key}' if key > 0 else f'{timestamp}:p{-key}'
+
+def _iter_pages(read_page, limit=None, before=None):
+    """Rows from successive keyset pages of read_page(page_limit, before), newest first
+
+    Only one page is held at a time and no connection or transaction is kept
+    open between pages, so an export of any length runs in constant memory.
+    """
+    while limit is None or limit > 0:
+        page_limit = EXPORT_PAGE_ROWS if limit is None else min(EXPORT_PAGE_ROWS, limit)
+        rows = read_page(page_limit, before)
+        yield from rows
+        if len(rows) < page_limit:
+            return
+        before = (rows[-1][0], rows[-1][-1])
+        if limit is not None:
+            limit -= len(rows)
+
+def _export_response(rows, export_format, to_entry, name):
+    """Stream rows as chunked NDJSON or CSV without building the body in memory"""
+    def generate():
+        buffer = io.StringIO()
+        writer = None
+        try:
+            for row in rows:
+                entry = to_entry(row)
+                if export_format == 'csv':
+                    if writer is None:
+                        writer = csv.DictWriter(buffer, fieldnames=list(entry))
+                        writer.writeheader()
+                    writer.writerow(entry)
+                else:
+                    buffer.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                
+                if buffer.tell() >= EXPORT_CHUNK_BYTES:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            if buffer.tell():
+                yield buffer.getvalue()
+        except Exception as e:
+            logger.error(f"Error streaming {name}: {e}")
+            raise
+    
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    if export_format == 'csv':
+        headers['Content-Disposition'] = f'attachment; filename="{name}.csv"'
+    return app.response_class(generate(), mimetype=EXPORT_FORMATS[export_format], headers=headers)
+
+def _live_data():
+    """Latest MQTT values, or the logger's last snapshot until MQTT catches up"""
+    if latest_bluetti_data:
+        return latest_bluetti_data
+    
+    record = telemetry.latest()
+    if record is None:
+        return {}
+    
+    values = dict(zip(telemetry_ring.RECORD_FIELDS, record[1:]))
+    return {
+        'total_battery_percent': values['battery_percent'],
+        'total_battery_voltage': values['battery_voltage'],
+        'ac_output_power': values['ac_output_power'],
+        'dc_output_power': values['dc_output_power'],
+        'ac_input_power': values['ac_input_power'],
+        'dc_input_power': values['dc_input_power']
+    }
+
+def _range_source(conn, table, period):
+    """Get a FROM-clause source limited to the day partitions within the last period"""
+    return battery_db.partition_source(conn, table, (datetime.now() - period).date())
+
 # Battery Activity API Endpoints
 
+def _current_activity():
+    """The current-status payload, rebuilt only while serving the logger's ring"""
+    status = current_status.current
+    if status.activity is not None:
+        return status.activity_payload()
+    
+    live_data = _live_data()
+    if not live_data:
+        return None
+    
+    is_charging = float(live_data.get('ac_input_power', 0)) > 0 or float(live_data.get('dc_input_power', 0)) > 0
+    return live_status.activity_status(
+        live_data, discharge_engine.current(), discharge_engine.capacity,
+        _open_charge_session() if is_charging else None
+    )
+
 @app.route('/api/activity/current', methods=['GET'])
 def get_activity_current():
     """Get current battery status with time remaining"""
     try:
-        if not latest_bluetti_data:
-            return jsonify({'error': 'No data available'}), 503
-        
-        # Extract current data
-        battery_percent = float(latest_bluetti_data.get('total_battery_percent', 0))
-        battery_voltage = float(latest_bluetti_data.get('total_battery_voltage', 0))
-        ac_output = float(latest_bluetti_data.get('ac_output_power', 0))
-        dc_output = float(latest_bluetti_data.get('dc_output_power', 0))
-        ac_input = float(latest_bluetti_data.get('ac_input_power', 0))
-        dc_input = float(latest_bluetti_data.get('dc_input_power', 0))
-        
-        total_output = ac_output + dc_output
-        total_capacity_wh = 6144  # AC200MAX + 2x B230
-        remaining_wh = (battery_percent / 100) * total_capacity_wh
-        
-        is_charging = ac_input > 0 or dc_input > 0
-        
-        # Get time remaining from discharge analysis (more accurate)
-        time_remaining_hours = float('inf')
-        formatted_time = "∞"
-        
-        # Always try to get discharge analysis data for better estimates
-        if os.path.exists(BATTERY_DB_PATH):
-            try:
-                # Get discharge analysis data for accurate time remaining
-                with sqlite3.connect(BATTERY_DB_PATH) as conn:
-                    cursor = conn.cursor()
-                    
-                    # Get the most recent discharge session for current battery level
-                    cursor.execute('''
-                        SELECT battery_percent, timestamp
-                        FROM discharge_sessions 
-                        ORDER BY timestamp DESC 
-                        LIMIT 1
-                    ''')
-                    latest = cursor.fetchone()
-                    
-                    if latest:
-                        current_battery, current_timestamp = latest
-                        
-                        # Calculate statistics from all sessions in the last 24 hours
-                        cursor.execute('''
-                            SELECT 
-                                AVG(discharge_rate_percent_per_hour) as avg_discharge_rate,
-                                AVG(avg_power_consumption) as avg_power,
-                                COUNT(*) as session_count
-                            FROM discharge_sessions 
-                            WHERE timestamp >= datetime('now', '-24 hours')
-                        ''')
-                        stats = cursor.fetchone()
-                        
-                        if stats and stats[2] > 0:  # session_count
-                            avg_discharge_rate, avg_power, session_count = stats
-                            
-                            # Calculate time-based discharge rate from battery level changes
-                            cursor.execute('''
-                                SELECT battery_percent, timestamp
-                                FROM discharge_sessions 
-                                WHERE timestamp >= datetime('now', '-12 hours')
-                                ORDER BY timestamp ASC
-                            ''')
-                            sessions = cursor.fetchall()
-                            
-                            # Calculate actual discharge rate
-                            if len(sessions) >= 3:
-                                first_battery = sessions[0][0]
-                                last_battery = sessions[-1][0]
-                                first_time = datetime.fromisoformat(sessions[0][1])
-                                last_time = datetime.fromisoformat(sessions[-1][1])
-                                
-                                time_diff_hours = (last_time - first_time).total_seconds() / 3600
-                                battery_diff = first_battery - last_battery
-                                
-                                if time_diff_hours >= 2 and battery_diff > 0:
-                                    actual_discharge_rate = battery_diff / time_diff_hours
-                                else:
-                                    if avg_power > 0:
-                                        actual_discharge_rate = (avg_power / total_capacity_wh) * 100
-                                    else:
-                                        actual_discharge_rate = avg_discharge_rate or 0
-                            else:
-                                if avg_power > 0:
-                                    actual_discharge_rate = (avg_power / total_capacity_wh) * 100
-                                else:
-                                    actual_discharge_rate = avg_discharge_rate or 0
-                            
-                            # Calculate estimated time remaining
-                            if actual_discharge_rate > 0:
-                                time_remaining_hours = current_battery / actual_discharge_rate
-                                
-                                # Format time remaining
-                                days = int(time_remaining_hours // 24)
-                                remaining_hours = int(time_remaining_hours % 24)
-                                minutes = int((time_remaining_hours % 1) * 60)
-                                
-                                if days > 0:
-                                    formatted_time = f"{days}d {remaining_hours}h {minutes}m"
-                                elif remaining_hours > 0:
-                                    formatted_time = f"{remaining_hours}h {minutes}m"
-                                else:
-                                    formatted_time = f"{minutes}m"
-                                
-                                # If charging, prefix with discharge estimate
-                                if is_charging:
-                                    formatted_time = f"~{formatted_time} (discharge)"
-            except Exception as e:
-                # Fallback to simple calculation if discharge analysis fails
-                time_remaining_hours = remaining_wh / total_output if total_output > 0 else float('inf')
-                if time_remaining_hours != float('inf'):
-                    days = int(time_remaining_hours // 24)
-                    remaining_hours = int(time_remaining_hours % 24)
-                    minutes = int((time_remaining_hours % 1) * 60)
-                    
-                    if days > 0:
-                        formatted_time = f"{days}d {remaining_hours}h {minutes}m"
-                    elif remaining_hours > 0:
-                        formatted_time = f"{remaining_hours}h {minutes}m"
-                    else:
-                        formatted_time = f"{minutes}m"
-        
-        # Handle infinity values for JSON compatibility
-        if time_remaining_hours == float('inf'):
-            time_remaining_data = {
-                'hours': None,
-                'days': None,
-                'formatted': formatted_time
-            }
-        else:
-            time_remaining_data = {
-                'hours': time_remaining_hours,
-                'days': time_remaining_hours / 24,
-                'formatted': formatted_time
-            }
-        
-        result = {
-            'battery_percent': battery_percent,
-            'battery_voltage': battery_voltage,
-            'total_capacity_wh': total_capacity_wh,
-            'remaining_capacity_wh': remaining_wh,
-            'current_output_watts': total_output,
-            'time_remaining': time_remaining_data,
-            'is_charging': is_charging,
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        # Check for active charging session
-        if is_charging and os.path.exists(BATTERY_DB_PATH):
-            try:
-                with sqlite3.connect(BATTERY_DB_PATH) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        SELECT start_time, start_percent, charge_type
-                        FROM charge_sessions 
-                        WHERE end_time IS NULL 
-                        ORDER BY start_time DESC 
-                        LIMIT 1
-                    ''')
-                    session = cursor.fetchone()
-                    
-                    if session:
-                        start_time = datetime.fromisoformat(session[0])
-                        duration = (datetime.now() - start_time).total_seconds() / 60
-                        result['current_session'] = {
-                            'started_at': session[0],
-                            'start_percent': session[1],
-                            'duration_minutes': int(duration),
-                            'charge_type': session[2]
-                        }
-            except Exception as e:
-                logger.warning(f"Error checking current session: {e}")
+        # Built at MQTT ingest, so usually just the pre-encoded bytes plus the clock fields
+        status = current_status.current
+        if status.activity_json is not None:
+            return app.response_class(status.activity_body(), mimetype='application/json')
         
+        result = _current_activity()
+        if result is None:
+            return jsonify({'error': 'No data available'}), 503
         return jsonify(result)
         
     except Exception as e:
         logger.error(f"Error getting current activity: {e}")
         return jsonify({'error': str(e)}), 500
 
+def _history_resolution(hours, points, resolution):
+    """Resolve the requested history resolution; None means the default of raw rows"""
+    # With a point budget, serve the finest rollup that fits it instead of raw rows
+    if resolution is None and points is not None:
+        if hours * 3600 / battery_db.SNAPSHOT_INTERVAL <= points:
+            return 'raw'
+        return battery_db.choose_resolution(hours * 3600, points)
+    return resolution or 'raw'
+
+def _read_rollup_page(resolution, start_ms):
+    def read_page(limit, before):
+        with battery_db.connection() as conn:
+            return battery_db.read_rollup_rows(conn, resolution, start_ms, limit, before)
+    return read_page
+
+def _activity_history(hours, limit, points=None, resolution='raw', before=None):
+    """The /api/activity/history payload, or None when it needs a missing database"""
+    cutoff_ms = battery_db.to_ms(datetime.now() - timedelta(hours=hours))
+    # A point budget sets the page size, whether it picked a rollup or raw rows
+    page_limit = points or limit
+    
+    if resolution != 'raw':
+        rows = _read_rollup_page(resolution, cutoff_ms)(page_limit, before)
+        history = [battery_db.rollup_point(row) for row in rows]
+        return {
+            'history': history,
+            'count': len(history),
+            'period_hours': hours,
+            'resolution': resolution,
+            'next_cursor': _next_cursor(rows, page_limit)
+        }
+    
+    # Recent windows are served from the logger's telemetry ring
+    rows = _ring_history(cutoff_ms, page_limit, before)
+    if rows is None:
+        if not os.path.exists(BATTERY_DB_PATH):
+            return None
+        rows = _snapshot_rows(cutoff_ms + 1, page_limit, before)
+    
+    history = [_snapshot_entry(row) for row in rows]
+    return {
+        'history': history,
+        'count': len(history),
+        'period_hours': hours,
+        'resolution': 'raw',
+        'next_cursor': _next_cursor(rows, page_limit)
+    }
+
+def _export_activity_history(hours, resolution, limit=None, before=None):
+    """/api/activity/history as a streamed NDJSON or CSV export"""
+    cutoff_ms = battery_db.to_ms(datetime.now() - timedelta(hours=hours))
+    if resolution != 'raw':
+        return _iter_pages(_read_rollup_page(resolution, cutoff_ms), limit, before), battery_db.rollup_point
+    return _iter_pages(lambda page_limit, key: _snapshot_rows(cutoff_ms + 1, page_limit, key), limit, before), _snapshot_entry
+
 @app.route('/api/activity/history', methods=['GET'])
+@responses.cached(extra_version=lambda: telemetry.appended())
 def get_activity_history():
-    """Get battery history for last 7 days"""
+    """Get battery history, newest first
+
+    Pages continue from cursor=<next_cursor of the previous page>.
+    format=ndjson or format=csv streams the whole window (or limit rows)
+    instead of returning one page.
+    """
     try:
-        if not os.path.exists(BATTERY_DB_PATH):
-            return jsonify({'error': 'Database not available'}), 503
-        
         # Get query parameters
-        limit = request.args.get('limit', 100, type=int)
         hours = request.args.get('hours', 24, type=int)
+        points = request.args.get('points', type=int)
+        export_format = request.args.get('format', 'json')
+        resolution = _history_resolution(hours, points, request.args.get('resolution'))
+        try:
+            cursor = _parse_cursor(request.args.get('cursor'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        cutoff_time = datetime.now() - timedelta(hours=hours)
+        if resolution != 'raw' and resolution not in battery_db.ROLLUP_RESOLUTIONS:
+            return jsonify({'error': f'Unknown resolution: {resolution}'}), 400
+        if export_format != 'json' and export_format not in EXPORT_FORMATS:
+            return jsonify({'error': f'Unknown format: {export_format}'}), 400
         
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT timestamp, battery_percent, battery_voltage, 
-                       ac_output_power, dc_output_power, total_output_power,
-                       ac_input_power, dc_input_power, time_remaining_hours,
-                       pack1_voltage, pack2_voltage, pack3_voltage
-                FROM battery_snapshots 
-                WHERE timestamp > ? 
-                ORDER BY timestamp DESC 
-                LIMIT ?
-            ''', (cutoff_time.isoformat(), limit))
-            
-            rows = cursor.fetchall()
-            
-            history = []
-            for row in rows:
-                history.append({
-                    'timestamp': row[0],
-                    'battery_percent': row[1],
-                    'battery_voltage': row[2],
-                    'ac_output_power': row[3],
-                    'dc_output_power': row[4],
-                    'total_output_power': row[5],
-                    'ac_input_power': row[6],
-                    'dc_input_power': row[7],
-                    'time_remaining_hours': row[8],
-                    'pack1_voltage': row[9],
-                    'pack2_voltage': row[10],
-                    'pack3_voltage': row[11]
-                })
-            
-            return jsonify({
-                'history': history,
-                'count': len(history),
-                'period_hours': hours
-            })
+        if export_format != 'json':
+            if not os.path.exists(BATTERY_DB_PATH):
+                return jsonify({'error': 'Database not available'}), 503
+            rows, to_entry = _export_activity_history(hours, resolution, request.args.get('limit', type=int), cursor)
+            return _export_response(rows, export_format, to_entry, 'activity_history')
+        
+        limit = request.args.get('limit', 100, type=int)
+        result = _activity_history(hours, limit, points, resolution, cursor)
+        if result is None:
+            return jsonify({'error': 'Database not available'}), 503
+        return jsonify(result)
             
     except Exception as e:
         logger.error(f"Error getting activity history: {e}")
         return jsonify({'error': str(e)}), 500
 
+def _charge_sessions(limit, days):
+    """The /api/activity/charge-sessions payload"""
+    cutoff_time = datetime.now() - timedelta(days=days)
+    
+    with battery_db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT start_time, end_time, start_percent, end_percent,
+                   duration_minutes, charge_type, avg_input_power,
+                   peak_input_power, energy_wh, output_energy_wh
+            FROM charge_sessions 
+            WHERE start_time > ? 
+            ORDER BY start_time DESC 
+            LIMIT ?
+        ''', (battery_db.to_ms(cutoff_time), limit))
+        
+        rows = cursor.fetchall()
+    
+    sessions = []
+    for row in rows:
+        sessions.append({
+            'start_time': battery_db.ms_to_iso(row[0]),
+            'end_time': battery_db.ms_to_iso(row[1]),
+            'start_percent': row[2],
+            'end_percent': row[3],
+            'duration_minutes': row[4],
+            'charge_type': row[5],
+            'avg_input_power': row[6],
+            'peak_input_power': row[7],
+            'energy_wh': row[8],
+            'output_energy_wh': row[9],
+            'percent_gained': row[3] - row[2] if row[1] else None,
+            'completed': row[1] is not None
+        })
+    
+    return {
+        'sessions': sessions,
+        'count': len(sessions),
+        'period_days': days
+    }
+
 @app.route('/api/activity/charge-sessions', methods=['GET'])
+@responses.cached()
 def get_charge_sessions():
     """Get recent charging sessions"""
     try:
@@ -558,47 +833,69 @@ def get_charge_sessions():
         
         limit = request.args.get('limit', 20, type=int)
         days = request.args.get('days', 7, type=int)
-        
-        cutoff_time = datetime.now() - timedelta(days=days)
-        
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT start_time, end_time, start_percent, end_percent,
-                       duration_minutes, charge_type, avg_input_power
-                FROM charge_sessions 
-                WHERE start_time > ? 
-                ORDER BY start_time DESC 
-                LIMIT ?
-            ''', (cutoff_time.isoformat(), limit))
-            
-            rows = cursor.fetchall()
-            
-            sessions = []
-            for row in rows:
-                sessions.append({
-                    'start_time': row[0],
-                    'end_time': row[1],
-                    'start_percent': row[2],
-                    'end_percent': row[3],
-                    'duration_minutes': row[4],
-                    'charge_type': row[5],
-                    'avg_input_power': row[6],
-                    'percent_gained': row[3] - row[2] if row[1] else None,
-                    'completed': row[1] is not None
-                })
-            
-            return jsonify({
-                'sessions': sessions,
-                'count': len(sessions),
-                'period_days': days
-            })
+        return jsonify(_charge_sessions(limit, days))
             
     except Exception as e:
         logger.error(f"Error getting charge sessions: {e}")
         return jsonify({'error': str(e)}), 500
 
+def _activity_stats(days):
+    """The /api/activity/stats payload"""
+    cutoff_time = datetime.now() - timedelta(days=days)
+    
+    with battery_db.connection() as conn:
+        cursor = conn.cursor()
+        
+        # Get consumption stats from the rollups rather than raw snapshots
+        resolution = battery_db.choose_resolution(days * 86400, STATS_MAX_BUCKETS)
+        cutoff_ms = battery_db.rollup_bucket(resolution, battery_db.to_ms(cutoff_time))
+        cursor.execute(f'''
+            SELECT SUM(total_output_power_sum) / SUM(output_active_count),
+                   MAX(total_output_power_max),
+                   SUM(output_active_count) as snapshot_count
+            FROM {battery_db.rollup_table(resolution)}
+            WHERE bucket_start >= ? AND output_active_count > 0
+        ''', (cutoff_ms,))
+        
+        consumption_stats = cursor.fetchone()
+        
+        # Get charging stats
+        cursor.execute('''
+            SELECT COUNT(*) as total_sessions,
+                   AVG(duration_minutes) as avg_duration,
+                   AVG(end_percent - start_percent) as avg_percent_gained,
+                   SUM(duration_minutes) as total_charge_time,
+                   SUM(energy_wh) as total_energy,
+                   MAX(peak_input_power) as peak_input_power
+            FROM charge_sessions 
+            WHERE start_time > ? AND end_time IS NOT NULL
+        ''', (battery_db.to_ms(cutoff_time),))
+        
+        charging_stats = cursor.fetchone()
+        
+        # Percentiles from the hourly sketches
+        power = quantile_sketch.merge_range(conn, battery_db.to_ms(cutoff_time), fields=('total_output_power',))
+    
+    return {
+        'period_days': days,
+        'consumption': {
+            'avg_power_watts': consumption_stats[0] or 0,
+            'max_power_watts': consumption_stats[1] or 0,
+            'snapshot_count': consumption_stats[2] or 0,
+            'power_percentiles': power['total_output_power'].summary()
+        },
+        'charging': {
+            'total_sessions': charging_stats[0] or 0,
+            'avg_duration_minutes': charging_stats[1] or 0,
+            'avg_percent_gained': charging_stats[2] or 0,
+            'total_charge_time_minutes': charging_stats[3] or 0,
+            'total_energy_wh': charging_stats[4] or 0,
+            'peak_input_power': charging_stats[5] or 0
+        }
+    }
+
 @app.route('/api/activity/stats', methods=['GET'])
+@responses.cached()
 def get_activity_stats():
     """Get summary statistics"""
     try:
@@ -606,248 +903,389 @@ def get_activity_stats():
             return jsonify({'error': 'Database not available'}), 503
         
         days = request.args.get('days', 7, type=int)
-        cutoff_time = datetime.now() - timedelta(days=days)
-        
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            # Get consumption stats
-            cursor.execute('''
-                SELECT AVG(total_output_power), MAX(total_output_power), 
-                       COUNT(*) as snapshot_count
-                FROM battery_snapshots 
-                WHERE timestamp > ? AND total_output_power > 0
-            ''', (cutoff_time.isoformat(),))
-            
-            consumption_stats = cursor.fetchone()
-            
-            # Get charging stats
-            cursor.execute('''
-                SELECT COUNT(*) as total_sessions,
-                       AVG(duration_minutes) as avg_duration,
-                       AVG(end_percent - start_percent) as avg_percent_gained,
-                       SUM(duration_minutes) as total_charge_time
-                FROM charge_sessions 
-                WHERE start_time > ? AND end_time IS NOT NULL
-            ''', (cutoff_time.isoformat(),))
-            
-            charging_stats = cursor.fetchone()
-            
-            return jsonify({
-                'period_days': days,
-                'consumption': {
-                    'avg_power_watts': consumption_stats[0] or 0,
-                    'max_power_watts': consumption_stats[1] or 0,
-                    'snapshot_count': consumption_stats[2] or 0
-                },
-                'charging': {
-                    'total_sessions': charging_stats[0] or 0,
-                    'avg_duration_minutes': charging_stats[1] or 0,
-                    'avg_percent_gained': charging_stats[2] or 0,
-                    'total_charge_time_minutes': charging_stats[3] or 0
-                }
-            })
+        return jsonify(_activity_stats(days))
             
     except Exception as e:
         logger.error(f"Error getting activity stats: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/activity/stats/extended', methods=['GET'])
+def get_activity_stats_extended():
+    """Get percentiles, power histogram, rolling mean, duty cycle and energy for a range"""
+    try:
+        if not battery_analytics.available():
+            return jsonify({'error': 'NumPy is required for extended statistics'}), 501
+        if not os.path.exists(BATTERY_DB_PATH):
+            return jsonify({'error': 'Database not available'}), 503
+        
+        days = min(request.args.get('days', 7, type=int), EXTENDED_STATS_MAX_DAYS)
+        bins = min(max(request.args.get('bins', 20, type=int), 1), 200)
+        window_minutes = max(request.args.get('window_minutes', 60, type=int), 1)
+        points = min(max(request.args.get('points', 200, type=int), 1), 2000)
+        
+        start = time.monotonic()
+        cutoff_ms = battery_db.to_ms(datetime.now() - timedelta(days=days))
+        with battery_db.connection() as conn:
+            data = battery_analytics.load_range(conn, cutoff_ms)
+        
+        result = battery_analytics.summarize(data, bins, window_minutes * 60000, points)
+        result['period_days'] = days
+        result['compute_ms'] = round((time.monotonic() - start) * 1000, 1)
+        return jsonify(result)
+        
+    except Exception as e:
+        logger.error(f"Error getting extended activity stats: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/activity/quantiles', methods=['GET'])
+def get_activity_quantiles():
+    """Get power and voltage percentiles merged from the hourly sketches"""
+    try:
+        if not os.path.exists(BATTERY_DB_PATH):
+            return jsonify({'error': 'Database not available'}), 503
+        
+        hours = request.args.get('hours', 24 * request.args.get('days', 30, type=int), type=int)
+        fields = request.args.get('fields')
+        fields = fields.split(',') if fields else list(quantile_sketch.SKETCH_FIELDS)
+        unknown = [field for field in fields if field not in quantile_sketch.SKETCH_FIELDS]
+        if unknown:
+            return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+        try:
+            quantiles = [float(q) for q in request.args.get('q', '0.5,0.95,0.99').split(',')]
+        except ValueError:
+            return jsonify({'error': 'q must be a comma-separated list of numbers between 0 and 1'}), 400
+        if not all(0 <= q <= 1 for q in quantiles):
+            return jsonify({'error': 'q must be a comma-separated list of numbers between 0 and 1'}), 400
+        
+        start = time.monotonic()
+        cutoff_ms = battery_db.to_ms(datetime.now() - timedelta(hours=hours))
+        with battery_db.connection() as conn:
+            sketches = quantile_sketch.merge_range(conn, cutoff_ms, fields=fields)
+        
+        return jsonify({
+            'period_hours': hours,
+            'fields': {field: sketch.summary(quantiles) for field, sketch in sketches.items()},
+            'compute_ms': round((time.monotonic() - start) * 1000, 1)
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting activity quantiles: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# Energy Ledger API Endpoints
+@app.route('/api/energy/hourly', methods=['GET'])
+def get_energy_hourly():
+    """Get Wh in/out per hour, AC vs DC (solar)"""
+    return _energy_response('hourly', timedelta(hours=request.args.get('hours', 48, type=int)))
+
+@app.route('/api/energy/daily', methods=['GET'])
+def get_energy_daily():
+    """Get Wh in/out per local day, AC vs DC (solar)"""
+    return _energy_response('daily', timedelta(days=request.args.get('days', 30, type=int)))
+
+def _energy_response(period, span):
+    try:
+        if not os.path.exists(BATTERY_DB_PATH):
+            return jsonify({'error': 'Database not available'}), 503
+        
+        start_ms = battery_db.to_ms(datetime.now() - span)
+        if period == 'daily':
+            start_ms = battery_db.rollup_bucket('1d', start_ms)
+        else:
+            start_ms = battery_db.rollup_bucket('1h', start_ms)
+        
+        with battery_db.connection() as conn:
+            periods = energy_ledger.read_periods(conn, period, start_ms)
+        
+        totals = {}
+        for key in ('ac_input_wh', 'dc_input_wh', 'ac_output_wh', 'dc_output_wh', 'total_input_wh', 'total_output_wh'):
+            totals[key] = round(sum(entry[key] for entry in periods), 2)
+        totals['solar_share'] = round(totals['dc_input_wh'] / totals['total_input_wh'], 3) if totals['total_input_wh'] > 0 else None
+        
+        return jsonify({
+            'period': period,
+            'periods': periods,
+            'count': len(periods),
+            'totals': totals
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting {period} energy: {e}")
+        return jsonify({'error': str(e)}), 500
+
+# Battery Health API Endpoints
+def _battery_capacity(days):
+    """The /api/battery/capacity payload"""
+    discharge_engine.current()
+    result = discharge_engine.capacity.summary()
+    
+    with battery_db.connection() as conn:
+        rows = conn.execute('''
+            SELECT timestamp, direction, start_percent, end_percent, energy_wh,
+                   segment_capacity_wh, capacity_wh, confidence
+            FROM capacity_history
+            WHERE timestamp >= ?
+            ORDER BY timestamp
+        ''', (battery_db.to_ms(datetime.now() - timedelta(days=days)),)).fetchall()
+    
+    result['history'] = [
+        {
+            'timestamp': battery_db.ms_to_iso(row[0]),
+            'direction': row[1],
+            'start_percent': row[2],
+            'end_percent': row[3],
+            'energy_wh': row[4],
+            'segment_capacity_wh': row[5],
+            'capacity_wh': row[6],
+            'confidence': row[7]
+        }
+        for row in rows
+    ]
+    result['period_days'] = days
+    return result
+
+@app.route('/api/battery/capacity', methods=['GET'])
+def get_battery_capacity():
+    """Get the estimated effective capacity, state of health and recent segments"""
+    try:
+        if not os.path.exists(BATTERY_DB_PATH):
+            return jsonify({'error': 'Database not available'}), 503
+        
+        days = request.args.get('days', 90, type=int)
+        return jsonify(_battery_capacity(days))
+        
+    except Exception as e:
+        logger.error(f"Error getting battery capacity: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/discharge/load-profile', methods=['GET'])
+def get_load_profile():
+    """Get the learned net power draw (watts) per weekday and hour of day"""
+    try:
+        if not os.path.exists(BATTERY_DB_PATH):
+            return jsonify({'error': 'Database not available'}), 503
+        
+        discharge_engine.current()
+        profile = discharge_engine.profile
+        return jsonify({
+            'profile_ready': profile.ready,
+            'last_hour': battery_db.ms_to_iso(profile.last_bucket),
+            'net_power_watts': profile.summary()
+        })
+        
+    except Exception as e:
+        logger.error(f"Error getting load profile: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/packs/health', methods=['GET'])
+def get_pack_health():
+    """Get live pack voltages, spread and recent imbalance, drift and sag events"""
+    try:
+        return jsonify(pack_health.health())
+        
+    except Exception as e:
+        logger.error(f"Error getting pack health: {e}")
+        return jsonify({'error': str(e)}), 500
+
 # Discharge Session API Endpoints
+def _round_hours(hours):
+    return round(hours, 2) if hours is not None and hours != float('inf') else None
+
+def _discharge_payload(analysis):
+    """The /api/discharge/current body for an analysis"""
+    if not analysis.data_available:
+        return {
+            'data_available': False,
+            'message': 'No discharge data available yet'
+        }
+    
+    estimated_hours_remaining = analysis.estimated_hours_remaining or 0
+    estimated_days_remaining = analysis.estimated_days_remaining or 0
+    
+    return {
+        'data_available': True,
+        'battery_percent': analysis.battery_percent,
+        'discharge_rate_percent_per_hour': round(analysis.discharge_rate_percent_per_hour, 2),
+        'estimated_hours_remaining': round(estimated_hours_remaining, 1),
+        'estimated_days_remaining': round(estimated_days_remaining, 1),
+        'avg_power_consumption': round(analysis.avg_power_consumption, 1),
+        'last_updated': battery_db.ms_to_iso(analysis.last_updated_ms),
+        'formatted_time_remaining': format_duration_short(estimated_hours_remaining),
+        'analysis_period_hours': analysis.analysis_period_hours,
+        'sessions_analyzed': round(analysis.sample_weight),
+        'capacity_wh': round(analysis.capacity_wh, 1),
+        'capacity_confidence': round(analysis.capacity_confidence, 3),
+        'forecast': {
+            'hours_to_empty': _round_hours(analysis.forecast_hours_to_empty),
+            'beyond_horizon': analysis.forecast_beyond_horizon,
+            'formatted_time_to_empty': format_duration(analysis.forecast_hours_to_empty),
+            'thresholds': [
+                {
+                    'percent': percent,
+                    'hours': _round_hours(hours),
+                    'formatted': format_duration(hours)
+                }
+                for percent, hours in analysis.forecast_thresholds
+            ]
+        }
+    }
+
 @app.route('/api/discharge/current', methods=['GET'])
 def get_discharge_current():
     """Get current discharge status and predictions based on historical analysis"""
     try:
         if not os.path.exists(BATTERY_DB_PATH):
             return jsonify({'error': 'Database not available'}), 503
-            
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            # Get the most recent discharge session for current battery level
-            cursor.execute('''
-                SELECT battery_percent, timestamp
-                FROM discharge_sessions 
-                ORDER BY timestamp DESC 
-                LIMIT 1
-            ''')
-            latest = cursor.fetchone()
-            
-            if not latest:
-                return jsonify({
-                    'data_available': False,
-                    'message': 'No discharge data available yet'
-                })
-            
-            current_battery, current_timestamp = latest
-            
-            # Calculate statistics from all sessions in the last 24 hours
-            cursor.execute('''
-                SELECT 
-                    AVG(discharge_rate_percent_per_hour) as avg_discharge_rate,
-                    AVG(avg_power_consumption) as avg_power,
-                    COUNT(*) as session_count,
-                    MIN(timestamp) as first_session,
-                    MAX(timestamp) as last_session
-                FROM discharge_sessions 
-                WHERE timestamp >= datetime('now', '-24 hours')
-            ''')
-            stats = cursor.fetchone()
-            
-            if not stats or stats[2] == 0:  # session_count
-                return jsonify({
-                    'data_available': False,
-                    'message': 'Insufficient data for analysis'
-                })
-            
-            avg_discharge_rate, avg_power, session_count, first_session, last_session = stats
-            
-            # Calculate time-based discharge rate from battery level changes
-            # Use a longer period to get more accurate rate
-            cursor.execute('''
-                SELECT battery_percent, timestamp
-                FROM discharge_sessions 
-                WHERE timestamp >= datetime('now', '-12 hours')
-                ORDER BY timestamp ASC
-            ''')
-            sessions = cursor.fetchall()
-            
-            # Calculate actual discharge rate from battery level changes
-            if len(sessions) >= 3:  # Need at least 3 sessions for reliable calculation
-                first_battery = sessions[0][0]
-                last_battery = sessions[-1][0]
-                first_time = datetime.fromisoformat(sessions[0][1])
-                last_time = datetime.fromisoformat(sessions[-1][1])
-                
-                time_diff_hours = (last_time - first_time).total_seconds() / 3600
-                battery_diff = first_battery - last_battery
-                
-                # Only use this calculation if we have enough time span (at least 2 hours)
-                if time_diff_hours >= 2 and battery_diff > 0:
-                    actual_discharge_rate = battery_diff / time_diff_hours
-                else:
-                    # If not enough data, use power-based estimation
-                    # Estimate discharge rate based on power consumption
-                    if avg_power > 0:
-                        # Convert power consumption to %/hour based on battery capacity
-                        total_capacity_wh = 6144
-                        power_discharge_rate = (avg_power / total_capacity_wh) * 100
-                        actual_discharge_rate = power_discharge_rate
-                    else:
-                        actual_discharge_rate = avg_discharge_rate or 0
-            else:
-                # Not enough data, use power-based estimation
-                if avg_power > 0:
-                    total_capacity_wh = 6144
-                    actual_discharge_rate = (avg_power / total_capacity_wh) * 100
-                else:
-                    actual_discharge_rate = avg_discharge_rate or 0
-            
-            # Calculate estimated time remaining based on current battery and discharge rate
-            # Use actual battery capacity (6144Wh for AC200MAX + 2x B230)
-            total_capacity_wh = 6144
-            if actual_discharge_rate > 0:
-                # Convert discharge rate from %/hour to Wh/hour
-                current_capacity_wh = (current_battery / 100) * total_capacity_wh
-                discharge_rate_wh_per_hour = (actual_discharge_rate / 100) * total_capacity_wh
-                
-                if discharge_rate_wh_per_hour > 0:
-                    estimated_hours_remaining = current_capacity_wh / discharge_rate_wh_per_hour
-                    estimated_days_remaining = estimated_hours_remaining / 24
-                else:
-                    estimated_hours_remaining = 0
-                    estimated_days_remaining = 0
-            else:
-                estimated_hours_remaining = 0
-                estimated_days_remaining = 0
-            
-            # Format time remaining
-            if estimated_days_remaining >= 1:
-                formatted_time_remaining = f"{int(estimated_days_remaining)}d {int(estimated_hours_remaining % 24)}h"
-            elif estimated_hours_remaining >= 1:
-                formatted_time_remaining = f"{int(estimated_hours_remaining)}h {int((estimated_hours_remaining % 1) * 60)}m"
-            else:
-                formatted_time_remaining = f"{int(estimated_hours_remaining * 60)}m"
-            
-            return jsonify({
-                'data_available': True,
-                'battery_percent': current_battery,
-                'discharge_rate_percent_per_hour': round(actual_discharge_rate, 2),
-                'estimated_hours_remaining': round(estimated_hours_remaining, 1),
-                'estimated_days_remaining': round(estimated_days_remaining, 1),
-                'avg_power_consumption': round(avg_power or 0, 1),
-                'last_updated': current_timestamp,
-                'formatted_time_remaining': formatted_time_remaining,
-                'analysis_period_hours': 24,
-                'sessions_analyzed': session_count
-            })
+        
+        return jsonify(_discharge_payload(discharge_engine.current()))
             
     except Exception as e:
         logger.error(f"Error getting current discharge status: {e}")
         return jsonify({'error': str(e)}), 500
 
+def _read_discharge_page(start_ms):
+    def read_page(limit, before):
+        with battery_db.connection() as conn:
+            return battery_db.read_page(
+                conn, 'discharge_sessions', ', '.join(DISCHARGE_COLUMNS), start_ms, limit, before
+            )
+    return read_page
+
+def _discharge_entry(row):
+    """History dict for a discharge_sessions row (DISCHARGE_COLUMNS, then id)"""
+    timestamp, battery_percent, discharge_rate, est_hours, est_days, avg_power, total_power, _ = row
+    
+    # Format time remaining
+    if est_days >= 1:
+        formatted_time = f"{int(est_days)}d {int(est_hours % 24)}h"
+    elif est_hours >= 1:
+        formatted_time = f"{int(est_hours)}h {int((est_hours % 1) * 60)}m"
+    else:
+        formatted_time = f"{int(est_hours * 60)}m"
+    
+    return {
+        'timestamp': battery_db.ms_to_iso(timestamp),
+        'battery_percent': battery_percent,
+        'discharge_rate_percent_per_hour': discharge_rate,
+        'estimated_hours_remaining': est_hours,
+        'estimated_days_remaining': est_days,
+        'formatted_time_remaining': formatted_time,
+        'avg_power_consumption': avg_power,
+        'total_output_power': total_power
+    }
+
+def _discharge_history(hours, limit, before=None):
+    """The /api/discharge/history payload"""
+    cutoff_ms = battery_db.to_ms(datetime.now() - timedelta(hours=hours))
+    rows = _read_discharge_page(cutoff_ms)(limit, before)
+    sessions = [_discharge_entry(row) for row in rows]
+    
+    return {
+        'sessions': sessions,
+        'count': len(sessions),
+        'period_hours': hours,
+        'next_cursor': _next_cursor(rows, limit)
+    }
+
 @app.route('/api/discharge/history', methods=['GET'])
+@responses.cached()
 def get_discharge_history():
-    """Get discharge session history"""
+    """Get discharge session history, newest first
+
+    Pages continue from cursor=<next_cursor of the previous page>.
+    format=ndjson or format=csv streams the whole window (or limit rows).
+    """
     try:
         if not os.path.exists(BATTERY_DB_PATH):
             return jsonify({'error': 'Database not available'}), 503
             
         hours = request.args.get('hours', 24, type=int)
-        limit = request.args.get('limit', 50, type=int)
-        
-        # Limit to reasonable values
-        hours = min(hours, 168)  # Max 1 week
-        limit = min(limit, 200)  # Max 200 records
+        export_format = request.args.get('format', 'json')
+        try:
+            cursor = _parse_cursor(request.args.get('cursor'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        cutoff_time = datetime.now() - timedelta(hours=hours)
+        if export_format != 'json':
+            if export_format not in EXPORT_FORMATS:
+                return jsonify({'error': f'Unknown format: {export_format}'}), 400
+            cutoff_ms = battery_db.to_ms(datetime.now() - timedelta(hours=hours))
+            rows = _iter_pages(_read_discharge_page(cutoff_ms), request.args.get('limit', type=int), cursor)
+            return _export_response(rows, export_format, _discharge_entry, 'discharge_history')
         
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                SELECT timestamp, battery_percent, discharge_rate_percent_per_hour,
-                       estimated_hours_remaining, estimated_days_remaining,
-                       avg_power_consumption, total_output_power
-                FROM discharge_sessions 
-                WHERE timestamp >= ?
-                ORDER BY timestamp DESC 
-                LIMIT ?
-            ''', (cutoff_time.isoformat(), limit))
-            
-            sessions = []
-            for row in cursor.fetchall():
-                timestamp, battery_percent, discharge_rate, est_hours, est_days, avg_power, total_power = row
-                
-                # Format time remaining
-                if est_days >= 1:
-                    formatted_time = f"{int(est_days)}d {int(est_hours % 24)}h"
-                elif est_hours >= 1:
-                    formatted_time = f"{int(est_hours)}h {int((est_hours % 1) * 60)}m"
-                else:
-                    formatted_time = f"{int(est_hours * 60)}m"
-                
-                sessions.append({
-                    'timestamp': timestamp,
-                    'battery_percent': battery_percent,
-                    'discharge_rate_percent_per_hour': discharge_rate,
-                    'estimated_hours_remaining': est_hours,
-                    'estimated_days_remaining': est_days,
-                    'formatted_time_remaining': formatted_time,
-                    'avg_power_consumption': avg_power,
-                    'total_output_power': total_power
-                })
-            
-            return jsonify({
-                'sessions': sessions,
-                'count': len(sessions),
-                'period_hours': hours
-            })
+        # Page size is bounded; longer ranges are read page by page
+        limit = min(request.args.get('limit', 50, type=int), DISCHARGE_HISTORY_MAX_ROWS)
+        return jsonify(_discharge_history(hours, limit, cursor))
             
     except Exception as e:
         logger.error(f"Error getting discharge history: {e}")
         return jsonify({'error': str(e)}), 500
 
+def _discharge_stats(days):
+    """The /api/discharge/stats payload"""
+    cutoff_time = datetime.now() - timedelta(days=days)
+    
+    with battery_db.connection() as conn:
+        cursor = conn.cursor()
+        
+        # Get discharge statistics
+        cursor.execute(f'''
+            SELECT 
+                COUNT(*) as total_sessions,
+                AVG(discharge_rate_percent_per_hour) as avg_discharge_rate,
+                MIN(discharge_rate_percent_per_hour) as min_discharge_rate,
+                MAX(discharge_rate_percent_per_hour) as max_discharge_rate,
+                AVG(avg_power_consumption) as avg_power_consumption,
+                MIN(avg_power_consumption) as min_power_consumption,
+                MAX(avg_power_consumption) as max_power_consumption,
+                AVG(estimated_days_remaining) as avg_estimated_days
+            FROM {_range_source(conn, 'discharge_sessions', timedelta(days=days))} 
+            WHERE timestamp >= ? AND discharge_rate_percent_per_hour > 0
+        ''', (battery_db.to_ms(cutoff_time),))
+        
+        stats = cursor.fetchone()
+    
+    if not stats or stats[0] == 0:
+        return {
+            'period_days': days,
+            'total_sessions': 0,
+            'discharge_rate': {
+                'avg_percent_per_hour': 0,
+                'min_percent_per_hour': 0,
+                'max_percent_per_hour': 0
+            },
+            'power_consumption': {
+                'avg_watts': 0,
+                'min_watts': 0,
+                'max_watts': 0
+            },
+            'predictions': {
+                'avg_estimated_days': 0
+            }
+        }
+    
+    total_sessions, avg_rate, min_rate, max_rate, avg_power, min_power, max_power, avg_est_days = stats
+    
+    return {
+        'period_days': days,
+        'total_sessions': total_sessions,
+        'discharge_rate': {
+            'avg_percent_per_hour': round(avg_rate or 0, 2),
+            'min_percent_per_hour': round(min_rate or 0, 2),
+            'max_percent_per_hour': round(max_rate or 0, 2)
+        },
+        'power_consumption': {
+            'avg_watts': round(avg_power or 0, 1),
+            'min_watts': round(min_power or 0, 1),
+            'max_watts': round(max_power or 0, 1)
+        },
+        'predictions': {
+            'avg_estimated_days': round(avg_est_days or 0, 1)
+        }
+    }
+
 @app.route('/api/discharge/stats', methods=['GET'])
+@responses.cached()
 def get_discharge_stats():
     """Get discharge statistics"""
     try:
@@ -857,66 +1295,7 @@ def get_discharge_stats():
         days = request.args.get('days', 7, type=int)
         days = min(days, 30)  # Max 30 days
         
-        cutoff_time = datetime.now() - timedelta(days=days)
-        
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            # Get discharge statistics
-            cursor.execute('''
-                SELECT 
-                    COUNT(*) as total_sessions,
-                    AVG(discharge_rate_percent_per_hour) as avg_discharge_rate,
-                    MIN(discharge_rate_percent_per_hour) as min_discharge_rate,
-                    MAX(discharge_rate_percent_per_hour) as max_discharge_rate,
-                    AVG(avg_power_consumption) as avg_power_consumption,
-                    MIN(avg_power_consumption) as min_power_consumption,
-                    MAX(avg_power_consumption) as max_power_consumption,
-                    AVG(estimated_days_remaining) as avg_estimated_days
-                FROM discharge_sessions 
-                WHERE timestamp >= ? AND discharge_rate_percent_per_hour > 0
-            ''', (cutoff_time.isoformat(),))
-            
-            stats = cursor.fetchone()
-            
-            if not stats or stats[0] == 0:
-                return jsonify({
-                    'period_days': days,
-                    'total_sessions': 0,
-                    'discharge_rate': {
-                        'avg_percent_per_hour': 0,
-                        'min_percent_per_hour': 0,
-                        'max_percent_per_hour': 0
-                    },
-                    'power_consumption': {
-                        'avg_watts': 0,
-                        'min_watts': 0,
-                        'max_watts': 0
-                    },
-                    'predictions': {
-                        'avg_estimated_days': 0
-                    }
-                })
-            
-            total_sessions, avg_rate, min_rate, max_rate, avg_power, min_power, max_power, avg_est_days = stats
-            
-            return jsonify({
-                'period_days': days,
-                'total_sessions': total_sessions,
-                'discharge_rate': {
-                    'avg_percent_per_hour': round(avg_rate or 0, 2),
-                    'min_percent_per_hour': round(min_rate or 0, 2),
-                    'max_percent_per_hour': round(max_rate or 0, 2)
-                },
-                'power_consumption': {
-                    'avg_watts': round(avg_power or 0, 1),
-                    'min_watts': round(min_power or 0, 1),
-                    'max_watts': round(max_power or 0, 1)
-                },
-                'predictions': {
-                    'avg_estimated_days': round(avg_est_days or 0, 1)
-                }
-            })
+        return jsonify(_discharge_stats(days))
             
     except Exception as e:
         logger.error(f"Error getting discharge stats: {e}")
@@ -927,25 +1306,11 @@ def get_discharge_stats():
 def get_section_order():
     """Get current section order and visibility settings"""
     try:
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT section_name, display_order, is_visible 
-                FROM section_order 
-                ORDER BY display_order
-            ''')
-            sections = []
-            for row in cursor.fetchall():
-                sections.append({
-                    'name': row[0],
-                    'order': row[1],
-                    'visible': bool(row[2])
-                })
-            
-            return jsonify({
-                'sections': sections,
-                'count': len(sections)
-            })
+        sections = settings_cache.section_order()
+        return jsonify({
+            'sections': sections,
+            'count': len(sections)
+        })
             
     except Exception as e:
         logger.error(f"Error getting section order: {e}")
@@ -959,23 +1324,14 @@ def update_section_order():
         if not data or 'sections' not in data:
             return jsonify({'error': 'Invalid request data'}), 400
         
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            # Update each section's order and visibility
-            for section in data['sections']:
-                cursor.execute('''
-                    UPDATE section_order 
-                    SET display_order = ?, is_visible = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE section_name = ?
-                ''', (section['order'], section['visible'], section['name']))
-            
-            conn.commit()
-            
-            return jsonify({
-                'success': True,
-                'message': 'Section order updated successfully'
-            })
+        with battery_db.transaction() as conn:
+            battery_settings.save_section_order(conn, data['sections'])
+        settings_cache.invalidate()
+        
+        return jsonify({
+            'success': True,
+            'message': 'Section order updated successfully'
+        })
             
     except Exception as e:
         logger.error(f"Error updating section order: {e}")
@@ -985,38 +1341,112 @@ def update_section_order():
 def reset_section_order():
     """Reset section order to default"""
     try:
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            # Reset to default order
-            default_sections = [
-                ('battery_status', 1, 1),
-                ('power_flow', 2, 1),
-                ('activity_log', 3, 1),
-                ('discharge_analysis', 4, 1),
-                ('raw_data', 5, 1)
-            ]
-            
-            # Clear existing data
-            cursor.execute('DELETE FROM section_order')
-            
-            # Insert default order
-            cursor.executemany('''
-                INSERT INTO section_order (section_name, display_order, is_visible)
-                VALUES (?, ?, ?)
-            ''', default_sections)
-            
-            conn.commit()
-            
-            return jsonify({
-                'success': True,
-                'message': 'Section order reset to default'
-            })
+        with battery_db.transaction() as conn:
+            battery_settings.reset_section_order(conn)
+        settings_cache.invalidate()
+        
+        return jsonify({
+            'success': True,
+            'message': 'Section order reset to default'
+        })
             
     except Exception as e:
         logger.error(f"Error resetting section order: {e}")
         return jsonify({'error': str(e)}), 500
 
+# Dashboard API Endpoint
+def _dashboard_section(name, args):
+    """Build one /api/dashboard section from its prefixed query args (e.g. history.hours)"""
+    if name == 'current':
+        return _current_activity()
+    if name == 'discharge':
+        return _discharge_payload(discharge_engine.current())
+    if name == 'sections':
+        sections = settings_cache.section_order()
+        return {'sections': sections, 'count': len(sections)}
+    if name == 'packs':
+        return pack_health.health()
+    
+    if name == 'history':
+        hours = args.get('history.hours', 24, type=int)
+        limit = args.get('history.limit', 100, type=int)
+        points = args.get('history.points', type=int)
+        resolution = _history_resolution(hours, points, args.get('history.resolution'))
+        if resolution != 'raw' and resolution not in battery_db.ROLLUP_RESOLUTIONS:
+            raise ValueError(f'Unknown resolution: {resolution}')
+        return responses.value(
+            ('dashboard', name, hours, limit, points, resolution),
+            lambda: _activity_history(hours, limit, points, resolution),
+            extra_version=telemetry.appended()
+        )
+    
+    if not os.path.exists(BATTERY_DB_PATH):
+        raise LookupError('Database not available')
+    if name == 'charge_sessions':
+        limit = args.get('sessions.limit', 20, type=int)
+        days = args.get('sessions.days', 7, type=int)
+        return responses.value(('dashboard', name, limit, days), lambda: _charge_sessions(limit, days))
+    if name == 'stats':
+        days = args.get('stats.days', 7, type=int)
+        return responses.value(('dashboard', name, days), lambda: _activity_stats(days))
+    if name == 'discharge_history':
+        hours = args.get('discharge_history.hours', 24, type=int)
+        limit = min(args.get('discharge_history.limit', 50, type=int), DISCHARGE_HISTORY_MAX_ROWS)
+        return responses.value(('dashboard', name, hours, limit), lambda: _discharge_history(hours, limit))
+    if name == 'discharge_stats':
+        days = min(args.get('discharge_stats.days', 7, type=int), 30)
+        return responses.value(('dashboard', name, days), lambda: _discharge_stats(days))
+    if name == 'capacity':
+        days = args.get('capacity.days', 90, type=int)
+        return _battery_capacity(days)
+    raise KeyError(name)
+
+@app.route('/api/dashboard', methods=['GET'])
+def get_dashboard():
+    """Get everything the dashboard shows in one response
+
+    include= takes a comma-separated list of sections (default: all of
+    DASHBOARD_SECTIONS). Database sections come from the shared response
+    cache and are otherwise read inside one read transaction, so they
+    describe the same moment. A section that fails is reported in errors
+    and the rest are still returned.
+    """
+    try:
+        include = request.args.get('include')
+        names = [name.strip() for name in include.split(',') if name.strip()] if include else list(DASHBOARD_SECTIONS)
+        unknown = [name for name in names if name not in DASHBOARD_SECTIONS + DASHBOARD_OPTIONAL_SECTIONS]
+        if unknown:
+            return jsonify({'error': f"Unknown sections: {', '.join(unknown)}"}), 400
+        
+        result = {}
+        errors = {}
+        with battery_db.read_snapshot() if os.path.exists(BATTERY_DB_PATH) else contextlib.nullcontext():
+            for name in names:
+                try:
+                    result[name] = _dashboard_section(name, request.args)
+                except Exception as e:
+                    logger.error(f"Error getting dashboard section {name}: {e}")
+                    result[name] = None
+                    errors[name] = str(e)
+        if errors:
+            result['errors'] = errors
+        
+        # The ETag leaves out the wall-clock fields, so an unchanged dashboard still gets a 304
+        stable = dict(result)
+        if stable.get('current'):
+            stable['current'] = live_status.without_clock_fields(stable['current'])
+        etag = hashlib.sha1(json.dumps(stable, sort_keys=True, default=str).encode()).hexdigest()
+        
+        result['timestamp'] = datetime.now().isoformat()
+        response = jsonify(result)
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+        
+    except Exception as e:
+        logger.error(f"Error getting dashboard: {e}")
+        return jsonify({'error': str(e)}), 500
+
 # Discharge Data Edit API Endpoints
 @app.route('/api/discharge/edit', methods=['POST'])
 def edit_discharge_data():
@@ -1033,18 +1463,19 @@ def edit_discharge_data():
         if discharge_rate is None or estimated_hours is None:
             return jsonify({'error': 'discharge_rate_percent_per_hour and estimated_hours_remaining are required'}), 400
         
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
+        with battery_db.transaction() as conn:
             cursor = conn.cursor()
             
-            # Insert a new manual discharge session
-            cursor.execute('''
-                INSERT INTO discharge_sessions 
+            # Insert a new manual discharge session into today's partition
+            partition = battery_db.ensure_partition(conn, 'discharge_sessions', datetime.now().date())
+            cursor.execute(f'''
+                INSERT INTO {partition} 
                 (timestamp, battery_percent, battery_voltage, total_output_power, 
                  discharge_rate_percent_per_hour, estimated_hours_remaining, 
                  estimated_days_remaining, avg_power_consumption, session_type)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
-                datetime.now().isoformat(),
+                battery_db.now_ms(),
                 100.0,  # Assume full battery for manual entry
                 0.0,    # No voltage data for manual entry
                 0.0,    # No power data for manual entry
@@ -1055,8 +1486,6 @@ def edit_discharge_data():
                 'manual'
             ))
             
-            conn.commit()
-            
             return jsonify({
                 'success': True,
                 'message': 'Discharge data updated successfully',
@@ -1075,18 +1504,14 @@ def edit_discharge_data():
 def clear_discharge_data():
     """Clear all discharge data"""
     try:
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            # Clear all discharge sessions
-            cursor.execute('DELETE FROM discharge_sessions')
-            
-            conn.commit()
-            
-            return jsonify({
-                'success': True,
-                'message': 'All discharge data cleared successfully'
-            })
+        with battery_db.transaction() as conn:
+            # Clear all discharge sessions by dropping every day partition
+            battery_db.drop_partitions(conn, 'discharge_sessions')
+        
+        return jsonify({
+            'success': True,
+            'message': 'All discharge data cleared successfully'
+        })
             
     except Exception as e:
         logger.error(f"Error clearing discharge data: {e}")
@@ -1096,22 +1521,11 @@ def clear_discharge_data():
 def get_discharge_interval():
     """Get current discharge logging interval"""
     try:
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            # Get the current interval setting
-            cursor.execute('''
-                SELECT setting_value FROM discharge_settings 
-                WHERE setting_name = 'interval_minutes'
-            ''')
-            
-            result = cursor.fetchone()
-            interval = int(result[0]) if result else 10
-            
-            return jsonify({
-                'interval_minutes': interval,
-                'interval_label': f"{interval} minutes" if interval < 60 else f"{interval // 60} hour{'s' if interval // 60 > 1 else ''}"
-            })
+        interval = settings_cache.discharge_interval()
+        return jsonify({
+            'interval_minutes': interval,
+            'interval_label': f"{interval} minutes" if interval < 60 else f"{interval // 60} hour{'s' if interval // 60 > 1 else ''}"
+        })
             
     except Exception as e:
         logger.error(f"Error getting discharge interval: {e}")
@@ -1129,31 +1543,31 @@ def set_discharge_interval():
         if interval < 1 or interval > 1440:  # 1 minute to 24 hours
             return jsonify({'error': 'Interval must be between 1 and 1440 minutes'}), 400
         
-        with sqlite3.connect(BATTERY_DB_PATH) as conn:
-            cursor = conn.cursor()
-            
-            # Update or insert the interval setting
-            cursor.execute('''
-                INSERT OR REPLACE INTO discharge_settings (setting_name, setting_value, updated_at)
-                VALUES ('interval_minutes', ?, CURRENT_TIMESTAMP)
-            ''', (str(interval),))
-            
-            conn.commit()
-            
-            return jsonify({
-                'success': True,
-                'message': f'Discharge logging interval set to {interval} minutes',
-                'interval_minutes': interval
-            })
+        with battery_db.transaction() as conn:
+            battery_settings.save_discharge_interval(conn, interval)
+        settings_cache.invalidate()
+        
+        return jsonify({
+            'success': True,
+            'message': f'Discharge logging interval set to {interval} minutes',
+            'interval_minutes': interval
+        })
             
     except Exception as e:
         logger.error(f"Error setting discharge interval: {e}")
         return jsonify({'error': str(e)}), 500
 
 if __name__ == "__main__":
+    # In RAM storage mode, bring the database back from the SD card if the logger hasn't yet
+    battery_db.restore_from_durable()
+    
     # Start MQTT handler
     mqtt_handler = MQTTHandler()
     
     # Start Flask app
     logger.info("Starting Bluetti Monitor API Server...")
-    app.run(host='0.0.0.0', port=8083, debug=False)
+    try:
+        app.run(host='0.0.0.0', port=8083, debug=False)
+    finally:
+        # End open /api/stream responses so their worker threads don't hold up exit
+        stream_hub.close_all()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Battery Analytics
+Vectorized statistics over long snapshot ranges with NumPy
+"""
+
+import logging
+import battery_db
+import snapshot_archive
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+ANALYTICS_FIELDS = (
+    'battery_percent', 'total_output_power',
+    'ac_output_power', 'dc_output_power',
+    'ac_input_power', 'dc_input_power'
+)
+MAX_SAMPLE_GAP_MS = 5 * battery_db.SNAPSHOT_INTERVAL * 1000  # longer gaps count as no data
+PERCENTILES = (5, 25, 50, 75, 95, 99)
+
+
+def available():
+    return np is not None
+
+
+def load_range(conn, start_ms, end_ms=None):
+    """Load snapshots into one float64 array per column, oldest first
+
+    Days still in SQLite are read with a single fetchall over the partitions
+    in range; older days come straight from the columnar archive.
+    """
+    columns = {'timestamp': [], **{field: [] for field in ANALYTICS_FIELDS}}
+
+    live_start = snapshot_archive.oldest_live_ms(conn)
+    if live_start is None or start_ms < live_start:
+        archive_end = end_ms
+        if live_start is not None:
+            archive_end = live_start if end_ms is None else min(end_ms, live_start)
+        archived = snapshot_archive.read_columns(start_ms, archive_end)
+        for name in columns:
+            columns[name].append(np.asarray(archived[name], dtype=np.float64))
+
+    start_day = battery_db.from_ms(max(start_ms, live_start or start_ms)).date()
+    source = battery_db.partition_source(conn, 'battery_snapshots', start_day)
+    params = [start_ms] + ([end_ms] if end_ms is not None else [])
+    rows = conn.execute(f'''
+        SELECT timestamp, {', '.join(ANALYTICS_FIELDS)}
+        FROM {source}
+        WHERE timestamp >= ? {'AND timestamp < ?' if end_ms is not None else ''}
+        ORDER BY timestamp
+    ''', params).fetchall()
+    if rows:
+        # NULLs become NaN, like archived values
+        live = np.array(rows, dtype=np.float64)
+        for index, name in enumerate(columns):
+            columns[name].append(live[:, index])
+
+    return {
+        name: np.concatenate(parts) if parts else np.empty(0)
+        for name, parts in columns.items()
+    }
+
+
+def sample_durations(timestamps):
+    """Hours each sample stands for: the time to the next one, zero across gaps"""
+    if len(timestamps) < 2:
+        return np.zeros(len(timestamps))
+    gaps = np.diff(timestamps)
+    gaps = np.where(gaps > MAX_SAMPLE_GAP_MS, 0, gaps)
+    return np.append(gaps, 0) / 3600000
+
+
+def time_weighted_mean(values, durations):
+    mask = ~np.isnan(values) & (durations > 0)
+    total = durations[mask].sum()
+    return float((values[mask] * durations[mask]).sum() / total) if total > 0 else None
+
+
+def percentiles(values):
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return None
+    return dict(zip((f'p{p}' for p in PERCENTILES), np.percentile(values, PERCENTILES).round(2).tolist()))
+
+
+def histogram(values, bins):
+    values = values[~np.isnan(values)]
+    if values.size == 0:
+        return {'edges': [], 'counts': []}
+    counts, edges = np.histogram(values, bins=bins)
+    return {'edges': edges.round(1).tolist(), 'counts': counts.tolist()}
+
+
+def rolling_mean(timestamps, values, window_ms, points):
+    """Time-based rolling mean sampled at `points` evenly spaced times
+
+    Cumulative sums make each window O(1), so the whole series costs one
+    pass plus a binary search per output point.
+    """
+    mask = ~np.isnan(values)
+    timestamps, values = timestamps[mask], values[mask]
+    if timestamps.size == 0:
+        return []
+
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+    at = np.linspace(timestamps[0] + window_ms, timestamps[-1], points) if timestamps[-1] - timestamps[0] > window_ms else timestamps[-1:]
+    upper = np.searchsorted(timestamps, at, side='right')
+    lower = np.searchsorted(timestamps, at - window_ms, side='right')
+    counts = upper - lower
+    means = np.divide(cumulative[upper] - cumulative[lower], counts, out=np.full(len(at), np.nan), where=counts > 0)
+    return [
+        {'timestamp': battery_db.ms_to_iso(int(ts)), 'mean': round(float(mean), 2)}
+        for ts, mean in zip(at, means) if not np.isnan(mean)
+    ]
+
+
+def duty_cycle(data, durations):
+    """Share of logged time spent charging, discharging and idle"""
+    charging = (np.nan_to_num(data['ac_input_power']) + np.nan_to_num(data['dc_input_power'])) > 0
+    discharging = ~charging & (np.nan_to_num(data['total_output_power']) > 0)
+    total = durations.sum()
+    if total <= 0:
+        return {'charging': 0.0, 'discharging': 0.0, 'idle': 0.0, 'hours_logged': 0.0}
+    charging_hours = durations[charging].sum()
+    discharging_hours = durations[discharging].sum()
+    return {
+        'charging': round(float(charging_hours / total), 4),
+        'discharging': round(float(discharging_hours / total), 4),
+        'idle': round(float(1 - (charging_hours + discharging_hours) / total), 4),
+        'hours_logged': round(float(total), 2)
+    }
+
+
+def energy_totals(data, durations):
+    """Wh per power column from the time-weighted samples"""
+    return {
+        field.replace('_power', '_wh'): round(float((np.nan_to_num(data[field]) * durations).sum()), 1)
+        for field in ('ac_input_power', 'dc_input_power', 'ac_output_power', 'dc_output_power', 'total_output_power')
+    }
+
+
+def summarize(data, bins=20, window_ms=3600000, points=200):
+    """All extended statistics for one loaded range"""
+    timestamps = data['timestamp']
+    durations = sample_durations(timestamps)
+    output = data['total_output_power']
+    return {
+        'sample_count': int(timestamps.size),
+        'first_sample': battery_db.ms_to_iso(int(timestamps[0])) if timestamps.size else None,
+        'last_sample': battery_db.ms_to_iso(int(timestamps[-1])) if timestamps.size else None,
+        'output_power': {
+            'time_weighted_avg_watts': time_weighted_mean(output, durations),
+            'percentiles': percentiles(output),
+            'histogram': histogram(output, bins),
+            'rolling_mean': rolling_mean(timestamps, output, window_ms, points)
+        },
+        'battery_percent': {
+            'time_weighted_avg': time_weighted_mean(data['battery_percent'], durations),
+            'percentiles': percentiles(data['battery_percent'])
+        },
+        'duty_cycle': duty_cycle(data, durations),
+        'energy': energy_totals(data, durations)
+    }
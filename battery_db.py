@@ -0,0 +1,845 @@
+#!/usr/bin/env python3
+"""
+Battery Activity Database
+Shared SQLite access layer used by the battery logger and the API server
+"""
+
+import os
+import fcntl
+import sqlite3
+import threading
+import queue
+import time
+import logging
+from contextlib import contextmanager
+from datetime import datetime, date
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+DATA_DIR = "/home/pi/bluetti-monitor"
+DURABLE_DB_PATH = os.path.join(DATA_DIR, "battery_activity.db")
+# 'ram' keeps the live database on tmpfs and copies it to DURABLE_DB_PATH
+# every CHECKPOINT_INTERVAL seconds and on clean shutdown, so at most that
+# much data is lost on a power cut; 'disk' writes DURABLE_DB_PATH directly
+STORAGE_MODE = os.getenv("BATTERY_DB_MODE", "disk").lower()
+RAM_DB_PATH = "/dev/shm/bluetti-monitor/battery_activity.db"
+CHECKPOINT_INTERVAL = int(os.getenv("BATTERY_DB_CHECKPOINT_SECONDS", "900"))
+DB_PATH = RAM_DB_PATH if STORAGE_MODE == "ram" else DURABLE_DB_PATH
+BUSY_TIMEOUT_MS = 5000  # SQLite waits this long for a lock before raising
+BUSY_RETRIES = 4  # Extra attempts for writes that still hit "database is locked"
+BUSY_RETRY_DELAY = 0.2  # seconds, doubled after every failed attempt
+STATEMENT_CACHE_SIZE = 256  # Prepared statements kept per connection
+POOL_SIZE = 8  # Idle connections kept open for reuse
+MIGRATION_BATCH_SIZE = 5000  # rows converted per transaction by data migrations
+SNAPSHOT_INTERVAL = 30  # seconds between logged battery snapshots
+
+# Snapshot rollups: resolution -> (bucket seconds, retention days or None to keep forever)
+ROLLUP_RESOLUTIONS = {
+    '1m': (60, 30),
+    '1h': (3600, 400),
+    '1d': (86400, None)
+}
+
+# Tables stored as one physical table per local day behind a UNION ALL view,
+# so retention drops whole days and range queries only touch the days they need
+PARTITIONED_TABLES = {
+    'battery_snapshots': {
+        'columns': [
+            'id INTEGER PRIMARY KEY',
+            'timestamp INTEGER NOT NULL',
+            'battery_percent REAL',
+            'battery_voltage REAL',
+            'ac_output_power REAL',
+            'dc_output_power REAL',
+            'total_output_power REAL',
+            'ac_input_power REAL',
+            'dc_input_power REAL',
+            'time_remaining_hours REAL',
+            'pack1_voltage REAL',
+            'pack2_voltage REAL',
+            'pack3_voltage REAL'
+        ],
+        # Local day of a legacy text timestamp (snapshots were stored as UTC)
+        'day_expr': "date(timestamp, 'localtime')"
+    },
+    'discharge_sessions': {
+        'columns': [
+            'id INTEGER PRIMARY KEY',
+            'timestamp INTEGER NOT NULL',
+            'battery_percent REAL',
+            'battery_voltage REAL',
+            'total_output_power REAL',
+            'discharge_rate_percent_per_hour REAL',
+            'estimated_hours_remaining REAL',
+            'estimated_days_remaining REAL',
+            'avg_power_consumption REAL',
+            "session_type TEXT DEFAULT 'discharge'"
+        ],
+        # Local day of a legacy text timestamp (discharge rows were local ISO)
+        'day_expr': 'date(timestamp)'
+    }
+}
+
+# Snapshot columns aggregated into min/max/sum and a non-NULL count per rollup bucket
+ROLLUP_FIELDS = [
+    'battery_percent', 'battery_voltage',
+    'ac_output_power', 'dc_output_power', 'total_output_power',
+    'ac_input_power', 'dc_input_power',
+    'pack1_voltage', 'pack2_voltage', 'pack3_voltage'
+]
+
+ROLLUP_FIELD_COLUMNS = '{field}_min REAL, {field}_max REAL, {field}_sum REAL, {field}_count INTEGER NOT NULL DEFAULT 0'
+
+_local = threading.local()
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+_partition_lock = threading.Lock()
+_partition_cache = {'schema_version': None, 'partitions': {}}
+
+
+def open_connection():
+    """Open a new connection configured for concurrent logger/API access
+
+    Most callers should use connection(); this is for components that need a
+    dedicated connection of their own, e.g. to watch PRAGMA data_version.
+    """
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,  # Transactions are managed explicitly
+        check_same_thread=False,  # Pooled connections move between threads
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+    except sqlite3.OperationalError as e:
+        # WAL is persistent, so another process has usually set it already
+        logger.warning(f"Could not enable WAL mode: {e}")
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+def _is_locked_error(error):
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+
+@contextmanager
+def connection():
+    """Check out a long-lived connection for the current thread
+
+    Nested use within the same thread returns the connection already held,
+    so helpers can be composed inside a single transaction.
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        yield conn
+        return
+
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = open_connection()
+
+    _local.conn = conn
+    try:
+        yield conn
+    finally:
+        _local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            _pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+
+def _begin_immediate(conn):
+    """Take the write lock up front, retrying while another writer holds it"""
+    delay = BUSY_RETRY_DELAY
+    for attempt in range(BUSY_RETRIES + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            return
+        except sqlite3.OperationalError as e:
+            if not _is_locked_error(e) or attempt == BUSY_RETRIES:
+                raise
+        logger.warning(f"Database locked, retrying in {delay:.1f}s (attempt {attempt + 1}/{BUSY_RETRIES})")
+        time.sleep(delay)
+        delay *= 2
+
+
+@contextmanager
+def transaction():
+    """Run a block of writes in one immediate transaction
+
+    Taking the write lock with BEGIN IMMEDIATE means readers in the other
+    process are never blocked and a lock upgrade can't deadlock. A nested
+    transaction() in the same thread joins the outer one.
+    """
+    with connection() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+        _begin_immediate(conn)
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+
+@contextmanager
+def read_snapshot():
+    """Run a block of reads against one consistent view of the database
+
+    A deferred transaction pins the WAL snapshot at its first read, so
+    helpers composed inside it see the same committed state even while the
+    logger keeps writing. Nothing is written; the transaction is rolled back.
+    """
+    with connection() as conn:
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute('BEGIN')
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+
+
+def enable_incremental_vacuum():
+    """Switch the database to incremental auto-vacuum so freed pages can be reclaimed
+
+    Databases created before the switch need a one-off full VACUUM.
+    """
+    with connection() as conn:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return
+        start = time.monotonic()
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('VACUUM')
+        logger.info(f"Enabled incremental auto-vacuum ({time.monotonic() - start:.1f}s)")
+
+
+def database_size():
+    """Get the on-disk size of the database plus its WAL file in bytes"""
+    size = 0
+    for path in (DB_PATH, DB_PATH + '-wal'):
+        try:
+            size += os.path.getsize(path)
+        except OSError:
+            pass
+    return size
+
+
+def restore_from_durable():
+    """Seed the RAM database from the durable copy at startup (RAM mode only)
+
+    Both processes call this before their first query. The copy only happens
+    while the RAM database has no tables, i.e. after a reboot cleared tmpfs;
+    a process restart keeps the newer RAM copy. Returns True if restored.
+    """
+    if STORAGE_MODE != 'ram':
+        return False
+    
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    with open(DB_PATH + '.restore-lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with connection() as conn:
+            if conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0]:
+                return False
+            if not os.path.exists(DURABLE_DB_PATH):
+                logger.info(f"No durable copy at {DURABLE_DB_PATH}, starting with an empty RAM database")
+                return False
+            
+            start = time.monotonic()
+            source = sqlite3.connect(DURABLE_DB_PATH)
+            try:
+                source.backup(conn)
+            finally:
+                source.close()
+        logger.info(f"Restored {DB_PATH} from {DURABLE_DB_PATH} ({time.monotonic() - start:.1f}s)")
+        return True
+
+
+def checkpoint():
+    """Copy the RAM database to DURABLE_DB_PATH with the online backup API
+
+    The backup reads one consistent snapshot without blocking writers (WAL),
+    is written to a temporary file and renamed over the durable copy, so a
+    power cut mid-checkpoint leaves the previous copy intact. Returns the
+    number of bytes written, or None outside RAM mode.
+    """
+    if STORAGE_MODE != 'ram':
+        return None
+    
+    start = time.monotonic()
+    os.makedirs(os.path.dirname(DURABLE_DB_PATH), exist_ok=True)
+    tmp_path = DURABLE_DB_PATH + '.tmp'
+    target = sqlite3.connect(tmp_path)
+    try:
+        with connection() as conn:
+            conn.backup(target)
+    finally:
+        target.close()
+    
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, DURABLE_DB_PATH)
+    dir_fd = os.open(os.path.dirname(DURABLE_DB_PATH), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    
+    size = os.path.getsize(DURABLE_DB_PATH)
+    logger.info(f"Checkpointed database to {DURABLE_DB_PATH} ({size} bytes, {time.monotonic() - start:.1f}s)")
+    return size
+
+
+class DataVersionWatcher:
+    """Tells cheaply whether the database has changed since the last check
+
+    Holds a dedicated connection and reads PRAGMA data_version, which moves
+    whenever any other connection (in any process) commits and is answered
+    from the WAL index without reading the database. Checks are throttled
+    to one per poll_interval. Not thread-safe; callers hold their own lock.
+    """
+
+    def __init__(self, poll_interval=1.0):
+        self.poll_interval = poll_interval
+        self.conn = None
+        self._checked_at = 0.0
+        self._data_version = None
+
+    def changed(self):
+        """True on the first call and whenever another connection has committed since"""
+        now = time.monotonic()
+        if self._data_version is not None and now - self._checked_at < self.poll_interval:
+            return False
+        self._checked_at = now
+        
+        if self.conn is None:
+            self.conn = open_connection()
+        data_version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        if data_version == self._data_version:
+            return False
+        self._data_version = data_version
+        return True
+
+    def reset(self):
+        """Make the next changed() call return True"""
+        self._data_version = None
+
+
+def close_all():
+    """Close every idle pooled connection (used on shutdown)"""
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+
+
+
+# Time conversion: every stored timestamp is an integer count of epoch milliseconds
+
+_JULIANDAY_TO_MS = "CAST(ROUND(({value} - 2440587.5) * 86400000) AS INTEGER)"
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def to_ms(moment):
+    """Convert a datetime (naive means local time) to epoch milliseconds"""
+    return int(moment.timestamp() * 1000)
+
+
+def from_ms(ms):
+    """Convert epoch milliseconds to a naive local datetime"""
+    return datetime.fromtimestamp(ms / 1000)
+
+
+def ms_to_iso(ms):
+    """Format epoch milliseconds as a local ISO string for API responses"""
+    return from_ms(ms).isoformat() if ms is not None else None
+
+
+# Schema migrations
+
+def _text_to_ms_expr(column):
+    """SQL converting a legacy text timestamp to epoch ms
+
+    CURRENT_TIMESTAMP wrote UTC with a space separator, isoformat() wrote
+    local time with a 'T', so the separator tells the two apart.
+    """
+    local = _JULIANDAY_TO_MS.format(value=f"julianday({column}, 'utc')")
+    utc = _JULIANDAY_TO_MS.format(value=f"julianday({column})")
+    return f"CASE WHEN instr({column}, 'T') > 0 THEN {local} ELSE {utc} END"
+
+
+def _convert_text_timestamps(table, column):
+    """Rewrite a column's text timestamps as epoch ms, one batch per transaction"""
+    total = 0
+    while True:
+        with transaction() as conn:
+            converted = conn.execute(f'''
+                UPDATE {table} SET {column} = {_text_to_ms_expr(column)}
+                WHERE rowid IN (
+                    SELECT rowid FROM {table} WHERE typeof({column}) = 'text' LIMIT {MIGRATION_BATCH_SIZE}
+                )
+            ''').rowcount
+        total += converted
+        if converted < MIGRATION_BATCH_SIZE:
+            return total
+
+
+def _migrate_epoch_timestamps():
+    """Convert every timestamp column to integer epoch milliseconds in place"""
+    with connection() as conn:
+        targets = [
+            (name, 'timestamp')
+            for table in PARTITIONED_TABLES
+            for _, name in list_partitions(conn, table)
+        ]
+    targets += [
+        ('charge_sessions', 'start_time'),
+        ('charge_sessions', 'end_time'),
+        ('section_order', 'created_at'),
+        ('section_order', 'updated_at'),
+        ('discharge_settings', 'updated_at')
+    ]
+    for table, column in targets:
+        converted = _convert_text_timestamps(table, column)
+        if converted:
+            logger.info(f"Converted {converted} {table}.{column} values to epoch ms")
+
+
+def _create_app_settings():
+    """Create the key/value table for settings that aren't discharge-specific"""
+    with transaction() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS app_settings (
+                setting_name TEXT PRIMARY KEY,
+                setting_value TEXT NOT NULL,
+                updated_at INTEGER
+            )
+        ''')
+        conn.execute('''
+            INSERT OR IGNORE INTO app_settings (setting_name, setting_value, updated_at)
+            VALUES ('settings_version', '0', ?)
+        ''', (now_ms(),))
+
+
+def _create_estimator_state():
+    """Create the table holding persisted streaming-estimator state"""
+    with transaction() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS estimator_state (
+                name TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                updated_at INTEGER
+            )
+        ''')
+
+
+def _add_charge_session_aggregates():
+    """Add the running-aggregate columns written by charge_sessions.ChargeSession"""
+    with transaction() as conn:
+        existing = {row[1] for row in conn.execute('PRAGMA table_info(charge_sessions)')}
+        for column, column_type in (
+            ('peak_input_power', 'REAL'),
+            ('energy_wh', 'REAL'),
+            ('output_energy_wh', 'REAL'),
+            ('sample_count', 'INTEGER')
+        ):
+            if column not in existing:
+                conn.execute(f'ALTER TABLE charge_sessions ADD COLUMN {column} {column_type}')
+
+
+def _create_capacity_history():
+    """Create the table of accepted capacity-estimator segments"""
+    with transaction() as conn:
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS capacity_history (
+                id INTEGER PRIMARY KEY,
+                timestamp INTEGER NOT NULL,
+                direction TEXT NOT NULL,
+                start_percent REAL,
+                end_percent REAL,
+                energy_wh REAL,
+                segment_capacity_wh REAL,
+                capacity_wh REAL,
+                confidence REAL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_capacity_history_timestamp ON capacity_history(timestamp)')
+
+
+def _add_rollup_field_counts():
+    """Add the per-field non-NULL counts that rollup averages divide by
+
+    Existing buckets can't tell which samples were NULL; a bucket whose sum
+    survived had no NULLs (a NULL made the old upsert's sum NULL), so its
+    count is the sample count.
+    """
+    with transaction() as conn:
+        for resolution in ROLLUP_RESOLUTIONS:
+            table = rollup_table(resolution)
+            existing = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+            if not existing:
+                continue  # created with the counts by create_rollup_tables
+            for field in ROLLUP_FIELDS:
+                if f'{field}_count' not in existing:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN {field}_count INTEGER NOT NULL DEFAULT 0')
+                    conn.execute(f'UPDATE {table} SET {field}_count = sample_count WHERE {field}_sum IS NOT NULL')
+
+
+# (version, description, function). A migration interrupted part-way is run
+# again at the next startup, so each one must be safe to re-run.
+MIGRATIONS = [
+    (1, 'integer epoch-ms timestamps', _migrate_epoch_timestamps),
+    (2, 'app_settings table', _create_app_settings),
+    (3, 'estimator_state table', _create_estimator_state),
+    (4, 'charge session aggregate columns', _add_charge_session_aggregates),
+    (5, 'capacity_history table', _create_capacity_history),
+    (6, 'rollup per-field counts', _add_rollup_field_counts)
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate():
+    """Apply pending migrations in order, recording each in PRAGMA user_version"""
+    with connection() as conn:
+        current = schema_version(conn)
+    
+    for version, description, func in MIGRATIONS:
+        if version <= current:
+            continue
+        logger.info(f"Applying schema migration {version}: {description}")
+        start = time.monotonic()
+        func()
+        with transaction() as conn:
+            conn.execute(f'PRAGMA user_version = {version}')
+        logger.info(f"Schema migration {version} done in {time.monotonic() - start:.1f}s")
+
+
+# Day partitions
+
+def partition_name(table, day):
+    return f"{table}_p{day.strftime('%Y%m%d')}"
+
+
+def list_partitions(conn, table):
+    """Get (day, partition table) pairs for a partitioned table, oldest first
+
+    The list is cached until PRAGMA schema_version changes, so either process
+    adding or dropping a partition is picked up without scanning sqlite_master.
+    """
+    schema_version = conn.execute('PRAGMA schema_version').fetchone()[0]
+    with _partition_lock:
+        if _partition_cache['schema_version'] != schema_version:
+            partitions = {name: [] for name in PARTITIONED_TABLES}
+            rows = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name GLOB '*_p[0-9]*'").fetchall()
+            for (name,) in rows:
+                base, _, suffix = name.rpartition('_p')
+                if base in partitions and len(suffix) == 8 and suffix.isdigit():
+                    day = datetime.strptime(suffix, '%Y%m%d').date()
+                    partitions[base].append((day, name))
+            for pairs in partitions.values():
+                pairs.sort()
+            _partition_cache['schema_version'] = schema_version
+            _partition_cache['partitions'] = partitions
+        return list(_partition_cache['partitions'][table])
+
+
+def _rebuild_partition_view(conn, table):
+    """Point the table's view at the current set of partitions"""
+    names = [name for _, name in list_partitions(conn, table)]
+    if names:
+        body = ' UNION ALL '.join(f'SELECT * FROM {name}' for name in names)
+    else:
+        columns = [column.split()[0] for column in PARTITIONED_TABLES[table]['columns']]
+        body = f"SELECT {', '.join(f'NULL AS {column}' for column in columns)} WHERE 0"
+    conn.execute(f'DROP VIEW IF EXISTS {table}')
+    conn.execute(f'CREATE VIEW {table} AS {body}')
+
+
+def _create_partition(conn, table, day):
+    name = partition_name(table, day)
+    columns = ',\n'.join(PARTITIONED_TABLES[table]['columns'])
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {name} ({columns})')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{name}_timestamp ON {name}(timestamp)')
+    return name
+
+
+def ensure_partition(conn, table, day):
+    """Create the partition for a day if it doesn't exist yet and return its name"""
+    name = partition_name(table, day)
+    if (day, name) not in list_partitions(conn, table):
+        _create_partition(conn, table, day)
+        _rebuild_partition_view(conn, table)
+        logger.info(f"Created partition {name}")
+    return name
+
+
+def drop_partitions(conn, table, before_day=None):
+    """Drop every partition older than before_day (all of them if None)"""
+    dropped = []
+    for day, name in list_partitions(conn, table):
+        if before_day is None or day < before_day:
+            conn.execute(f'DROP TABLE {name}')
+            dropped.append(name)
+    if dropped:
+        _rebuild_partition_view(conn, table)
+    return dropped
+
+
+def partition_source(conn, table, start_day, end_day=None):
+    """Get a FROM-clause source covering only the partitions in a day range
+
+    The result is a UNION ALL subquery; SQLite pushes the caller's WHERE
+    clause into each arm so every partition still uses its timestamp index.
+    """
+    names = [
+        name for day, name in list_partitions(conn, table)
+        if day >= start_day and (end_day is None or day <= end_day)
+    ]
+    if not names:
+        return f'(SELECT * FROM {table} WHERE 0)'
+    if len(names) == 1:
+        return names[0]
+    return '(' + ' UNION ALL '.join(f'SELECT * FROM {name}' for name in names) + ')'
+
+
+def latest_row(conn, table, columns):
+    """Get the newest row by timestamp, reading partitions newest first"""
+    for _, name in reversed(list_partitions(conn, table)):
+        row = conn.execute(f'SELECT {columns} FROM {name} ORDER BY timestamp DESC LIMIT 1').fetchone()
+        if row:
+            return row
+    return None
+
+
+def read_page(conn, table, columns, start_ms, limit, before=None):
+    """Rows with timestamp >= start_ms that sort before the (timestamp, id) key before, newest first
+
+    Keyset pagination on (timestamp, id), since timestamps alone aren't
+    unique: each row ends with its id, and the last row's (timestamp, id)
+    is the next page's before. Partitions are read newest first, each
+    through its timestamp index, so a page costs the same wherever it falls
+    in the range.
+    """
+    start_day = from_ms(start_ms).date()
+    end_day = from_ms(before[0]).date() if before is not None else None
+    rows = []
+    for day, name in reversed(list_partitions(conn, table)):
+        if len(rows) >= limit or day < start_day:
+            break
+        if end_day is not None and day > end_day:
+            continue
+        rows += conn.execute(f'''
+            SELECT {columns}, id FROM {name}
+            WHERE timestamp >= ? {'AND timestamp <= ? AND (timestamp < ? OR id < ?)' if before is not None else ''}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', [start_ms] + ([before[0], before[0], before[1]] if before is not None else []) + [limit - len(rows)]).fetchall()
+    return rows
+
+
+def id_at_position(conn, table, timestamp, position):
+    """Id of the row position places down (0 = highest id) among rows at timestamp, 0 if there is none
+
+    Turns a position among tied rows, the key for sources without ids,
+    into the (timestamp, id) bound read_page takes.
+    """
+    name = partition_name(table, from_ms(timestamp).date())
+    if name not in (partition for _, partition in list_partitions(conn, table)):
+        return 0
+    row = conn.execute(f'''
+        SELECT id FROM {name} WHERE timestamp = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+    ''', (timestamp, position)).fetchone()
+    return row[0] if row else 0
+
+
+def create_partitioned_tables(conn):
+    """Create partition views, splitting any legacy single table into day partitions"""
+    for table, spec in PARTITIONED_TABLES.items():
+        row = conn.execute("SELECT type FROM sqlite_master WHERE name=?", (table,)).fetchone()
+        if row and row[0] == 'table':
+            legacy = f'{table}_legacy'
+            conn.execute(f'ALTER TABLE {table} RENAME TO {legacy}')
+            days = conn.execute(f"SELECT DISTINCT {spec['day_expr']} FROM {legacy}").fetchall()
+            for (day_text,) in days:
+                if day_text is None:
+                    continue
+                name = _create_partition(conn, table, date.fromisoformat(day_text))
+                conn.execute(f"INSERT INTO {name} SELECT * FROM {legacy} WHERE {spec['day_expr']} = ?", (day_text,))
+            conn.execute(f'DROP TABLE {legacy}')
+            logger.info(f"Split {table} into {len(days)} day partitions")
+        
+        _create_partition(conn, table, date.today())
+        _rebuild_partition_view(conn, table)
+
+
+# Snapshot rollups
+
+def rollup_table(resolution):
+    return f"snapshot_rollup_{resolution}"
+
+
+def rollup_bucket(resolution, ts_ms):
+    """Get the bucket start (epoch ms) containing ts_ms; days start at local midnight"""
+    if resolution == '1d':
+        midnight = from_ms(ts_ms).replace(hour=0, minute=0, second=0, microsecond=0)
+        return to_ms(midnight)
+    bucket_ms = ROLLUP_RESOLUTIONS[resolution][0] * 1000
+    return ts_ms - ts_ms % bucket_ms
+
+
+def _build_rollup_upsert_sql(resolution):
+    columns = ['bucket_start', 'sample_count', 'output_active_count']
+    updates = [
+        'sample_count = sample_count + excluded.sample_count',
+        'output_active_count = output_active_count + excluded.output_active_count'
+    ]
+    # NULL readings leave min/max/sum alone and don't count towards the field's average
+    for field in ROLLUP_FIELDS:
+        columns += [f'{field}_min', f'{field}_max', f'{field}_sum', f'{field}_count']
+        updates += [
+            f'{field}_min = COALESCE(MIN({field}_min, excluded.{field}_min), {field}_min, excluded.{field}_min)',
+            f'{field}_max = COALESCE(MAX({field}_max, excluded.{field}_max), {field}_max, excluded.{field}_max)',
+            f'{field}_sum = COALESCE({field}_sum + excluded.{field}_sum, {field}_sum, excluded.{field}_sum)',
+            f'{field}_count = {field}_count + excluded.{field}_count'
+        ]
+    placeholders = ', '.join('?' * len(columns))
+    return (
+        f"INSERT INTO {rollup_table(resolution)} ({', '.join(columns)}) VALUES ({placeholders}) "
+        f"ON CONFLICT(bucket_start) DO UPDATE SET {', '.join(updates)}"
+    )
+
+
+ROLLUP_UPSERT_SQL = {resolution: _build_rollup_upsert_sql(resolution) for resolution in ROLLUP_RESOLUTIONS}
+
+
+def local_day_start_sql(ms_expr):
+    """SQL expression for the epoch ms of local midnight on the day of ms_expr"""
+    return _JULIANDAY_TO_MS.format(
+        value=f"julianday({ms_expr} / 1000, 'unixepoch', 'localtime', 'start of day', 'utc')"
+    )
+
+
+def create_rollup_tables(cursor):
+    """Create the rollup tables, backfilling any that are new from raw snapshots
+
+    Backfill expects epoch-ms snapshot timestamps, so call this after migrate().
+    """
+    for resolution, (bucket_seconds, _) in ROLLUP_RESOLUTIONS.items():
+        table = rollup_table(resolution)
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,))
+        if cursor.fetchone():
+            continue
+        
+        field_columns = ', '.join(ROLLUP_FIELD_COLUMNS.format(field=field) for field in ROLLUP_FIELDS)
+        cursor.execute(f'''
+            CREATE TABLE {table} (
+                bucket_start INTEGER PRIMARY KEY,
+                sample_count INTEGER NOT NULL,
+                output_active_count INTEGER NOT NULL,
+                {field_columns}
+            )
+        ''')
+        
+        if resolution == '1d':
+            bucket_expr = local_day_start_sql('timestamp')
+        else:
+            bucket_expr = f"(timestamp / {bucket_seconds * 1000}) * {bucket_seconds * 1000}"
+        aggregates = ', '.join(f'MIN({field}), MAX({field}), SUM({field}), COUNT({field})' for field in ROLLUP_FIELDS)
+        cursor.execute(f'''
+            INSERT INTO {table}
+            SELECT {bucket_expr} AS bucket, COUNT(*), COALESCE(SUM(total_output_power > 0), 0), {aggregates}
+            FROM battery_snapshots
+            GROUP BY bucket
+        ''')
+        logger.info(f"Created rollup table {table} ({cursor.rowcount} buckets backfilled)")
+
+
+def rollup_rows(ts_ms, values):
+    """Get (sql, params) upserts folding one snapshot into every rollup"""
+    params = [1, 1 if (values['total_output_power'] or 0) > 0 else 0]
+    for field in ROLLUP_FIELDS:
+        value = values[field]
+        params += [value, value, value, 0 if value is None else 1]
+    return [
+        (ROLLUP_UPSERT_SQL[resolution], (rollup_bucket(resolution, ts_ms), *params))
+        for resolution in ROLLUP_RESOLUTIONS
+    ]
+
+
+def prune_rollups(conn, now_ms):
+    """Apply each rollup's own retention and return rows deleted per table"""
+    deleted = {}
+    for resolution, (_, retention_days) in ROLLUP_RESOLUTIONS.items():
+        if retention_days is None:
+            continue
+        cutoff_ms = now_ms - retention_days * 86400000
+        cursor = conn.execute(f'DELETE FROM {rollup_table(resolution)} WHERE bucket_start < ?', (cutoff_ms,))
+        deleted[resolution] = cursor.rowcount
+    return deleted
+
+
+def choose_resolution(span_seconds, max_points):
+    """Pick the finest rollup whose bucket count over the span fits max_points
+
+    Resolutions whose retention doesn't reach back over the span are skipped,
+    and the coarsest one is the fallback.
+    """
+    for resolution, (bucket_seconds, retention_days) in ROLLUP_RESOLUTIONS.items():
+        if retention_days is not None and span_seconds > retention_days * 86400:
+            continue
+        if span_seconds / bucket_seconds <= max_points:
+            return resolution
+    return list(ROLLUP_RESOLUTIONS)[-1]
+
+
+def read_rollup_rows(conn, resolution, start_ms, limit, before=None):
+    """Raw rollup rows newest first, each ending with its rowid; before is a (bucket_start, rowid) keyset bound
+
+    bucket_start is the INTEGER PRIMARY KEY, so the rowid equals it and
+    buckets never tie; the key has the same shape as read_page's so the
+    API pages both the same way.
+    """
+    columns = ', '.join(f'{field}_sum, {field}_min, {field}_max, {field}_count' for field in ROLLUP_FIELDS)
+    return conn.execute(f'''
+        SELECT bucket_start, sample_count, {columns}, rowid
+        FROM {rollup_table(resolution)}
+        WHERE bucket_start >= ? {'AND bucket_start <= ? AND (bucket_start < ? OR rowid < ?)' if before is not None else ''}
+        ORDER BY bucket_start DESC, rowid DESC
+        LIMIT ?
+    ''', [start_ms] + ([before[0], before[0], before[1]] if before is not None else []) + [limit]).fetchall()
+
+
+def rollup_point(row):
+    """A rollup row as a dict of avg/min/max per field"""
+    count = row[1]
+    point = {
+        'timestamp': ms_to_iso(row[0]),
+        'sample_count': count
+    }
+    for index, field in enumerate(ROLLUP_FIELDS):
+        total, low, high, field_count = row[2 + index * 4:6 + index * 4]
+        point[field] = total / field_count if field_count else None
+        point[f'{field}_min'] = low
+        point[f'{field}_max'] = high
+    return point
@@ -4,14 +4,27 @@ Battery Activity Logger
 Tracks battery usage, calculates time remaining, and logs charging sessions
 """
 
-import sqlite3
 import json
 import time
 import logging
 import paho.mqtt.client as mqtt
 from datetime import datetime, timedelta
 import os
+import sys
+import signal
 import threading
+from collections import deque
+import battery_db
+import battery_settings
+import telemetry_ring
+import snapshot_archive
+from discharge_estimator import DischargeEstimator, ESTIMATOR_SAVE_SQL, ESTIMATOR_WINDOWS
+from capacity_estimator import CapacityEstimator, CAPACITY_SAVE_SQL, CAPACITY_HISTORY_INSERT_SQL
+from discharge_analysis import DischargeAnalysisEngine, DISCHARGE_INSERT_SQL, discharge_row, format_duration
+from energy_ledger import EnergyLedger, create_energy_tables, prune_energy
+from quantile_sketch import HourlySketches, create_sketch_table, prune_sketches
+from load_forecast import LoadProfile, LOAD_PROFILE_SAVE_SQL
+from charge_sessions import ChargeSessionTracker, CHARGE_KEYS, CHARGE_SESSION_INSERT_SQL
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,22 +33,353 @@ logger = logging.getLogger(__name__)
 # Configuration
 MQTT_BROKER_HOST = "127.0.0.1"
 MQTT_BROKER_PORT = 1883
-DB_PATH = "/home/pi/bluetti-monitor/battery_activity.db"
-TOTAL_CAPACITY_WH = 6144  # AC200MAX (2048) + 2x B230 (2048 each)
-SNAPSHOT_INTERVAL = 30  # seconds
+DB_PATH = battery_db.DB_PATH
+SNAPSHOT_INTERVAL = battery_db.SNAPSHOT_INTERVAL  # seconds
 CLEANUP_DAYS = 7
 
+# Retention per table in days, enforced continuously by RetentionService
+RETENTION_DAYS = {
+    'battery_snapshots': CLEANUP_DAYS,
+    'charge_sessions': CLEANUP_DAYS,
+    'discharge_sessions': CLEANUP_DAYS
+}
+ARCHIVED_TABLES = ('battery_snapshots',)  # day partitions copied to snapshot_archive before they are dropped
+RETENTION_INTERVAL = 900  # seconds between retention passes
+RETENTION_BATCH_SIZE = 500  # rows deleted per transaction
+RETENTION_BATCH_PAUSE = 0.05  # seconds between batches so other writers get the lock
+VACUUM_PAGES_PER_STEP = 256  # pages reclaimed per incremental_vacuum transaction
+VACUUM_TIME_BUDGET = 2.0  # seconds of vacuuming per pass at most
+FLUSH_BATCH_SIZE = 100  # queued rows (snapshots plus rollup upserts) that trigger an early flush
+FLUSH_INTERVAL = 60  # seconds between group commits
+MAX_PENDING_ROWS = 10000  # oldest whole row groups are dropped beyond this if the DB stays unwritable
+
+# Logger health figures, rewritten with every flush so the API process can report them
+LOGGER_STATUS_SAVE_SQL = '''
+    INSERT OR REPLACE INTO estimator_state (name, state, updated_at)
+    VALUES ('logger_status', ?, ?)
+'''
+
+# {table} is filled in with the day partition the row belongs to
+SNAPSHOT_INSERT_SQL = '''
+    INSERT INTO {table} 
+    (timestamp, battery_percent, battery_voltage, ac_output_power, dc_output_power, 
+     total_output_power, ac_input_power, dc_input_power, time_remaining_hours,
+     pack1_voltage, pack2_voltage, pack3_voltage)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+class WriteBehindBuffer:
+    """Queues rows and writes them with executemany in a single transaction
+
+    A flush happens every FLUSH_INTERVAL seconds, or sooner once
+    FLUSH_BATCH_SIZE rows are waiting, so one fsync covers many rows.
+    Rows are queued in groups that are kept or dropped together, such as a
+    snapshot and the rollup, sketch and estimator rows derived from it.
+    If status is given, its result is saved as the 'logger_status' row in
+    the same transaction. save_rows, if given, returns (sql, params) rows of
+    state that is saved once per flush rather than queued with every change.
+    """
+
+    def __init__(self, batch_size=FLUSH_BATCH_SIZE, interval=FLUSH_INTERVAL, status=None, save_rows=None):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.status = status
+        self.save_rows = save_rows
+        self._pending = deque()
+        self._pending_rows = 0
+        self._dropped_groups = 0
+        self._dropped_rows = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flush_count = 0
+        self._rows_flushed = 0
+        self._total_flush_ms = 0.0
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+        self._last_batch_rows = 0
+        self._last_flush_at = time.monotonic()
+
+    def add(self, sql, params, partition=None):
+        """Queue a row on its own for the next flush"""
+        self.add_group([(sql, params, partition)])
+
+    def add_group(self, rows):
+        """Queue (sql, params, partition) rows to be written or dropped together
+
+        partition is an optional (table, day) pair whose day partition must
+        exist before the row is inserted. Beyond MAX_PENDING_ROWS the oldest
+        groups are dropped whole and counted in stats().
+        """
+        if not rows:
+            return
+        with self._lock:
+            self._pending.append(rows)
+            self._pending_rows += len(rows)
+            while self._pending_rows > MAX_PENDING_ROWS and len(self._pending) > 1:
+                dropped = self._pending.popleft()
+                self._pending_rows -= len(dropped)
+                self._dropped_groups += 1
+                self._dropped_rows += len(dropped)
+            depth = self._pending_rows
+        
+        if depth >= self.batch_size:
+            self._wakeup.set()
+
+    def flush(self):
+        """Write every queued row in one transaction and return the row count"""
+        with self._flush_lock:
+            with self._lock:
+                groups, self._pending = self._pending, deque()
+                self._pending_rows = 0
+            if self.save_rows is not None:
+                groups.append([(sql, params, None) for sql, params in self.save_rows()])
+            self._last_flush_at = time.monotonic()
+            batch = [row for group in groups for row in group]
+            if not batch:
+                return 0
+            
+            # Group rows per statement so each table is a single executemany
+            grouped = {}
+            partitions = set()
+            for sql, params, partition in batch:
+                grouped.setdefault(sql, []).append(params)
+                if partition:
+                    partitions.add(partition)
+            
+            start = time.monotonic()
+            self._last_batch_rows = len(batch)
+            try:
+                with battery_db.transaction() as conn:
+                    for table, day in sorted(partitions):
+                        battery_db.ensure_partition(conn, table, day)
+                    for sql, rows in grouped.items():
+                        conn.executemany(sql, rows)
+                    if self.status is not None:
+                        conn.execute(LOGGER_STATUS_SAVE_SQL, (json.dumps(self.status()), battery_db.now_ms()))
+            except Exception:
+                # Put the batch back in front of anything queued meanwhile
+                with self._lock:
+                    self._pending.extendleft(reversed(groups))
+                    self._pending_rows += len(batch)
+                raise
+            
+            elapsed_ms = (time.monotonic() - start) * 1000
+            self._flush_count += 1
+            self._rows_flushed += len(batch)
+            self._total_flush_ms += elapsed_ms
+            self._last_flush_ms = elapsed_ms
+            self._max_flush_ms = max(self._max_flush_ms, elapsed_ms)
+            logger.debug(f"Flushed {len(batch)} rows in {elapsed_ms:.1f}ms")
+            return len(batch)
+
+    def start(self):
+        """Start the background flush thread"""
+        def flush_worker():
+            while True:
+                self._wakeup.wait(self.interval)
+                self._wakeup.clear()
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"Error flushing write buffer: {e}")
+        
+        thread = threading.Thread(target=flush_worker, daemon=True)
+        thread.start()
+        logger.info(f"Write buffer started (flush every {self.interval}s or {self.batch_size} rows)")
+
+    def seconds_until_flush(self):
+        """Get the time left before the next scheduled flush"""
+        return max(0.0, self.interval - (time.monotonic() - self._last_flush_at))
+
+    def stats(self):
+        """Get queue depth and flush latency figures"""
+        with self._lock:
+            depth = self._pending_rows
+        return {
+            'queue_depth': depth,
+            'dropped_groups': self._dropped_groups,
+            'dropped_rows': self._dropped_rows,
+            'flush_count': self._flush_count,
+            'rows_flushed': self._rows_flushed,
+            'last_batch_rows': self._last_batch_rows,
+            'last_flush_ms': round(self._last_flush_ms, 2),
+            'avg_flush_ms': round(self._total_flush_ms / self._flush_count, 2) if self._flush_count else 0,
+            'max_flush_ms': round(self._max_flush_ms, 2)
+        }
+
+class RetentionService:
+    """Expires old rows in small batches and reclaims free pages when idle
+
+    Day partitions past their retention are dropped outright; rows older
+    than the cutoff inside the oldest remaining partition, and in unpartitioned
+    tables, are deleted RETENTION_BATCH_SIZE at a time so no transaction holds
+    the write lock for long.
+    """
+
+    def __init__(self, write_buffer, retention_days=None, interval=RETENTION_INTERVAL):
+        self.write_buffer = write_buffer
+        self.retention_days = retention_days or RETENTION_DAYS
+        self.interval = interval
+        self.last_report = {}
+
+    def _delete_in_batches(self, table, condition, params):
+        total = 0
+        while True:
+            with battery_db.transaction() as conn:
+                deleted = conn.execute(f'''
+                    DELETE FROM {table} WHERE rowid IN (
+                        SELECT rowid FROM {table} WHERE {condition} LIMIT {RETENTION_BATCH_SIZE}
+                    )
+                ''', params).rowcount
+            total += deleted
+            if deleted < RETENTION_BATCH_SIZE:
+                return total
+            time.sleep(RETENTION_BATCH_PAUSE)
+
+    def _expire_table(self, table, cutoff):
+        """Apply retention to one table and return (partitions dropped, rows deleted)"""
+        spec = battery_db.PARTITIONED_TABLES.get(table)
+        cutoff_ms = battery_db.to_ms(cutoff)
+        if spec is None:
+            return 0, self._delete_in_batches(table, 'start_time < ?', (cutoff_ms,))
+        
+        if table in ARCHIVED_TABLES:
+            # The archive write happens before the drop; if it fails, keep the days for the next pass
+            try:
+                with battery_db.connection() as conn:
+                    for day, partition in battery_db.list_partitions(conn, table):
+                        if day < cutoff.date():
+                            snapshot_archive.archive_partition(conn, partition, day)
+            except Exception as e:
+                logger.error(f"Error archiving {table}, keeping expired partitions: {e}")
+                return 0, 0
+        
+        with battery_db.transaction() as conn:
+            dropped = battery_db.drop_partitions(conn, table, cutoff.date())
+            partitions = battery_db.list_partitions(conn, table)
+        
+        # Trim the part of the boundary day that has already expired; archived
+        # tables keep it until the whole day is archived and dropped
+        rows_deleted = 0
+        if partitions and partitions[0][0] == cutoff.date() and table not in ARCHIVED_TABLES:
+            rows_deleted = self._delete_in_batches(partitions[0][1], 'timestamp < ?', (cutoff_ms,))
+        return len(dropped), rows_deleted
+
+    def _vacuum_when_idle(self):
+        """Reclaim free pages in small steps, only while no flush is due"""
+        pages = 0
+        deadline = time.monotonic() + VACUUM_TIME_BUDGET
+        while time.monotonic() < deadline:
+            if self.write_buffer.seconds_until_flush() < VACUUM_TIME_BUDGET:
+                break
+            with battery_db.transaction() as conn:
+                free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if free_pages == 0:
+                    break
+                step = min(free_pages, VACUUM_PAGES_PER_STEP)
+                conn.execute(f'PRAGMA incremental_vacuum({step})').fetchall()
+            pages += step
+        return pages
+
+    def run_once(self):
+        """Run one retention pass and return its report"""
+        start = time.monotonic()
+        now = datetime.now()
+        report = {'partitions_dropped': {}, 'rows_deleted': {}}
+        
+        for table, days in self.retention_days.items():
+            dropped, deleted = self._expire_table(table, now - timedelta(days=days))
+            report['partitions_dropped'][table] = dropped
+            report['rows_deleted'][table] = deleted
+        
+        # Each rollup resolution, energy ledger table and the sketches have their own retention
+        with battery_db.transaction() as conn:
+            report['rollup_buckets_deleted'] = battery_db.prune_rollups(conn, battery_db.now_ms())
+            report['energy_periods_deleted'] = prune_energy(conn, battery_db.now_ms())
+            report['sketch_rows_deleted'] = prune_sketches(conn, battery_db.now_ms())
+        
+        report['pages_vacuumed'] = self._vacuum_when_idle()
+        report['duration_ms'] = round((time.monotonic() - start) * 1000, 1)
+        report['db_size_bytes'] = battery_db.database_size()
+        self.last_report = report
+        logger.info(f"Retention pass: {report}")
+        return report
+
+    def start(self):
+        """Start the periodic retention thread (first pass runs immediately)"""
+        def retention_worker():
+            while True:
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.error(f"Error during retention pass: {e}")
+                time.sleep(self.interval)
+        
+        thread = threading.Thread(target=retention_worker, daemon=True)
+        thread.start()
+        logger.info(f"Retention service started (every {self.interval}s)")
+
+class CheckpointService:
+    """Copies the RAM database to the SD card periodically (RAM storage mode)
+
+    Queued rows are flushed first so each checkpoint includes everything
+    logged so far; a power cut loses at most battery_db.CHECKPOINT_INTERVAL
+    seconds of data.
+    """
+
+    def __init__(self, write_buffer, interval=battery_db.CHECKPOINT_INTERVAL):
+        self.write_buffer = write_buffer
+        self.interval = interval
+        self.last_checkpoint = None
+
+    def run_once(self):
+        self.write_buffer.flush()
+        size = battery_db.checkpoint()
+        self.last_checkpoint = {'timestamp': datetime.now().isoformat(), 'bytes': size}
+        return size
+
+    def start(self):
+        """Start the periodic checkpoint thread (nothing to do in disk mode)"""
+        if battery_db.STORAGE_MODE != 'ram':
+            return
+        
+        def checkpoint_worker():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.error(f"Error checkpointing database: {e}")
+        
+        thread = threading.Thread(target=checkpoint_worker, daemon=True)
+        thread.start()
+        logger.info(f"Checkpoint service started (every {self.interval}s to {battery_db.DURABLE_DB_PATH})")
+
 class BatteryLogger:
     def __init__(self):
         self.client = mqtt.Client()
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
         self.latest_data = {}
-        self.current_charge_session = None
-        self.db_lock = threading.Lock()
+        self.charge_sessions = ChargeSessionTracker()
+        self.charge_lock = threading.Lock()
+        self.last_discharge_time = None
+        self.sketches = HourlySketches()
+        self.write_buffer = WriteBehindBuffer(status=self.status, save_rows=self.sketches.save_rows)
+        self.retention = RetentionService(self.write_buffer)
+        self.checkpoints = CheckpointService(self.write_buffer)
+        self.settings = battery_settings.SettingsCache()
+        self.ring = self._open_ring()
+        self.estimator = DischargeEstimator()
+        self.capacity = CapacityEstimator()
+        self.profile = LoadProfile()
+        self.analysis = DischargeAnalysisEngine()
+        self.energy = EnergyLedger()
         
         # Initialize database
         self._init_database()
+        self.write_buffer.start()
         
         # Connect to MQTT
         self.client.connect(MQTT_BROKER_HOST, MQTT_BROKER_PORT, 60)
@@ -47,42 +391,46 @@ class BatteryLogger:
         # Start hourly discharge logging timer
         self._start_hourly_timer()
         
-        # Cleanup old data on startup
-        self._cleanup_old_data()
+        # Expire old data now and periodically from then on
+        self.retention.start()
+        self.checkpoints.start()
+
+    def status(self):
+        """Health figures saved with each flush for /api/system/status"""
+        return {
+            'write_buffer': self.write_buffer.stats(),
+            'retention': self.retention.last_report,
+            'storage_mode': battery_db.STORAGE_MODE,
+            'checkpoint': self.checkpoints.last_checkpoint
+        }
+
+    def _open_ring(self):
+        """Open the shared telemetry ring; logging carries on without it"""
+        try:
+            return telemetry_ring.TelemetryRingWriter()
+        except Exception as e:
+            logger.error(f"Error opening telemetry ring: {e}")
+            return None
 
     def _init_database(self):
         """Initialize SQLite database with required tables"""
         try:
             os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+            battery_db.restore_from_durable()
+            battery_db.enable_incremental_vacuum()
             
-            with sqlite3.connect(DB_PATH) as conn:
+            with battery_db.transaction() as conn:
                 cursor = conn.cursor()
                 
-                # Battery snapshots table
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS battery_snapshots (
-                        id INTEGER PRIMARY KEY,
-                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        battery_percent REAL,
-                        battery_voltage REAL,
-                        ac_output_power REAL,
-                        dc_output_power REAL,
-                        total_output_power REAL,
-                        ac_input_power REAL,
-                        dc_input_power REAL,
-                        time_remaining_hours REAL,
-                        pack1_voltage REAL,
-                        pack2_voltage REAL,
-                        pack3_voltage REAL
-                    )
-                ''')
+                # Battery snapshots and discharge sessions, partitioned by day
+                battery_db.create_partitioned_tables(conn)
                 
                 # Charging sessions table
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS charge_sessions (
                         id INTEGER PRIMARY KEY,
-                        start_time DATETIME,
-                        end_time DATETIME,
+                        start_time INTEGER,
+                        end_time INTEGER,
                         start_percent REAL,
                         end_percent REAL,
                         duration_minutes INTEGER,
@@ -91,21 +439,19 @@ class BatteryLogger:
                     )
                 ''')
                 
-                # Discharge sessions table (hourly tracking)
+                # Discharge logging settings table
                 cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS discharge_sessions (
+                    CREATE TABLE IF NOT EXISTS discharge_settings (
                         id INTEGER PRIMARY KEY,
-                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        battery_percent REAL,
-                        battery_voltage REAL,
-                        total_output_power REAL,
-                        discharge_rate_percent_per_hour REAL,
-                        estimated_hours_remaining REAL,
-                        estimated_days_remaining REAL,
-                        avg_power_consumption REAL,
-                        session_type TEXT DEFAULT 'discharge'
+                        setting_name TEXT UNIQUE NOT NULL,
+                        setting_value TEXT NOT NULL,
+                        updated_at INTEGER
                     )
                 ''')
+                cursor.execute('''
+                    INSERT OR IGNORE INTO discharge_settings (setting_name, setting_value, updated_at)
+                    VALUES ('interval_minutes', ?, ?)
+                ''', (str(battery_settings.DEFAULT_DISCHARGE_INTERVAL), battery_db.now_ms()))
                 
                 # Dashboard section order preferences table
                 cursor.execute('''
@@ -114,33 +460,63 @@ class BatteryLogger:
                         section_name TEXT UNIQUE NOT NULL,
                         display_order INTEGER NOT NULL,
                         is_visible BOOLEAN DEFAULT 1,
-                        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                        created_at INTEGER,
+                        updated_at INTEGER
                     )
                 ''')
                 
                 # Insert default section order if not exists
                 cursor.execute('SELECT COUNT(*) FROM section_order')
                 if cursor.fetchone()[0] == 0:
+                    now = battery_db.now_ms()
                     default_sections = [
-                        ('battery_status', 1, 1),
-                        ('power_flow', 2, 1),
-                        ('activity_log', 3, 1),
-                        ('discharge_analysis', 4, 1),
-                        ('raw_data', 5, 1)
+                        (name, order, visible, now, now)
+                        for name, order, visible in battery_settings.DEFAULT_SECTIONS
                     ]
                     cursor.executemany('''
-                        INSERT INTO section_order (section_name, display_order, is_visible)
-                        VALUES (?, ?, ?)
+                        INSERT INTO section_order (section_name, display_order, is_visible, created_at, updated_at)
+                        VALUES (?, ?, ?, ?, ?)
                     ''', default_sections)
                 
                 # Create indexes for better performance
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_snapshots_timestamp ON battery_snapshots(timestamp)')
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_start_time ON charge_sessions(start_time)')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_discharge_timestamp ON discharge_sessions(timestamp)')
-                
-                conn.commit()
-                logger.info("Database initialized successfully")
+            
+            # Bring older databases up to the current schema version
+            battery_db.migrate()
+            
+            # Carry the discharge estimate across restarts, seeding a new one from recent snapshots
+            with battery_db.connection() as conn:
+                self.estimator = DischargeEstimator.load(conn)
+                if self.estimator.last_ts is None:
+                    since = datetime.now() - timedelta(hours=max(ESTIMATOR_WINDOWS.values()))
+                    source = battery_db.partition_source(conn, 'battery_snapshots', since.date())
+                    for row in conn.execute(f'''
+                        SELECT timestamp, battery_percent, total_output_power, ac_input_power + dc_input_power
+                        FROM {source}
+                        WHERE timestamp >= ?
+                        ORDER BY timestamp
+                    ''', (battery_db.to_ms(since),)):
+                        self.estimator.update(row[0], row[1], row[2] or 0.0, (row[3] or 0) > 0)
+                # Capacity evidence only ever comes from new segments
+                self.capacity = CapacityEstimator.load(conn)
+            
+            with battery_db.transaction() as conn:
+                # 1-minute, 1-hour and 1-day snapshot aggregates
+                battery_db.create_rollup_tables(conn.cursor())
+                # Hourly and daily Wh in/out
+                create_energy_tables(conn.cursor())
+                # Hourly quantile sketches, picking up the current hour after a restart
+                create_sketch_table(conn.cursor())
+                self.sketches.load(conn, battery_db.now_ms())
+                # Weekday/hour load profile, catching up on hours missed while stopped
+                self.profile = LoadProfile.load(conn)
+                folded = self.profile.update(conn, battery_db.now_ms())
+                conn.execute(LOAD_PROFILE_SAVE_SQL, self.profile.save_params())
+                if folded:
+                    logger.info(f"Load profile updated from {folded} hourly buckets")
+            self.analysis.publish(self.estimator, self.capacity, self.profile)
+            
+            logger.info("Database initialized successfully")
                 
         except Exception as e:
             logger.error(f"Error initializing database: {e}")
@@ -161,89 +537,50 @@ class BatteryLogger:
                 except json.JSONDecodeError:
                     value = msg.payload.decode()
                 
+                previous = self.latest_data.get(key)
                 self.latest_data[key] = value
                 
-                # Check for charging state changes
-                self._check_charging_state()
+                # Only readings that can start or end a session need re-evaluating
+                if key in CHARGE_KEYS and value != previous:
+                    self._check_charging_state()
                 
         except Exception as e:
             logger.error(f"Error processing MQTT message: {e}")
 
     def _check_charging_state(self):
-        """Check if charging state has changed and update session tracking"""
+        """Feed the current readings to the charge session tracker"""
         try:
             ac_input = float(self.latest_data.get('ac_input_power', 0))
             dc_input = float(self.latest_data.get('dc_input_power', 0))
             battery_percent = float(self.latest_data.get('total_battery_percent', 0))
+            output_power = float(self.latest_data.get('ac_output_power', 0)) + float(self.latest_data.get('dc_output_power', 0))
             
-            # Only consider it charging if input power is significant (>10W) or battery is actually gaining charge
-            is_charging = (ac_input > 10 or dc_input > 10) and battery_percent < 99.5
-            is_full = battery_percent >= 99.5
-            
-            # Start new charging session
-            if is_charging and not self.current_charge_session and not is_full:
-                self.current_charge_session = {
-                    'start_time': datetime.now(),
-                    'start_percent': battery_percent,
-                    'charge_type': 'AC' if ac_input > dc_input else 'DC',
-                    'input_powers': [max(ac_input, dc_input)],
-                    'last_charge_time': datetime.now()
-                }
-                logger.info(f"Started charging session at {battery_percent}%")
-            
-            # Update current session
-            elif self.current_charge_session and is_charging:
-                self.current_charge_session['input_powers'].append(max(ac_input, dc_input))
-                self.current_charge_session['last_charge_time'] = datetime.now()
-            
-            # End charging session if not charging for more than 2 minutes or battery is full
-            elif self.current_charge_session:
-                time_since_last_charge = (datetime.now() - self.current_charge_session['last_charge_time']).total_seconds()
-                if not is_charging and time_since_last_charge > 120:  # 2 minutes
-                    self._end_charge_session(battery_percent)
-                elif is_full:
-                    self._end_charge_session(battery_percent)
+            with self.charge_lock:
+                session = self.charge_sessions.update(battery_db.now_ms(), ac_input, dc_input, battery_percent, output_power)
+            if session:
+                self._save_charge_session(session)
                 
         except (ValueError, TypeError) as e:
             logger.warning(f"Error checking charging state: {e}")
 
     def _end_charge_session(self, end_percent):
-        """End current charging session and save to database"""
-        if not self.current_charge_session:
-            return
-            
+        """End the current charging session, e.g. on shutdown"""
+        with self.charge_lock:
+            session = self.charge_sessions.finish(battery_db.now_ms(), end_percent)
+        if session:
+            self._save_charge_session(session)
+
+    def _save_charge_session(self, session):
+        """Queue a finished session unless it was too short to matter"""
         try:
-            session = self.current_charge_session
-            end_time = datetime.now()
-            duration = (end_time - session['start_time']).total_seconds() / 60  # minutes
-            avg_power = sum(session['input_powers']) / len(session['input_powers']) if session['input_powers'] else 0
+            summary = f"{session.start_percent}% → {session.end_percent}% ({session.duration_minutes():.1f}min)"
             
             # Only save sessions that lasted at least 5 minutes or had significant charge gain
-            percent_gained = end_percent - session['start_percent']
-            if duration >= 5 or percent_gained >= 1.0:
-                with self.db_lock:
-                    with sqlite3.connect(DB_PATH) as conn:
-                        cursor = conn.cursor()
-                        cursor.execute('''
-                            INSERT INTO charge_sessions 
-                            (start_time, end_time, start_percent, end_percent, duration_minutes, charge_type, avg_input_power)
-                            VALUES (?, ?, ?, ?, ?, ?, ?)
-                        ''', (
-                            session['start_time'].isoformat(),
-                            end_time.isoformat(),
-                            session['start_percent'],
-                            end_percent,
-                            int(duration),
-                            session['charge_type'],
-                            avg_power
-                        ))
-                        conn.commit()
-                
-                logger.info(f"Ended charging session: {session['start_percent']}% → {end_percent}% ({duration:.1f}min)")
+            if session.worth_saving():
+                self.write_buffer.add(CHARGE_SESSION_INSERT_SQL, session.insert_params())
+                logger.info(f"Ended {session.charge_type} charging session: {summary}, {session.energy_wh:.0f}Wh, peak {session.peak_input_power:.0f}W")
             else:
-                logger.info(f"Ignored short charging session: {session['start_percent']}% → {end_percent}% ({duration:.1f}min)")
-            
-            self.current_charge_session = None
+                logger.info(f"Ignored short charging session: {summary}")
             
         except Exception as e:
             logger.error(f"Error ending charge session: {e}")
@@ -284,118 +621,45 @@ class BatteryLogger:
     def _check_and_log_discharge(self):
         """Check if we need to log discharge data based on selected interval"""
         try:
-            # Get fresh data from API server instead of relying on MQTT
-            self._fetch_latest_data_from_api()
-            
             if not self.latest_data:
-                logger.warning("No data available from API server")
+                logger.warning("No MQTT data received yet")
                 return
             
             # Get the selected interval from the database (default to 10 minutes)
             interval_minutes = self._get_discharge_interval()
             
-            # Check if we need to log based on the last logged time
-            with self.db_lock:
-                with sqlite3.connect(DB_PATH) as conn:
-                    cursor = conn.cursor()
-                    
-                    # Get the most recent discharge session
-                    cursor.execute('''
-                        SELECT timestamp FROM discharge_sessions 
-                        ORDER BY timestamp DESC 
-                        LIMIT 1
-                    ''')
-                    last_session = cursor.fetchone()
-                    
-                    current_time = datetime.now()
-                    should_log = False
-                    
-                    if last_session:
-                        last_time = datetime.fromisoformat(last_session[0])
-                        time_diff = (current_time - last_time).total_seconds() / 60  # minutes
-                        
-                        # Log if enough time has passed
-                        if time_diff >= interval_minutes:
-                            should_log = True
-                            logger.info(f"Time to log discharge: {time_diff:.1f} minutes since last log (interval: {interval_minutes} min)")
-                    else:
-                        # No previous logs, log immediately
-                        should_log = True
-                        logger.info("No previous discharge logs found, logging immediately")
-                    
-                    if should_log:
-                        self._log_hourly_discharge()
+            # Queued rows aren't visible in the database yet, so the last logged
+            # time is tracked in memory after the first lookup
+            if self.last_discharge_time is None:
+                with battery_db.connection() as conn:
+                    last_session = battery_db.latest_row(conn, 'discharge_sessions', 'timestamp')
+                if last_session:
+                    self.last_discharge_time = battery_db.from_ms(last_session[0])
+            
+            current_time = datetime.now()
+            should_log = False
+            
+            if self.last_discharge_time:
+                time_diff = (current_time - self.last_discharge_time).total_seconds() / 60  # minutes
+                
+                # Log if enough time has passed
+                if time_diff >= interval_minutes:
+                    should_log = True
+                    logger.info(f"Time to log discharge: {time_diff:.1f} minutes since last log (interval: {interval_minutes} min)")
+            else:
+                # No previous logs, log immediately
+                should_log = True
+                logger.info("No previous discharge logs found, logging immediately")
+            
+            if should_log:
+                self._log_hourly_discharge()
                         
         except Exception as e:
             logger.error(f"Error checking discharge logging: {e}")
 
-    def _fetch_latest_data_from_api(self):
-        """Fetch latest data from API server with retry"""
-        import requests
-        import time
-        
-        for attempt in range(3):  # Try 3 times
-            try:
-                response = requests.get('http://localhost:8083/api/bluetti', timeout=5)
-                if response.status_code == 200:
-                    self.latest_data = response.json()
-                    logger.debug(f"Fetched data from API: {len(self.latest_data)} fields")
-                    return
-                else:
-                    logger.warning(f"API server returned status {response.status_code}")
-            except Exception as e:
-                if attempt < 2:  # Don't log error on last attempt
-                    logger.debug(f"API connection attempt {attempt + 1} failed: {e}")
-                    time.sleep(2)  # Wait 2 seconds before retry
-                else:
-                    logger.error(f"Error fetching data from API after 3 attempts: {e}")
-
     def _get_discharge_interval(self):
-        """Get the selected discharge logging interval from database"""
-        try:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.cursor()
-                
-                # Check if we have a settings table for discharge interval
-                cursor.execute('''
-                    SELECT name FROM sqlite_master 
-                    WHERE type='table' AND name='discharge_settings'
-                ''')
-                
-                if not cursor.fetchone():
-                    # Create settings table if it doesn't exist
-                    cursor.execute('''
-                        CREATE TABLE discharge_settings (
-                            id INTEGER PRIMARY KEY,
-                            setting_name TEXT UNIQUE NOT NULL,
-                            setting_value TEXT NOT NULL,
-                            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                        )
-                    ''')
-                    
-                    # Insert default interval (10 minutes)
-                    cursor.execute('''
-                        INSERT INTO discharge_settings (setting_name, setting_value)
-                        VALUES ('interval_minutes', '10')
-                    ''')
-                    conn.commit()
-                    return 10
-                
-                # Get the current interval setting
-                cursor.execute('''
-                    SELECT setting_value FROM discharge_settings 
-                    WHERE setting_name = 'interval_minutes'
-                ''')
-                
-                result = cursor.fetchone()
-                if result:
-                    return int(result[0])
-                else:
-                    return 10  # Default to 10 minutes
-                    
-        except Exception as e:
-            logger.error(f"Error getting discharge interval: {e}")
-            return 10  # Default to 10 minutes
+        """Get the selected discharge logging interval from the settings cache"""
+        return self.settings.discharge_interval()
 
     def _take_snapshot(self):
         """Take a snapshot of current battery state"""
@@ -413,8 +677,8 @@ class BatteryLogger:
             
             total_output = ac_output + dc_output
             
-            # Calculate time remaining
-            remaining_wh = (battery_percent / 100) * TOTAL_CAPACITY_WH
+            # Calculate time remaining from the estimated effective capacity
+            remaining_wh = (battery_percent / 100) * self.capacity.capacity_wh
             time_remaining_hours = remaining_wh / total_output if total_output > 0 else float('inf')
             
             # Get pack voltages
@@ -422,58 +686,76 @@ class BatteryLogger:
             pack2_voltage = float(self.latest_data.get('pack2_voltage', 0))
             pack3_voltage = float(self.latest_data.get('pack3_voltage', 0))
             
-            # Save to database
-            with self.db_lock:
-                with sqlite3.connect(DB_PATH) as conn:
-                    cursor = conn.cursor()
-                    cursor.execute('''
-                        INSERT INTO battery_snapshots 
-                        (battery_percent, battery_voltage, ac_output_power, dc_output_power, 
-                         total_output_power, ac_input_power, dc_input_power, time_remaining_hours,
-                         pack1_voltage, pack2_voltage, pack3_voltage)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        battery_percent, battery_voltage, ac_output, dc_output,
-                        total_output, ac_input, dc_input, time_remaining_hours,
-                        pack1_voltage, pack2_voltage, pack3_voltage
-                    ))
-                    conn.commit()
-            
-            logger.debug(f"Snapshot saved: {battery_percent}%, {time_remaining_hours:.1f}h remaining")
+            # Queue for the next group commit in today's partition, with every row derived
+            # from this snapshot in one group so back-pressure drops them together
+            now_ms = battery_db.now_ms()
+            day = battery_db.from_ms(now_ms).date()
+            partition = battery_db.partition_name('battery_snapshots', day)
+            rows = [(SNAPSHOT_INSERT_SQL.format(table=partition), (
+                now_ms,
+                battery_percent, battery_voltage, ac_output, dc_output,
+                total_output, ac_input, dc_input, time_remaining_hours,
+                pack1_voltage, pack2_voltage, pack3_voltage
+            ), ('battery_snapshots', day))]
+            
+            # Fold the same values into the rollups in the same group commit
+            rollup_values = {
+                'battery_percent': battery_percent,
+                'battery_voltage': battery_voltage,
+                'ac_output_power': ac_output,
+                'dc_output_power': dc_output,
+                'total_output_power': total_output,
+                'ac_input_power': ac_input,
+                'dc_input_power': dc_input,
+                'pack1_voltage': pack1_voltage,
+                'pack2_voltage': pack2_voltage,
+                'pack3_voltage': pack3_voltage
+            }
+            rows += [(sql, params, None) for sql, params in battery_db.rollup_rows(now_ms, rollup_values)]
+            # The sketches are saved per flush; this only returns rows when an hour finishes
+            rows += [(sql, params, None) for sql, params in self.sketches.add(now_ms, rollup_values)]
+            
+            # Update the running discharge estimate and persist it with the same commit
+            self.estimator.update(now_ms, battery_percent, total_output, ac_input > 0 or dc_input > 0)
+            rows.append((ESTIMATOR_SAVE_SQL, self.estimator.save_params(), None))
+            
+            # Learn the effective capacity from the energy moved per percent
+            capacity_row = self.capacity.update(now_ms, battery_percent, ac_input + dc_input, total_output)
+            if capacity_row:
+                rows.append((CAPACITY_HISTORY_INSERT_SQL, capacity_row, None))
+            rows.append((CAPACITY_SAVE_SQL, self.capacity.save_params(), None))
+            
+            # Fold the last completed hour into the load profile once it has been committed
+            if self.profile.due(now_ms):
+                with battery_db.connection() as conn:
+                    self.profile.update(conn, now_ms)
+                rows.append((LOAD_PROFILE_SAVE_SQL, self.profile.save_params(), None))
+            self.analysis.publish(self.estimator, self.capacity, self.profile)
+            
+            # Integrate power since the previous snapshot into the energy ledger
+            rows += [(sql, params, None) for sql, params in self.energy.add_sample(now_ms, {
+                'ac_input_power': ac_input,
+                'dc_input_power': dc_input,
+                'ac_output_power': ac_output,
+                'dc_output_power': dc_output
+            })]
+            self.write_buffer.add_group(rows)
+            
+            # Re-check the charge session so the end-of-charge grace period expires without new readings
+            self._check_charging_state()
+            
+            # Publish to the API server straight away, ahead of the group commit
+            if self.ring:
+                rollup_values['time_remaining_hours'] = time_remaining_hours
+                self.ring.append(now_ms, rollup_values)
+            
+            logger.debug(f"Snapshot queued: {battery_percent}%, {time_remaining_hours:.1f}h remaining")
             
         except (ValueError, TypeError) as e:
             logger.warning(f"Error taking snapshot: {e}")
         except Exception as e:
             logger.error(f"Unexpected error in snapshot: {e}")
 
-    def _cleanup_old_data(self):
-        """Remove data older than CLEANUP_DAYS"""
-        try:
-            cutoff_date = datetime.now() - timedelta(days=CLEANUP_DAYS)
-            
-            with self.db_lock:
-                with sqlite3.connect(DB_PATH) as conn:
-                    cursor = conn.cursor()
-                    
-                    # Cleanup snapshots
-                    cursor.execute('DELETE FROM battery_snapshots WHERE timestamp < ?', (cutoff_date.isoformat(),))
-                    snapshots_deleted = cursor.rowcount
-                    
-                    # Cleanup old charge sessions
-                    cursor.execute('DELETE FROM charge_sessions WHERE start_time < ?', (cutoff_date.isoformat(),))
-                    sessions_deleted = cursor.rowcount
-                    
-                    # Cleanup old discharge sessions
-                    cursor.execute('DELETE FROM discharge_sessions WHERE timestamp < ?', (cutoff_date.isoformat(),))
-                    discharge_deleted = cursor.rowcount
-                    
-                    conn.commit()
-                    
-            logger.info(f"Cleanup completed: {snapshots_deleted} snapshots, {sessions_deleted} charge sessions, {discharge_deleted} discharge sessions deleted")
-            
-        except Exception as e:
-            logger.error(f"Error during cleanup: {e}")
-
     def get_current_status(self):
         """Get current battery status with time remaining"""
         try:
@@ -488,35 +770,43 @@ class BatteryLogger:
             dc_input = float(self.latest_data.get('dc_input_power', 0))
             
             total_output = ac_output + dc_output
-            remaining_wh = (battery_percent / 100) * TOTAL_CAPACITY_WH
-            time_remaining_hours = remaining_wh / total_output if total_output > 0 else float('inf')
+            capacity_wh = self.analysis.capacity.capacity_wh
+            remaining_wh = (battery_percent / 100) * capacity_wh
+            
+            # Same forecast the API serves, live power until it has data
+            time_remaining_hours = self.analysis.result.time_remaining_hours
+            if time_remaining_hours is None:
+                time_remaining_hours = remaining_wh / total_output if total_output > 0 else float('inf')
             
             is_charging = ac_input > 0 or dc_input > 0
             
             result = {
                 'battery_percent': battery_percent,
                 'battery_voltage': battery_voltage,
-                'total_capacity_wh': TOTAL_CAPACITY_WH,
+                'total_capacity_wh': capacity_wh,
                 'remaining_capacity_wh': remaining_wh,
+                'capacity_confidence': self.analysis.capacity.confidence,
                 'current_output_watts': total_output,
                 'time_remaining': {
                     'hours': time_remaining_hours,
                     'days': time_remaining_hours / 24,
-                    'formatted': self._format_time(time_remaining_hours)
+                    'formatted': format_duration(time_remaining_hours)
                 },
                 'is_charging': is_charging,
                 'timestamp': datetime.now().isoformat()
             }
             
             # Add current charging session info
-            if self.current_charge_session:
-                session = self.current_charge_session
-                current_duration = (datetime.now() - session['start_time']).total_seconds() / 60
+            session = self.charge_sessions.current
+            if session:
                 result['current_session'] = {
-                    'started_at': session['start_time'].isoformat(),
-                    'start_percent': session['start_percent'],
-                    'duration_minutes': int(current_duration),
-                    'charge_type': session['charge_type']
+                    'started_at': battery_db.ms_to_iso(session.start_ms),
+                    'start_percent': session.start_percent,
+                    'duration_minutes': int(session.duration_minutes(battery_db.now_ms())),
+                    'charge_type': session.charge_type,
+                    'avg_input_power': round(session.avg_input_power, 1),
+                    'peak_input_power': session.peak_input_power,
+                    'energy_wh': round(session.energy_wh, 1)
                 }
             
             return result
@@ -525,22 +815,6 @@ class BatteryLogger:
             logger.error(f"Error getting current status: {e}")
             return None
 
-    def _format_time(self, hours):
-        """Format time remaining as human-readable string"""
-        if hours == float('inf'):
-            return "∞"
-        
-        days = int(hours // 24)
-        remaining_hours = int(hours % 24)
-        minutes = int((hours % 1) * 60)
-        
-        if days > 0:
-            return f"{days}d {remaining_hours}h {minutes}m"
-        elif remaining_hours > 0:
-            return f"{remaining_hours}h {minutes}m"
-        else:
-            return f"{minutes}m"
-
     def _log_hourly_discharge(self):
         """Log hourly discharge data and calculate discharge rates"""
         try:
@@ -552,84 +826,44 @@ class BatteryLogger:
             battery_voltage = float(self.latest_data.get('total_battery_voltage', 0))
             total_output_power = float(self.latest_data.get('ac_output_power', 0)) + float(self.latest_data.get('dc_output_power', 0))
             
-            # Get the last discharge session to calculate rate
-            with self.db_lock:
-                with sqlite3.connect(DB_PATH) as conn:
-                    cursor = conn.cursor()
-                    
-                    # Get discharge sessions from the last 4 hours to calculate rate
-                    cursor.execute('''
-                        SELECT battery_percent, timestamp, total_output_power
-                        FROM discharge_sessions 
-                        WHERE timestamp >= datetime('now', '-4 hours')
-                        ORDER BY timestamp ASC
-                    ''')
-                    recent_sessions = cursor.fetchall()
-                    
-                    discharge_rate = 0.0
-                    estimated_hours = 0.0
-                    estimated_days = 0.0
-                    avg_power = total_output_power
-                    
-                    if len(recent_sessions) >= 2:
-                        # Calculate discharge rate from first to last session in the period
-                        first_percent = recent_sessions[0][0]
-                        first_timestamp = recent_sessions[0][1]
-                        last_percent = recent_sessions[-1][0]
-                        last_timestamp = recent_sessions[-1][1]
-                        
-                        first_time = datetime.fromisoformat(first_timestamp)
-                        last_time = datetime.fromisoformat(last_timestamp)
-                        hours_elapsed = (last_time - first_time).total_seconds() / 3600
-                        
-                        if hours_elapsed > 0 and first_percent > last_percent:
-                            # Calculate discharge rate (% per hour)
-                            discharge_rate = (first_percent - last_percent) / hours_elapsed
-                            
-                            # Calculate average power consumption from all sessions
-                            total_power = sum(session[2] for session in recent_sessions)
-                            avg_power = total_power / len(recent_sessions)
-                            
-                            # Estimate remaining time based on current discharge rate
-                            if discharge_rate > 0:
-                                estimated_hours = battery_percent / discharge_rate
-                                estimated_days = estimated_hours / 24
-                    
-                    # Insert new discharge session
-                    cursor.execute('''
-                        INSERT INTO discharge_sessions 
-                        (timestamp, battery_percent, battery_voltage, total_output_power, 
-                         discharge_rate_percent_per_hour, estimated_hours_remaining, 
-                         estimated_days_remaining, avg_power_consumption, session_type)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', (
-                        current_time.isoformat(),
-                        battery_percent,
-                        battery_voltage,
-                        total_output_power,
-                        discharge_rate,
-                        estimated_hours,
-                        estimated_days,
-                        avg_power,
-                        'discharge'
-                    ))
-                    
-                    conn.commit()
-                    logger.info(f"Logged hourly discharge: {battery_percent:.1f}% (rate: {discharge_rate:.2f}%/hr, est: {estimated_days:.1f} days)")
-                    
+            # Rate over the last few hours from the streaming estimator
+            row = discharge_row(self.estimator, battery_db.to_ms(current_time), battery_percent, battery_voltage, total_output_power)
+            
+            # Insert new discharge session
+            partition = battery_db.partition_name('discharge_sessions', current_time.date())
+            self.write_buffer.add(DISCHARGE_INSERT_SQL.format(table=partition), row,
+                                  partition=('discharge_sessions', current_time.date()))
+            self.last_discharge_time = current_time
+            
+            logger.info(f"Logged hourly discharge: {battery_percent:.1f}% (rate: {row[4]:.2f}%/hr, est: {row[6]:.1f} days)")
+            
         except Exception as e:
             logger.error(f"Error logging hourly discharge: {e}")
 
     def run(self):
         """Main run loop"""
         logger.info("Battery Logger started")
+        # Treat a service stop like Ctrl+C so queued rows are flushed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         try:
             while True:
                 time.sleep(1)
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, SystemExit):
             logger.info("Shutting down battery logger...")
-            if self.current_charge_session:
+            if self.charge_sessions.current:
                 self._end_charge_session(float(self.latest_data.get('total_battery_percent', 0)))
+            try:
+                rows = self.write_buffer.flush()
+                logger.info(f"Flushed {rows} queued rows on shutdown ({self.write_buffer.stats()})")
+            except Exception as e:
+                logger.error(f"Error flushing write buffer on shutdown: {e}")
+            try:
+                battery_db.checkpoint()
+            except Exception as e:
+                logger.error(f"Error checkpointing database on shutdown: {e}")
+            battery_db.close_all()
+            if self.ring:
+                self.ring.close()
 
 if __name__ == "__main__":
     battery_logger = BatteryLogger()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Battery Monitor Settings
+In-memory settings shared by the battery logger and the API server
+"""
+
+import json
+import threading
+import logging
+import battery_db
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+DEFAULT_DISCHARGE_INTERVAL = 10  # minutes
+DEFAULT_SECTIONS = [
+    ('battery_status', 1, 1),
+    ('power_flow', 2, 1),
+    ('activity_log', 3, 1),
+    ('discharge_analysis', 4, 1),
+    ('raw_data', 5, 1)
+]
+SETTINGS_POLL_INTERVAL = 1.0  # seconds between PRAGMA data_version checks
+
+
+def _bump_version(conn):
+    """Mark settings as changed so every process's cache reloads them"""
+    conn.execute('''
+        UPDATE app_settings
+        SET setting_value = CAST(setting_value AS INTEGER) + 1, updated_at = ?
+        WHERE setting_name = 'settings_version'
+    ''', (battery_db.now_ms(),))
+
+
+def save_discharge_interval(conn, interval_minutes):
+    conn.execute('''
+        INSERT OR REPLACE INTO discharge_settings (setting_name, setting_value, updated_at)
+        VALUES ('interval_minutes', ?, ?)
+    ''', (str(interval_minutes), battery_db.now_ms()))
+    _bump_version(conn)
+
+
+def save_section_order(conn, sections):
+    now = battery_db.now_ms()
+    for section in sections:
+        conn.execute('''
+            UPDATE section_order 
+            SET display_order = ?, is_visible = ?, updated_at = ?
+            WHERE section_name = ?
+        ''', (section['order'], section['visible'], now, section['name']))
+    _bump_version(conn)
+
+
+def reset_section_order(conn):
+    now = battery_db.now_ms()
+    conn.execute('DELETE FROM section_order')
+    conn.executemany('''
+        INSERT INTO section_order (section_name, display_order, is_visible, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(name, order, visible, now, now) for name, order, visible in DEFAULT_SECTIONS])
+    _bump_version(conn)
+
+
+def save_notification_config(conn, overrides):
+    """Merge notification config overrides into the stored ones"""
+    row = conn.execute("SELECT setting_value FROM app_settings WHERE setting_name = 'notification_config'").fetchone()
+    stored = json.loads(row[0]) if row else {}
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(stored.get(key), dict):
+            stored[key].update(value)
+        else:
+            stored[key] = value
+    conn.execute('''
+        INSERT OR REPLACE INTO app_settings (setting_name, setting_value, updated_at)
+        VALUES ('notification_config', ?, ?)
+    ''', (json.dumps(stored), battery_db.now_ms()))
+    _bump_version(conn)
+
+
+class SettingsCache:
+    """Keeps every setting in memory and reloads only when another write lands
+
+    A DataVersionWatcher notices commits from any connection; only then is
+    the settings_version row checked, and the settings are reloaded only if
+    a settings write bumped it.
+    """
+
+    def __init__(self, poll_interval=SETTINGS_POLL_INTERVAL):
+        self._lock = threading.Lock()
+        self._watcher = battery_db.DataVersionWatcher(poll_interval)
+        self._settings_version = None
+        self._values = {
+            'interval_minutes': DEFAULT_DISCHARGE_INTERVAL,
+            'sections': [
+                {'name': name, 'order': order, 'visible': bool(visible)}
+                for name, order, visible in DEFAULT_SECTIONS
+            ],
+            'notification_config': {}
+        }
+
+    def _load(self, conn):
+        values = dict(self._values)
+        
+        row = conn.execute('''
+            SELECT setting_value FROM discharge_settings 
+            WHERE setting_name = 'interval_minutes'
+        ''').fetchone()
+        values['interval_minutes'] = int(row[0]) if row else DEFAULT_DISCHARGE_INTERVAL
+        
+        rows = conn.execute('''
+            SELECT section_name, display_order, is_visible 
+            FROM section_order 
+            ORDER BY display_order
+        ''').fetchall()
+        values['sections'] = [
+            {'name': name, 'order': order, 'visible': bool(visible)}
+            for name, order, visible in rows
+        ]
+        
+        row = conn.execute("SELECT setting_value FROM app_settings WHERE setting_name = 'notification_config'").fetchone()
+        values['notification_config'] = json.loads(row[0]) if row else {}
+        return values
+
+    def _refresh(self):
+        try:
+            if not self._watcher.changed():
+                return
+            
+            conn = self._watcher.conn
+            row = conn.execute("SELECT setting_value FROM app_settings WHERE setting_name = 'settings_version'").fetchone()
+            settings_version = row[0] if row else None
+            if settings_version != self._settings_version or settings_version is None:
+                self._values = self._load(conn)
+                self._settings_version = settings_version
+                logger.debug(f"Settings reloaded (version {settings_version})")
+        except Exception as e:
+            # Keep serving the last known values, e.g. before the logger has created the schema
+            self._watcher.reset()
+            logger.warning(f"Error refreshing settings: {e}")
+
+    def get(self, name):
+        with self._lock:
+            self._refresh()
+            return self._values[name]
+
+    def invalidate(self):
+        """Force a reload on the next read (used after a local write)"""
+        with self._lock:
+            self._settings_version = None
+            self._watcher.reset()
+
+    def discharge_interval(self):
+        return self.get('interval_minutes')
+
+    def section_order(self):
+        return self.get('sections')
+
+    def notification_config(self):
+        return self.get('notification_config')
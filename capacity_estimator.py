@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Capacity Estimator
+Effective battery capacity and state of health, learned from how much
+energy each charge or discharge segment moved per percent
+"""
+
+import json
+import math
+import logging
+import battery_db
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+NOMINAL_CAPACITY_WH = 6144  # AC200MAX (2048) + 2x B230 (2048 each)
+PRIOR_WEIGHT = 50.0  # percent-points of evidence the nominal capacity counts as
+HALF_LIFE_PERCENT = 1000.0  # evidence halves after this many percent-points of newer segments (~10 cycles)
+NET_POWER_DEADBAND = 10.0  # watts; smaller net flows are idle and extend no segment
+MIN_SEGMENT_PERCENT = 5.0  # segments must move at least this far to count
+MAX_SEGMENT_PERCENT = 20.0  # longer runs are split so the estimate keeps moving
+MAX_GAP_MS = 5 * battery_db.SNAPSHOT_INTERVAL * 1000  # a longer gap in snapshots abandons the segment
+PLAUSIBLE_RANGE = (0.5, 1.3)  # segment estimates outside this share of nominal are discarded
+
+CAPACITY_SAVE_SQL = '''
+    INSERT OR REPLACE INTO estimator_state (name, state, updated_at)
+    VALUES ('capacity', ?, ?)
+'''
+
+CAPACITY_HISTORY_INSERT_SQL = '''
+    INSERT INTO capacity_history
+    (timestamp, direction, start_percent, end_percent, energy_wh, segment_capacity_wh,
+     capacity_wh, confidence)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+class CapacityEstimator:
+    """Weighted running mean of Wh per 100% over charge and discharge segments
+
+    A segment is a run of snapshots whose net power (input minus output)
+    keeps one sign. It is measured between the first and last change of the
+    reported percent, so the integer percent steps don't bias it, and it
+    closes when the direction changes, after a gap, or after
+    MAX_SEGMENT_PERCENT. Each segment updates decayed sums weighted by how
+    far it moved, so the work per segment is constant and history is never
+    rescanned. The nominal capacity acts as PRIOR_WEIGHT of prior evidence.
+
+    Discharge segments count delivered energy, which is what time-remaining
+    needs; charge segments include charging losses and are tracked
+    separately, used only until discharge evidence exists.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.last_ts = state.get('last_ts')
+        self.last_percent = state.get('last_percent')
+        self.last_net = state.get('last_net')
+        self.segment = state.get('segment')
+        self.sums = {
+            direction: dict({'w': 0.0, 'wx': 0.0, 'wxx': 0.0, 'segments': 0}, **state.get('sums', {}).get(direction, {}))
+            for direction in ('discharge', 'charge')
+        }
+
+    @classmethod
+    def load(cls, conn):
+        """Restore the persisted estimator, or start from the nominal capacity"""
+        try:
+            row = conn.execute("SELECT state FROM estimator_state WHERE name = 'capacity'").fetchone()
+        except Exception as e:
+            logger.warning(f"Error loading capacity estimator: {e}")
+            row = None
+        return cls(json.loads(row[0]) if row else None)
+
+    def update(self, ts_ms, battery_percent, input_power, output_power):
+        """Fold in one snapshot; returns CAPACITY_HISTORY_INSERT_SQL params when a segment is accepted"""
+        if self.last_ts is not None and ts_ms <= self.last_ts:
+            return None
+
+        net = input_power - output_power
+        direction = 'charge' if net > NET_POWER_DEADBAND else 'discharge' if net < -NET_POWER_DEADBAND else None
+        gap = self.last_ts is None or ts_ms - self.last_ts > MAX_GAP_MS
+        row = None
+
+        segment = self.segment
+        if segment and (gap or (direction and direction != segment['direction'])):
+            row = self._close_segment(ts_ms)
+            segment = None
+
+        if segment and not gap:
+            # Trapezoidal energy since the previous snapshot, as Wh into the battery
+            segment['energy_wh'] += (self.last_net + net) / 2 * (ts_ms - self.last_ts) / 3600000
+            if battery_percent != self.last_percent:
+                if segment['start_percent'] is None:
+                    # Measure from the first percent step so partial steps don't count
+                    segment['start_percent'] = battery_percent
+                    segment['energy_wh'] = 0.0
+                segment['end_percent'] = battery_percent
+                segment['end_energy_wh'] = segment['energy_wh']
+                if abs(segment['end_percent'] - segment['start_percent']) >= MAX_SEGMENT_PERCENT:
+                    # Split here; the next segment starts on this same percent step
+                    row = self._close_segment(ts_ms)
+                    self.segment = self._new_segment(segment['direction'], battery_percent)
+                    segment = self.segment
+
+        if segment is None and direction:
+            self.segment = self._new_segment(direction)
+
+        self.last_ts, self.last_percent, self.last_net = ts_ms, battery_percent, net
+        return row
+
+    @staticmethod
+    def _new_segment(direction, start_percent=None):
+        return {
+            'direction': direction,
+            'start_percent': start_percent,
+            'end_percent': start_percent,
+            'energy_wh': 0.0,
+            'end_energy_wh': 0.0
+        }
+
+    def _close_segment(self, ts_ms):
+        segment, self.segment = self.segment, None
+        if segment['start_percent'] is None:
+            return None
+        moved = segment['end_percent'] - segment['start_percent']
+        energy = segment['end_energy_wh']
+        if abs(moved) < MIN_SEGMENT_PERCENT or moved * energy <= 0:
+            return None
+
+        estimate = energy / moved * 100
+        low, high = PLAUSIBLE_RANGE
+        if not low * NOMINAL_CAPACITY_WH <= estimate <= high * NOMINAL_CAPACITY_WH:
+            logger.info(f"Discarded implausible {segment['direction']} segment: {estimate:.0f}Wh per 100%")
+            return None
+
+        weight = abs(moved)
+        sums = self.sums[segment['direction']]
+        decay = 0.5 ** (weight / HALF_LIFE_PERCENT)
+        sums['w'] = sums['w'] * decay + weight
+        sums['wx'] = sums['wx'] * decay + weight * estimate
+        sums['wxx'] = sums['wxx'] * decay + weight * estimate * estimate
+        sums['segments'] += 1
+        logger.info(f"Capacity segment ({segment['direction']}, {moved:+.0f}%): {estimate:.0f}Wh, "
+                    f"effective capacity now {self.capacity_wh:.0f}Wh")
+        return (
+            ts_ms, segment['direction'], segment['start_percent'], segment['end_percent'],
+            round(energy, 2), round(estimate, 1), round(self.capacity_wh, 1), round(self.confidence, 3)
+        )
+
+    def _evidence(self):
+        """The direction whose segments the estimate is based on"""
+        return self.sums['discharge'] if self.sums['discharge']['w'] > 0 else self.sums['charge']
+
+    @property
+    def capacity_wh(self):
+        """Effective capacity: the evidence blended with the nominal capacity"""
+        sums = self._evidence()
+        return (PRIOR_WEIGHT * NOMINAL_CAPACITY_WH + sums['wx']) / (PRIOR_WEIGHT + sums['w'])
+
+    @property
+    def confidence(self):
+        """0 at the nominal capacity, approaching 1 as consistent evidence builds up"""
+        sums = self._evidence()
+        if sums['w'] <= 0:
+            return 0.0
+        mean = sums['wx'] / sums['w']
+        spread = math.sqrt(max(sums['wxx'] / sums['w'] - mean * mean, 0.0)) / mean
+        return sums['w'] / (sums['w'] + PRIOR_WEIGHT) * max(0.0, 1 - spread)
+
+    @property
+    def state_of_health(self):
+        return self.capacity_wh / NOMINAL_CAPACITY_WH
+
+    def summary(self):
+        result = {
+            'nominal_capacity_wh': NOMINAL_CAPACITY_WH,
+            'capacity_wh': round(self.capacity_wh, 1),
+            'state_of_health_percent': round(self.state_of_health * 100, 1),
+            'confidence': round(self.confidence, 3)
+        }
+        for direction, sums in self.sums.items():
+            result[f'{direction}_segments'] = sums['segments']
+            result[f'{direction}_capacity_wh'] = round(sums['wx'] / sums['w'], 1) if sums['w'] > 0 else None
+        return result
+
+    def state(self):
+        return {
+            'last_ts': self.last_ts,
+            'last_percent': self.last_percent,
+            'last_net': self.last_net,
+            'segment': self.segment,
+            'sums': self.sums
+        }
+
+    def save_params(self):
+        """Parameters for CAPACITY_SAVE_SQL"""
+        return (json.dumps(self.state()), battery_db.now_ms())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Charge Sessions
+Charging-session detection with constant-memory running aggregates
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+CHARGE_POWER_THRESHOLD = 10  # watts of AC or DC input that count as charging
+FULL_PERCENT = 99.5  # a session ends once the battery reaches this
+END_GRACE_MS = 120000  # input must stay below the threshold this long to end a session
+MIN_SESSION_MINUTES = 5  # shorter sessions are only kept if they gained MIN_PERCENT_GAINED
+MIN_PERCENT_GAINED = 1.0
+MIXED_SHARE = 0.1  # each source needs this share of the input energy for a 'mixed' session
+PASS_THROUGH_SHARE = 0.9  # output covering this share of the input, with no gain, is pass-through
+CHARGE_KEYS = ('ac_input_power', 'dc_input_power', 'total_battery_percent')  # MQTT keys that can change the state
+
+CHARGE_SESSION_INSERT_SQL = '''
+    INSERT INTO charge_sessions
+    (start_time, end_time, start_percent, end_percent, duration_minutes, charge_type,
+     avg_input_power, peak_input_power, energy_wh, output_energy_wh, sample_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+class ChargeSession:
+    """Running totals for one charging session
+
+    Readings arrive when a value changes, so each one holds until the next:
+    energy is the previous power times the time since it was reported.
+    """
+
+    def __init__(self, ts_ms, battery_percent, ac_input, dc_input, output_power):
+        self.start_ms = ts_ms
+        self.start_percent = battery_percent
+        self.end_ms = None
+        self.end_percent = None
+        self.last_ts = ts_ms
+        self.stopped_ms = None  # first reading below the threshold, while in the grace period
+        self.ac_input = ac_input
+        self.dc_input = dc_input
+        self.output_power = output_power
+        self.sample_count = 1
+        self.power_sum = ac_input + dc_input
+        self.peak_input_power = ac_input + dc_input
+        self.ac_wh = 0.0
+        self.dc_wh = 0.0
+        self.output_wh = 0.0
+
+    def advance(self, ts_ms):
+        """Integrate the held readings up to ts_ms"""
+        if ts_ms > self.last_ts:
+            hours = (ts_ms - self.last_ts) / 3600000
+            self.ac_wh += self.ac_input * hours
+            self.dc_wh += self.dc_input * hours
+            self.output_wh += self.output_power * hours
+            self.last_ts = ts_ms
+
+    def add(self, ts_ms, ac_input, dc_input, output_power):
+        self.advance(ts_ms)
+        self.ac_input, self.dc_input, self.output_power = ac_input, dc_input, output_power
+        self.sample_count += 1
+        self.power_sum += ac_input + dc_input
+        self.peak_input_power = max(self.peak_input_power, ac_input + dc_input)
+
+    @property
+    def energy_wh(self):
+        return self.ac_wh + self.dc_wh
+
+    def duration_minutes(self, ts_ms=None):
+        end = ts_ms if ts_ms is not None else self.end_ms if self.end_ms is not None else self.last_ts
+        return (end - self.start_ms) / 60000
+
+    @property
+    def avg_input_power(self):
+        """Time-weighted average input in watts (sample mean until time has passed)"""
+        hours = (self.last_ts - self.start_ms) / 3600000
+        if hours > 0:
+            return self.energy_wh / hours
+        return self.power_sum / self.sample_count
+
+    @property
+    def charge_type(self):
+        """'AC', 'DC', 'mixed' or 'pass-through'"""
+        energy = self.energy_wh
+        if energy <= 0:
+            return 'AC' if self.ac_input >= self.dc_input else 'DC'
+        gained = (self.end_percent if self.end_percent is not None else self.start_percent) - self.start_percent
+        if gained < MIN_PERCENT_GAINED and self.output_wh >= PASS_THROUGH_SHARE * energy:
+            return 'pass-through'
+        if min(self.ac_wh, self.dc_wh) >= MIXED_SHARE * energy:
+            return 'mixed'
+        return 'AC' if self.ac_wh > self.dc_wh else 'DC'
+
+    def worth_saving(self):
+        return (self.duration_minutes() >= MIN_SESSION_MINUTES
+                or self.end_percent - self.start_percent >= MIN_PERCENT_GAINED)
+
+    def insert_params(self):
+        """Parameters for CHARGE_SESSION_INSERT_SQL"""
+        return (
+            self.start_ms, self.end_ms, self.start_percent, self.end_percent,
+            int(self.duration_minutes()), self.charge_type,
+            round(self.avg_input_power, 2), round(self.peak_input_power, 2),
+            round(self.energy_wh, 2), round(self.output_wh, 2), self.sample_count
+        )
+
+
+class ChargeSessionTracker:
+    """Starts and ends charge sessions from input power and battery percent
+
+    Timestamps are passed in, so the same logic runs on live MQTT readings
+    and on snapshots replayed from the database.
+    """
+
+    def __init__(self, state=None):
+        self.current = None
+        if state:
+            self.current = ChargeSession.__new__(ChargeSession)
+            self.current.__dict__.update(state)
+
+    def state(self):
+        """JSON-serialisable open session, or None"""
+        return dict(vars(self.current)) if self.current else None
+
+    def update(self, ts_ms, ac_input, dc_input, battery_percent, output_power=0.0):
+        """Fold in one reading and return the session it ended, if any"""
+        is_full = battery_percent >= FULL_PERCENT
+        is_charging = (ac_input > CHARGE_POWER_THRESHOLD or dc_input > CHARGE_POWER_THRESHOLD) and not is_full
+
+        session = self.current
+        if session is None:
+            if is_charging:
+                self.current = ChargeSession(ts_ms, battery_percent, ac_input, dc_input, output_power)
+                logger.info(f"Started charging session at {battery_percent}%")
+            return None
+
+        # Readings only arrive on change, so charging is assumed to have
+        # carried on until the first reading that says otherwise
+        session.add(ts_ms, ac_input, dc_input, output_power)
+        if is_charging:
+            session.stopped_ms = None
+            return None
+        if session.stopped_ms is None:
+            session.stopped_ms = ts_ms
+        if is_full or ts_ms - session.stopped_ms > END_GRACE_MS:
+            return self.finish(ts_ms, battery_percent)
+        return None
+
+    def finish(self, ts_ms, end_percent):
+        """End the current session (e.g. on shutdown) and return it, or None"""
+        session = self.current
+        if session is None:
+            return None
+        session.advance(ts_ms)
+        session.end_ms = max(ts_ms, session.start_ms)
+        session.end_percent = end_percent
+        self.current = None
+        return session
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Discharge Analysis
+One place that turns the streaming discharge estimate into time-remaining
+figures for the API routes and the battery logger
+"""
+
+import math
+import threading
+import logging
+from dataclasses import dataclass
+from typing import Optional
+import battery_db
+from discharge_estimator import DischargeEstimator, ESTIMATOR_WINDOWS
+from capacity_estimator import CapacityEstimator
+from load_forecast import LoadProfile
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+RATE_WINDOW = '12h'  # regression window used for the discharge rate
+POWER_WINDOW = '24h'  # EWMA window used for average power and the fallback rate
+ANALYSIS_POLL_INTERVAL = 1.0  # seconds between checks for new data in other processes
+DISCHARGE_LOG_WINDOW = '4h'  # window behind the periodic discharge_sessions rows
+
+# {table} is filled in with the day partition the row belongs to
+DISCHARGE_INSERT_SQL = '''
+    INSERT INTO {table} 
+    (timestamp, battery_percent, battery_voltage, total_output_power, 
+     discharge_rate_percent_per_hour, estimated_hours_remaining, 
+     estimated_days_remaining, avg_power_consumption, session_type)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def format_duration(hours):
+    """Format hours as e.g. '1d 4h 30m' ('∞' for None or infinity)"""
+    if hours is None or hours == float('inf'):
+        return "∞"
+
+    days = int(hours // 24)
+    remaining_hours = int(hours % 24)
+    minutes = int((hours % 1) * 60)
+
+    if days > 0:
+        return f"{days}d {remaining_hours}h {minutes}m"
+    elif remaining_hours > 0:
+        return f"{remaining_hours}h {minutes}m"
+    else:
+        return f"{minutes}m"
+
+
+def format_duration_short(hours):
+    """Format hours as e.g. '1d 4h' or '4h 30m'"""
+    if hours >= 24:
+        return f"{int(hours / 24)}d {int(hours % 24)}h"
+    elif hours >= 1:
+        return f"{int(hours)}h {int((hours % 1) * 60)}m"
+    else:
+        return f"{int(hours * 60)}m"
+
+
+@dataclass(frozen=True)
+class DischargeAnalysis:
+    """Immutable result published by DischargeAnalysisEngine"""
+    data_available: bool
+    battery_percent: Optional[float] = None
+    discharge_rate_percent_per_hour: float = 0.0
+    analysis_period_hours: float = 0.0  # time constant of the window the rate came from
+    avg_power_consumption: float = 0.0
+    estimated_hours_remaining: Optional[float] = None
+    sample_weight: float = 0.0
+    last_updated_ms: Optional[int] = None
+    capacity_wh: float = 0.0
+    capacity_confidence: float = 0.0
+    forecast_hours_to_empty: Optional[float] = None  # None without a load profile, inf beyond the horizon
+    forecast_thresholds: tuple = ()  # (percent, hours or None) per alert level below the current percent
+
+    @property
+    def time_remaining_hours(self):
+        """The load-profile forecast, or the rate estimate until a profile exists
+
+        Infinity when the profile says the battery outlasts the forecast
+        horizon; the rate estimate is only a stand-in for a missing profile.
+        """
+        if self.forecast_hours_to_empty is not None:
+            return self.forecast_hours_to_empty
+        return self.estimated_hours_remaining
+
+    @property
+    def forecast_beyond_horizon(self):
+        return self.forecast_hours_to_empty == math.inf
+
+    @property
+    def estimated_days_remaining(self):
+        if self.estimated_hours_remaining is None:
+            return None
+        return self.estimated_hours_remaining / 24
+
+    @property
+    def remaining_wh(self):
+        if self.battery_percent is None:
+            return None
+        return self.battery_percent / 100 * self.capacity_wh
+
+
+NO_ANALYSIS = DischargeAnalysis(data_available=False)
+
+
+def analyze(estimator, capacity, profile=None):
+    """Build the analysis for the estimators' current state
+
+    The rate is the RATE_WINDOW regression slope once it has enough
+    discharge behind it, otherwise the POWER_WINDOW average power converted
+    to percent per hour using the estimated effective capacity. With a load
+    profile, the forecast simulates the charge forward from the last
+    snapshot against it.
+    """
+    if estimator.last_ts is None:
+        return NO_ANALYSIS
+
+    capacity_wh = capacity.capacity_wh
+    avg_power = estimator.avg_power(POWER_WINDOW) or 0.0
+    rate = estimator.discharge_rate(RATE_WINDOW)
+    rate_window = RATE_WINDOW
+    if not rate:
+        rate = (avg_power / capacity_wh) * 100
+        rate_window = POWER_WINDOW
+
+    battery_percent = estimator.last_percent
+    hours_remaining = battery_percent / rate if rate > 0 else None
+    hours_to_empty, thresholds = (None, {})
+    if profile is not None:
+        hours_to_empty, thresholds = profile.forecast(estimator.last_ts, battery_percent, capacity_wh)
+    return DischargeAnalysis(
+        data_available=True,
+        battery_percent=battery_percent,
+        discharge_rate_percent_per_hour=rate,
+        analysis_period_hours=ESTIMATOR_WINDOWS[rate_window],
+        avg_power_consumption=avg_power,
+        estimated_hours_remaining=hours_remaining,
+        sample_weight=estimator.sample_weight(POWER_WINDOW),
+        last_updated_ms=estimator.last_ts,
+        capacity_wh=capacity_wh,
+        capacity_confidence=capacity.confidence,
+        forecast_hours_to_empty=hours_to_empty,
+        forecast_thresholds=tuple(thresholds.items())
+    )
+
+
+def discharge_row(estimator, ts_ms, battery_percent, battery_voltage, total_output_power):
+    """Parameters for DISCHARGE_INSERT_SQL from the estimator's DISCHARGE_LOG_WINDOW"""
+    discharge_rate = estimator.discharge_rate(DISCHARGE_LOG_WINDOW) or 0.0
+    avg_power = estimator.avg_power(DISCHARGE_LOG_WINDOW)
+    if avg_power is None:
+        avg_power = total_output_power
+
+    estimated_hours = 0.0
+    estimated_days = 0.0
+    if discharge_rate > 0:
+        estimated_hours = battery_percent / discharge_rate
+        estimated_days = estimated_hours / 24
+
+    return (
+        ts_ms, battery_percent, battery_voltage, total_output_power,
+        discharge_rate, estimated_hours, estimated_days, avg_power, 'discharge'
+    )
+
+
+class DischargeAnalysisEngine:
+    """Holds the latest DischargeAnalysis and recomputes it only on new data
+
+    The logger owns the estimators and load profile and calls publish()
+    after every snapshot.
+    Other processes call current(), which reloads the persisted estimators
+    only when a DataVersionWatcher reports a commit, so serving a request
+    costs at most one PRAGMA.
+    """
+
+    def __init__(self, poll_interval=ANALYSIS_POLL_INTERVAL):
+        self._lock = threading.Lock()
+        self._watcher = battery_db.DataVersionWatcher(poll_interval)
+        self._estimator_updated_at = None
+        self._result = NO_ANALYSIS
+        self._capacity = CapacityEstimator()
+        self._profile = LoadProfile()
+
+    @property
+    def result(self):
+        """Last published or loaded analysis, without checking for new data"""
+        return self._result
+
+    @property
+    def capacity(self):
+        """Last published or loaded capacity estimator"""
+        return self._capacity
+
+    @property
+    def profile(self):
+        """Last published or loaded load profile"""
+        return self._profile
+
+    def publish(self, estimator, capacity, profile):
+        """Recompute from in-process estimators"""
+        self._capacity = capacity
+        self._profile = profile
+        self._result = analyze(estimator, capacity, profile)
+        return self._result
+
+    def current(self):
+        """Latest analysis, refreshed from the database when it has changed"""
+        with self._lock:
+            try:
+                if self._watcher.changed():
+                    conn = self._watcher.conn
+                    updated_at = conn.execute('''
+                        SELECT MAX(updated_at) FROM estimator_state WHERE name IN ('discharge', 'capacity', 'load_profile')
+                    ''').fetchone()[0]
+                    if updated_at != self._estimator_updated_at:
+                        self._capacity = CapacityEstimator.load(conn)
+                        self._profile = LoadProfile.load(conn)
+                        self._result = analyze(DischargeEstimator.load(conn), self._capacity, self._profile)
+                        self._estimator_updated_at = updated_at
+            except Exception as e:
+                self._watcher.reset()
+                logger.warning(f"Error refreshing discharge analysis: {e}")
+            return self._result
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Discharge Estimator
+Streaming discharge-rate estimate updated from every battery snapshot
+"""
+
+import json
+import math
+import logging
+import battery_db
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+ESTIMATOR_WINDOWS = {  # window name -> time constant in hours
+    '1h': 1,
+    '4h': 4,
+    '12h': 12,
+    '24h': 24
+}
+MIN_SPAN_HOURS = 1.0  # a window needs this much uninterrupted discharge before its slope is used
+
+ESTIMATOR_SAVE_SQL = '''
+    INSERT OR REPLACE INTO estimator_state (name, state, updated_at)
+    VALUES ('discharge', ?, ?)
+'''
+
+
+class DischargeEstimator:
+    """Exponentially weighted least-squares fit of battery percent over time
+
+    Each window keeps decayed sums of w, w*t, w*y, w*t^2 and w*t*y with t in
+    hours relative to the newest sample, so adding a sample is O(1) and the
+    slope of the weighted regression line is a closed-form expression. The
+    same weights give an EWMA of output power. A charging sample restarts
+    the regression, since the slope is only meaningful while discharging.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.last_ts = state.get('last_ts')
+        self.last_percent = state.get('last_percent')
+        self.windows = {}
+        for name in ESTIMATOR_WINDOWS:
+            window = dict.fromkeys(('s0', 'st', 'sy', 'stt', 'sty', 'span', 'pw0', 'pw'), 0.0)
+            window.update(state.get('windows', {}).get(name, {}))
+            self.windows[name] = window
+
+    @classmethod
+    def load(cls, conn):
+        """Restore the persisted estimator, or start a fresh one"""
+        try:
+            row = conn.execute("SELECT state FROM estimator_state WHERE name = 'discharge'").fetchone()
+        except Exception as e:
+            logger.warning(f"Error loading discharge estimator: {e}")
+            row = None
+        return cls(json.loads(row[0]) if row else None)
+
+    def update(self, ts_ms, battery_percent, output_power, is_charging=False):
+        """Fold in one snapshot"""
+        if self.last_ts is not None and ts_ms <= self.last_ts:
+            return
+
+        dt = (ts_ms - self.last_ts) / 3600000 if self.last_ts is not None else 0.0
+        for name, tau in ESTIMATOR_WINDOWS.items():
+            w = self.windows[name]
+            decay = math.exp(-dt / tau)
+
+            # Move the origin to the new sample, then age every weight
+            w['stt'] = decay * (w['stt'] - 2 * dt * w['st'] + dt * dt * w['s0'])
+            w['sty'] = decay * (w['sty'] - dt * w['sy'])
+            w['st'] = decay * (w['st'] - dt * w['s0'])
+            w['sy'] = decay * w['sy']
+            w['s0'] = decay * w['s0']
+            w['pw0'] = decay * w['pw0'] + 1
+            w['pw'] = decay * w['pw'] + output_power
+
+            if is_charging:
+                for key in ('s0', 'st', 'sy', 'stt', 'sty', 'span'):
+                    w[key] = 0.0
+                continue
+
+            # The new sample sits at t = 0, so only s0 and sy change
+            w['s0'] += 1
+            w['sy'] += battery_percent
+            w['span'] = w['span'] + dt if w['s0'] > 1 else 0.0
+
+        self.last_ts = ts_ms
+        self.last_percent = battery_percent
+
+    def discharge_rate(self, window):
+        """Percent per hour lost according to the window's regression, or None
+
+        None means the window hasn't seen enough discharging yet; a flat or
+        rising line gives 0.
+        """
+        w = self.windows[window]
+        if w['span'] < MIN_SPAN_HOURS:
+            return None
+        denominator = w['s0'] * w['stt'] - w['st'] * w['st']
+        if denominator <= 0:
+            return None
+        slope = (w['s0'] * w['sty'] - w['st'] * w['sy']) / denominator
+        return max(-slope, 0.0)
+
+    def avg_power(self, window):
+        """EWMA of output power in watts, or None before the first sample"""
+        w = self.windows[window]
+        return w['pw'] / w['pw0'] if w['pw0'] else None
+
+    def sample_weight(self, window):
+        """Effective number of discharge samples behind the window's slope"""
+        return self.windows[window]['s0']
+
+    def state(self):
+        return {
+            'last_ts': self.last_ts,
+            'last_percent': self.last_percent,
+            'windows': self.windows
+        }
+
+    def save_params(self):
+        """Parameters for ESTIMATOR_SAVE_SQL"""
+        return (json.dumps(self.state()), battery_db.now_ms())
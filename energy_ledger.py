@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Energy Ledger
+Hourly and daily Wh in/out, integrated from snapshots as they are logged
+"""
+
+import logging
+import battery_db
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+ENERGY_FIELDS = ('ac_input', 'dc_input', 'ac_output', 'dc_output')  # each <field>_power -> <field>_wh
+ENERGY_PERIODS = {  # period -> (table, retention days or None to keep forever)
+    'hourly': ('energy_hourly', battery_db.ROLLUP_RESOLUTIONS['1h'][1]),
+    'daily': ('energy_daily', None)
+}
+MAX_GAP_MS = 5 * battery_db.SNAPSHOT_INTERVAL * 1000  # intervals longer than this are not integrated
+HOUR_MS = 3600000
+
+
+def _build_upsert_sql(table):
+    columns = ', '.join(f'{field}_wh' for field in ENERGY_FIELDS)
+    updates = ', '.join(f'{field}_wh = {field}_wh + excluded.{field}_wh' for field in ENERGY_FIELDS)
+    return f'''
+        INSERT INTO {table} (period_start, {columns}, covered_ms)
+        VALUES (?, {', '.join('?' for _ in ENERGY_FIELDS)}, ?)
+        ON CONFLICT(period_start) DO UPDATE SET {updates}, covered_ms = covered_ms + excluded.covered_ms
+    '''
+
+
+ENERGY_UPSERT_SQL = {period: _build_upsert_sql(table) for period, (table, _) in ENERGY_PERIODS.items()}
+
+
+def create_energy_tables(cursor):
+    """Create the ledger tables, backfilling new ones from raw snapshots
+
+    The backfill credits each interval to the hour its later sample falls
+    in; live integration splits intervals at hour boundaries. Call after
+    migrate(), like create_rollup_tables.
+    """
+    for period, (table, _) in ENERGY_PERIODS.items():
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,))
+        if cursor.fetchone():
+            continue
+
+        field_columns = ', '.join(f'{field}_wh REAL NOT NULL DEFAULT 0' for field in ENERGY_FIELDS)
+        cursor.execute(f'''
+            CREATE TABLE {table} (
+                period_start INTEGER PRIMARY KEY,
+                {field_columns},
+                covered_ms INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        if period == 'hourly':
+            trapezoids = ', '.join(
+                f'SUM((COALESCE({field}_power, 0) + COALESCE(prev_{field}, 0)) / 2 * (timestamp - prev_ts) / {HOUR_MS}.0)'
+                for field in ENERGY_FIELDS
+            )
+            lags = ', '.join(f'LAG({field}_power) OVER w AS prev_{field}' for field in ENERGY_FIELDS)
+            cursor.execute(f'''
+                INSERT INTO {table}
+                SELECT (timestamp / {HOUR_MS}) * {HOUR_MS} AS hour, {trapezoids}, SUM(timestamp - prev_ts)
+                FROM (
+                    SELECT timestamp, {', '.join(f'{field}_power' for field in ENERGY_FIELDS)},
+                           LAG(timestamp) OVER w AS prev_ts, {lags}
+                    FROM battery_snapshots
+                    WINDOW w AS (ORDER BY timestamp)
+                )
+                WHERE prev_ts IS NOT NULL AND timestamp - prev_ts <= ?
+                GROUP BY hour
+            ''', (MAX_GAP_MS,))
+        else:
+            day_expr = battery_db.local_day_start_sql('period_start')
+            sums = ', '.join(f'SUM({field}_wh)' for field in ENERGY_FIELDS)
+            cursor.execute(f'''
+                INSERT INTO {table}
+                SELECT {day_expr} AS day, {sums}, SUM(covered_ms)
+                FROM {ENERGY_PERIODS['hourly'][0]}
+                GROUP BY day
+            ''')
+        logger.info(f"Created energy table {table} ({cursor.rowcount} periods backfilled)")
+
+
+class EnergyLedger:
+    """Trapezoidal integration of AC/DC input and output power
+
+    Each new snapshot closes the interval since the previous one. Intervals
+    longer than MAX_GAP_MS (missed snapshots, restarts) are skipped rather
+    than guessed at, and covered_ms records how much of each period was
+    actually integrated. Intervals are split at hour boundaries using the
+    linearly interpolated power there.
+    """
+
+    def __init__(self):
+        self.last_ts = None
+        self.last_powers = None
+
+    def add_sample(self, ts_ms, powers):
+        """Fold in one snapshot and return (sql, params) upserts for the ledger"""
+        current = [float(powers.get(f'{field}_power') or 0.0) for field in ENERGY_FIELDS]
+        previous_ts, previous = self.last_ts, self.last_powers
+        if previous_ts is not None and ts_ms <= previous_ts:
+            return []
+        self.last_ts, self.last_powers = ts_ms, current
+
+        if previous_ts is None or ts_ms - previous_ts > MAX_GAP_MS:
+            return []
+
+        totals = {}
+        span = ts_ms - previous_ts
+        start, start_powers = previous_ts, previous
+        while start < ts_ms:
+            end = min((start // HOUR_MS + 1) * HOUR_MS, ts_ms)
+            fraction = (end - previous_ts) / span
+            end_powers = [a + (b - a) * fraction for a, b in zip(previous, current)]
+            energy = [(a + b) / 2 * (end - start) / HOUR_MS for a, b in zip(start_powers, end_powers)]
+
+            for period in ENERGY_PERIODS:
+                bucket = start - start % HOUR_MS if period == 'hourly' else battery_db.rollup_bucket('1d', start)
+                entry = totals.setdefault((period, bucket), [0.0] * len(ENERGY_FIELDS) + [0])
+                for index, wh in enumerate(energy):
+                    entry[index] += wh
+                entry[-1] += end - start
+            start, start_powers = end, end_powers
+
+        return [
+            (ENERGY_UPSERT_SQL[period], (bucket, *entry))
+            for (period, bucket), entry in totals.items()
+        ]
+
+
+def prune_energy(conn, now_ms):
+    """Apply each ledger table's retention and return rows deleted per period"""
+    deleted = {}
+    for period, (table, retention_days) in ENERGY_PERIODS.items():
+        if retention_days is None:
+            continue
+        cursor = conn.execute(f'DELETE FROM {table} WHERE period_start < ?', (now_ms - retention_days * 86400000,))
+        deleted[period] = cursor.rowcount
+    return deleted
+
+
+def read_periods(conn, period, start_ms):
+    """Ledger rows from start_ms onwards, oldest first, with derived totals"""
+    table = ENERGY_PERIODS[period][0]
+    rows = conn.execute(f'''
+        SELECT period_start, {', '.join(f'{field}_wh' for field in ENERGY_FIELDS)}, covered_ms
+        FROM {table}
+        WHERE period_start >= ?
+        ORDER BY period_start
+    ''', (start_ms,)).fetchall()
+
+    periods = []
+    for row in rows:
+        entry = {'period_start': battery_db.ms_to_iso(row[0])}
+        entry.update({f'{field}_wh': round(value, 2) for field, value in zip(ENERGY_FIELDS, row[1:-1])})
+        entry['total_input_wh'] = round(entry['ac_input_wh'] + entry['dc_input_wh'], 2)
+        entry['total_output_wh'] = round(entry['ac_output_wh'] + entry['dc_output_wh'], 2)
+        entry['solar_share'] = round(entry['dc_input_wh'] / entry['total_input_wh'], 3) if entry['total_input_wh'] > 0 else None
+        entry['covered_hours'] = round(row[-1] / HOUR_MS, 2)
+        periods.append(entry)
+    return periods
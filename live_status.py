@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Live Status
+Current-status responses built once per change at MQTT ingest time, so the
+polled status routes just hand back pre-encoded bytes
+"""
+
+import json
+import threading
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+from discharge_analysis import format_duration
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+ACTIVITY_KEYS = (
+    'total_battery_percent', 'total_battery_voltage',
+    'ac_output_power', 'dc_output_power', 'ac_input_power', 'dc_input_power'
+)
+BATTERY_KEYS = ('total_battery_percent', 'total_battery_voltage', 'dc_input_power', 'ac_input_power')
+POWER_KEYS = ('ac_output_power', 'dc_output_power', 'ac_input_power', 'dc_input_power', 'power_generation')
+STATUS_KEYS = frozenset(ACTIVITY_KEYS + BATTERY_KEYS + POWER_KEYS)
+
+
+def encode(payload):
+    """JSON bytes as jsonify would send them"""
+    return json.dumps(payload, sort_keys=True, separators=(',', ':')).encode() + b'\n'
+
+
+def activity_status(values, analysis, capacity, session=None):
+    """The /api/activity/current payload for raw MQTT-style values"""
+    activity, session = _stable_activity(values, analysis, capacity, session)
+    return dict(activity, **clock_fields(session))
+
+
+def clock_fields(session, now=None):
+    """The activity fields that change with the clock alone, added when served"""
+    now = now or datetime.now()
+    fields = {'timestamp': now.isoformat()}
+    if session:
+        started_at = datetime.fromisoformat(session['started_at'])
+        fields['current_session'] = dict(
+            session, duration_minutes=int((now - started_at).total_seconds() / 60)
+        )
+    return fields
+
+
+def without_clock_fields(activity):
+    """An activity payload minus the clock_fields values, for telling whether it changed"""
+    stable = {key: value for key, value in activity.items() if key != 'timestamp'}
+    if 'current_session' in stable:
+        stable['current_session'] = {
+            key: value for key, value in stable['current_session'].items() if key != 'duration_minutes'
+        }
+    return stable
+
+
+def _stable_activity(values, analysis, capacity, session):
+    """The activity payload minus clock_fields, and the session to report with it"""
+    battery_percent = float(values.get('total_battery_percent', 0))
+    battery_voltage = float(values.get('total_battery_voltage', 0))
+    ac_output = float(values.get('ac_output_power', 0))
+    dc_output = float(values.get('dc_output_power', 0))
+    ac_input = float(values.get('ac_input_power', 0))
+    dc_input = float(values.get('dc_input_power', 0))
+
+    total_output = ac_output + dc_output
+    is_charging = ac_input > 0 or dc_input > 0
+
+    # Time remaining from the load-profile forecast (more accurate)
+    total_capacity_wh = capacity.capacity_wh
+    remaining_wh = (battery_percent / 100) * total_capacity_wh
+    time_remaining_data = {'hours': None, 'days': None, 'formatted': "∞"}
+    hours = analysis.time_remaining_hours
+    if hours is not None and hours != float('inf'):
+        formatted_time = format_duration(hours)
+        # If charging, prefix with discharge estimate
+        if is_charging:
+            formatted_time = f"~{formatted_time} (discharge)"
+        time_remaining_data = {'hours': hours, 'days': hours / 24, 'formatted': formatted_time}
+
+    activity = {
+        'battery_percent': battery_percent,
+        'battery_voltage': battery_voltage,
+        'total_capacity_wh': total_capacity_wh,
+        'remaining_capacity_wh': remaining_wh,
+        'capacity_confidence': capacity.confidence,
+        'current_output_watts': total_output,
+        'time_remaining': time_remaining_data,
+        'is_charging': is_charging
+    }
+    return activity, session if is_charging else None
+
+
+@dataclass(frozen=True)
+class StatusSnapshot:
+    """One consistent set of status payloads; replaced whole, never modified
+
+    activity and activity_json leave out clock_fields, which would be stale
+    by the time a snapshot is served; use activity_payload()/activity_body().
+    """
+    version: int
+    activity: Optional[dict]
+    activity_json: Optional[bytes]
+    session: Optional[dict]
+    battery_json: bytes
+    power_json: bytes
+
+    def activity_payload(self):
+        if self.activity is None:
+            return None
+        return dict(self.activity, **clock_fields(self.session))
+
+    def activity_body(self):
+        """activity_json with clock_fields spliced in, or None"""
+        if self.activity_json is None:
+            return None
+        # Both halves are JSON objects: drop '}\n' from one and '{' from the other
+        return self.activity_json[:-2] + b',' + encode(clock_fields(self.session))[1:]
+
+
+class LiveStatus:
+    """Keeps the current StatusSnapshot, rebuilt only when its inputs change
+
+    update() is called from the MQTT thread for every message. It rebuilds
+    when one of STATUS_KEYS changes value or the discharge engine publishes
+    a new analysis; anything else costs a dict lookup and the engine's
+    throttled freshness check. Readers take `current` without locking.
+    The open charge session comes from session_lookup, which is only
+    called when charging starts.
+    """
+
+    def __init__(self, engine, session_lookup=None):
+        self._engine = engine
+        self._session_lookup = session_lookup
+        self._lock = threading.Lock()
+        self._values = {}
+        self._analysis = None
+        self._charging = False
+        self._session = None
+        self.current = None
+        self.current = self._build(0)
+
+    def update(self, key, value):
+        with self._lock:
+            changed = key in STATUS_KEYS and self._values.get(key) != value
+            if changed:
+                self._values[key] = value
+            analysis = self._engine.current()
+            if changed or analysis is not self._analysis:
+                self._analysis = analysis
+                self.current = self._build(self.current.version + 1)
+        return self.current
+
+    def _charge_session(self, values):
+        try:
+            charging = float(values.get('ac_input_power', 0)) > 0 or float(values.get('dc_input_power', 0)) > 0
+        except (ValueError, TypeError):
+            return self._session
+        if charging and not self._charging and self._session_lookup:
+            self._session = self._session_lookup()
+        self._charging = charging
+        return self._session if charging else None
+
+    def _build(self, version):
+        values = self._values
+        now = datetime.now().isoformat()
+        battery = {key: values.get(key, 'N/A') for key in BATTERY_KEYS}
+        battery['last_updated'] = now
+        power = {key: values.get(key, 'N/A') for key in POWER_KEYS}
+        power['last_updated'] = now
+
+        activity = session = None
+        if values and self._analysis is not None:
+            try:
+                activity, session = _stable_activity(
+                    values, self._analysis, self._engine.capacity, self._charge_session(values)
+                )
+            except (ValueError, TypeError) as e:
+                logger.debug(f"Skipping current status for unparseable values: {e}")
+                if self.current is not None:
+                    activity, session = self.current.activity, self.current.session
+
+        return StatusSnapshot(
+            version=version,
+            activity=activity,
+            activity_json=encode(activity) if activity is not None else None,
+            session=session,
+            battery_json=encode(battery),
+            power_json=encode(power)
+        )
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Live Stream
+Server-Sent Events fan-out of MQTT field changes and derived status to
+every connected dashboard
+"""
+
+import json
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+MAX_CLIENTS = 32  # further /api/stream connections are refused
+MAX_PENDING = 256  # coalesced updates held per client before it has to resync
+COALESCE_SECONDS = 0.2  # updates arriving this close together go out as one message
+KEEPALIVE_SECONDS = 15  # comment line sent on an idle stream so proxies keep it open
+RETRY_MS = 3000  # reconnect delay suggested to EventSource
+
+
+def format_event(event, data):
+    """One SSE message; data is a JSON-able value or pre-encoded JSON bytes"""
+    if isinstance(data, bytes):
+        data = data.decode().rstrip('\n')
+    else:
+        data = json.dumps(data, separators=(',', ':'))
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+class _Subscriber:
+    """One client's pending updates, latest value per (event, key)
+
+    A slow client never queues more than one value per key: newer values
+    overwrite older ones, so the backlog is bounded by the number of
+    distinct keys, not by the message rate.
+    """
+
+    def __init__(self):
+        self.ready = threading.Condition(threading.Lock())
+        self.pending = OrderedDict()
+        self.lagged = False
+        self.closed = False
+
+    def offer(self, event, key, data):
+        with self.ready:
+            self.pending[(event, key)] = data
+            self.pending.move_to_end((event, key))
+            if len(self.pending) > MAX_PENDING:
+                # Distinct keys beyond the bound; the client starts over from a snapshot
+                self.pending.clear()
+                self.lagged = True
+            self.ready.notify()
+
+    def take(self, timeout):
+        """Wait for updates; returns (updates, lagged), or None once closed"""
+        with self.ready:
+            if not self.pending and not self.lagged and not self.closed:
+                self.ready.wait(timeout)
+            if self.closed:
+                return None
+            updates, self.pending = self.pending, OrderedDict()
+            lagged, self.lagged = self.lagged, False
+            return updates, lagged
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify()
+
+
+class StreamHub:
+    """Publishes updates to every subscriber without ever blocking the publisher
+
+    publish() is called from the MQTT thread and only takes each client's
+    own short lock; the Flask worker serving that client does the encoding
+    and the (possibly slow) socket writes. Field updates are merged into a
+    single 'fields' message; other events send their latest data.
+    """
+
+    def __init__(self, snapshot=None):
+        self._snapshot = snapshot  # callable returning [(event, data)] for a new or lagged client
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    @property
+    def client_count(self):
+        return len(self._subscribers)
+
+    def publish(self, event, data, key=None):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.offer(event, key, data)
+
+    def publish_field(self, key, value):
+        self.publish('fields', value, key=key)
+
+    def subscribe(self):
+        """Register a client; returns None when MAX_CLIENTS are connected"""
+        with self._lock:
+            if len(self._subscribers) >= MAX_CLIENTS:
+                return None
+            subscriber = _Subscriber()
+            self._subscribers.add(subscriber)
+        logger.info(f"Stream client connected ({len(self._subscribers)} connected)")
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        """Drop a client; safe to call more than once"""
+        subscriber.close()
+        with self._lock:
+            if subscriber not in self._subscribers:
+                return
+            self._subscribers.discard(subscriber)
+        logger.info(f"Stream client disconnected ({len(self._subscribers)} connected)")
+
+    def close_all(self):
+        with self._lock:
+            subscribers, self._subscribers = list(self._subscribers), set()
+        for subscriber in subscribers:
+            subscriber.close()
+
+    def _snapshot_messages(self):
+        try:
+            return ''.join(format_event(event, data) for event, data in (self._snapshot() if self._snapshot else []))
+        except Exception as e:
+            logger.warning(f"Error building stream snapshot: {e}")
+            return ''
+
+    def stream(self, subscriber):
+        """Generator of SSE text for one client; unsubscribes when the client goes away"""
+        try:
+            yield f"retry: {RETRY_MS}\n\n" + self._snapshot_messages()
+            while True:
+                result = subscriber.take(KEEPALIVE_SECONDS)
+                if result is None:
+                    return
+                updates, lagged = result
+                if lagged:
+                    yield self._snapshot_messages()
+                    continue
+                if not updates:
+                    yield ": keepalive\n\n"
+                    continue
+
+                # Give a burst of MQTT messages a moment to land in the same write
+                time.sleep(COALESCE_SECONDS)
+                more = subscriber.take(0)
+                if more is None:
+                    return
+                if more[1]:
+                    yield self._snapshot_messages()
+                    continue
+                updates.update(more[0])
+
+                fields = {key: data for (event, key), data in updates.items() if event == 'fields'}
+                messages = [format_event('fields', fields)] if fields else []
+                messages += [format_event(event, data) for (event, key), data in updates.items() if event != 'fields']
+                yield ''.join(messages)
+        finally:
+            self.unsubscribe(subscriber)
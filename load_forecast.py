@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Load Forecast
+Weekday/hour-of-day profile of net power draw, learned from the hourly
+rollups, and a forward simulation of state of charge against it
+"""
+
+import json
+import math
+import logging
+from datetime import timedelta
+import battery_db
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+CELL_HALF_LIFE = 4.0  # observations; a weekday/hour cell sees one a week, so ~4 weeks
+HOUR_HALF_LIFE = 28.0  # observations; an hour-of-day sees one a day, so ~4 weeks
+MIN_CELL_WEIGHT = 2.0  # sparser weekday/hour cells fall back to the hour-of-day profile
+MIN_HOUR_SAMPLES = 30  # hourly buckets with fewer snapshots (logger down) are skipped
+SETTLE_MS = 5 * 60 * 1000  # an hour is folded in once it ended this long ago, after its last group commit
+FORECAST_HORIZON_HOURS = 14 * 24  # ETAs further out are reported as infinity; None means no profile yet
+ALERT_THRESHOLDS = (50, 40, 30, 15, 10, 5)  # percent levels the notifier alerts on
+HOUR_MS = 3600000
+
+LOAD_PROFILE_SAVE_SQL = '''
+    INSERT OR REPLACE INTO estimator_state (name, state, updated_at)
+    VALUES ('load_profile', ?, ?)
+'''
+
+
+def _fold(cell, value, half_life):
+    """Fold one observation into a decayed [weight, mean] cell"""
+    weight = cell[0] * 0.5 ** (1 / half_life) + 1
+    cell[1] += (value - cell[1]) / weight
+    cell[0] = weight
+
+
+class LoadProfile:
+    """Decayed mean net power (output minus input) per weekday and hour
+
+    Each completed hourly rollup bucket is folded into its local
+    weekday/hour cell and its hour-of-day cell exactly once, tracked by the
+    last folded bucket, so updating costs one indexed range read of new
+    buckets. Input power counts against the load, so regular solar hours
+    show up as negative net draw.
+    """
+
+    def __init__(self, state=None):
+        state = state or {}
+        self.last_bucket = state.get('last_bucket')
+        self.cells = state.get('cells') or [[0.0, 0.0] for _ in range(7 * 24)]
+        self.hours = state.get('hours') or [[0.0, 0.0] for _ in range(24)]
+
+    @classmethod
+    def load(cls, conn):
+        """Restore the persisted profile, or start an empty one"""
+        try:
+            row = conn.execute("SELECT state FROM estimator_state WHERE name = 'load_profile'").fetchone()
+        except Exception as e:
+            logger.warning(f"Error loading load profile: {e}")
+            row = None
+        return cls(json.loads(row[0]) if row else None)
+
+    def due(self, now_ms):
+        """Whether an hour has completed since the last update"""
+        settled = battery_db.rollup_bucket('1h', now_ms - SETTLE_MS)
+        return self.last_bucket is None or self.last_bucket + HOUR_MS < settled
+
+    def update(self, conn, now_ms):
+        """Fold in every completed hourly bucket not yet seen; returns how many"""
+        settled = battery_db.rollup_bucket('1h', now_ms - SETTLE_MS)
+        rows = conn.execute(f'''
+            SELECT bucket_start, sample_count,
+                   total_output_power_sum / NULLIF(total_output_power_count, 0),
+                   ac_input_power_sum / NULLIF(ac_input_power_count, 0),
+                   dc_input_power_sum / NULLIF(dc_input_power_count, 0)
+            FROM {battery_db.rollup_table('1h')}
+            WHERE bucket_start > ? AND bucket_start < ?
+            ORDER BY bucket_start
+        ''', (self.last_bucket if self.last_bucket is not None else -1, settled)).fetchall()
+
+        folded = 0
+        for bucket_start, count, output_avg, ac_input_avg, dc_input_avg in rows:
+            self.last_bucket = bucket_start
+            if count < MIN_HOUR_SAMPLES:
+                continue
+            net = (output_avg or 0.0) - (ac_input_avg or 0.0) - (dc_input_avg or 0.0)
+            moment = battery_db.from_ms(bucket_start)
+            _fold(self.cells[moment.weekday() * 24 + moment.hour], net, CELL_HALF_LIFE)
+            _fold(self.hours[moment.hour], net, HOUR_HALF_LIFE)
+            folded += 1
+        if self.last_bucket is None or self.last_bucket < settled - HOUR_MS:
+            # Nothing newer to wait for; later hours start from here
+            self.last_bucket = settled - HOUR_MS
+        return folded
+
+    @property
+    def ready(self):
+        return any(weight > 0 for weight, _ in self.hours)
+
+    def net_power(self, moment):
+        """Expected net draw in watts for the local hour containing moment"""
+        weight, mean = self.cells[moment.weekday() * 24 + moment.hour]
+        if weight >= MIN_CELL_WEIGHT:
+            return mean
+        weight, mean = self.hours[moment.hour]
+        if weight > 0:
+            return mean
+        populated = [(w, m) for w, m in self.hours if w > 0]
+        return sum(w * m for w, m in populated) / sum(w for w, _ in populated)
+
+    def forecast(self, now_ms, battery_percent, capacity_wh, thresholds=ALERT_THRESHOLDS):
+        """Hours until empty and until each threshold below battery_percent
+
+        Steps through the profile hour by hour from now, charging back up to
+        full when the profile shows net input, for at most
+        FORECAST_HORIZON_HOURS. Returns (hours_to_empty, {threshold: hours}):
+        hours_to_empty is None without a profile and infinity when the
+        battery outlasts the horizon; thresholds not reached are None.
+        """
+        if not self.ready or battery_percent is None or capacity_wh <= 0:
+            return None, {}
+
+        targets = sorted((t for t in thresholds if t < battery_percent), reverse=True) + [0]
+        etas = {}
+        remaining_wh = battery_percent / 100 * capacity_wh
+        moment = battery_db.from_ms(now_ms)
+        elapsed = 0.0
+        while targets and elapsed < FORECAST_HORIZON_HOURS:
+            hour_end = moment.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+            step = (hour_end - moment).total_seconds() / 3600
+            net = self.net_power(moment)
+            after_wh = min(remaining_wh - net * step, capacity_wh)
+            while targets and net > 0 and after_wh <= targets[0] / 100 * capacity_wh:
+                target_wh = targets[0] / 100 * capacity_wh
+                etas[targets.pop(0)] = elapsed + (remaining_wh - target_wh) / net
+            remaining_wh = after_wh
+            elapsed += step
+            moment = hour_end
+
+        hours_to_empty = etas.pop(0, math.inf)
+        return hours_to_empty, {t: etas.get(t) for t in thresholds if t < battery_percent}
+
+    def summary(self):
+        """Expected net draw per weekday and hour, for the API"""
+        days = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+        return {
+            day: [round(mean, 1) if weight > 0 else None for weight, mean in self.cells[index * 24:(index + 1) * 24]]
+            for index, day in enumerate(days)
+        }
+
+    def state(self):
+        return {
+            'last_bucket': self.last_bucket,
+            'cells': self.cells,
+            'hours': self.hours
+        }
+
+    def save_params(self):
+        """Parameters for LOAD_PROFILE_SAVE_SQL"""
+        return (json.dumps(self.state()), battery_db.now_ms())
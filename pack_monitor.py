@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Pack Monitor
+Streaming pack-voltage imbalance, drift and sag detection on raw MQTT
+telemetry, without touching the database
+"""
+
+import time
+import threading
+import logging
+from collections import deque
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+PACK_FIELDS = ('pack1_voltage', 'pack2_voltage', 'pack3_voltage')
+STALE_SECONDS = 300  # packs not reported for this long are left out of the spread
+SPREAD_WINDOW_SECONDS = 600  # imbalance is judged on the mean spread over this window
+IMBALANCE_VOLTS = 0.5  # mean spread between the highest and lowest pack that raises an event
+ZSCORE_WINDOW_SECONDS = 3600  # history each pack's offset from the median pack is compared with
+ZSCORE_THRESHOLD = 4.0
+MIN_ZSCORE_SAMPLES = 30  # z-scores need this many readings in the window
+MIN_OFFSET_STD = 0.01  # volts; floor on the offset's spread so a perfectly steady pack isn't flagged for millivolts
+MIN_DRIFT_VOLTS = 0.1  # and must move at least this far from its usual offset
+SAG_WINDOW_SECONDS = 60  # a drop from the highest reading within this window counts as sag
+SAG_VOLTS = 1.0
+LOAD_THRESHOLD_WATTS = 500  # sag is only checked while output is at least this
+EVENT_COOLDOWN_SECONDS = 3600  # the same event for the same pack is raised at most this often
+MAX_EVENTS = 100  # recent events kept for /api/packs/health
+
+
+class SlidingWindow:
+    """Readings from the last `seconds`, with O(1) amortised mean, std, min and max
+
+    Running sums give the mean and variance; monotonic deques give the
+    extremes. Each reading is pushed and expired exactly once.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.values = deque()
+        self.minima = deque()
+        self.maxima = deque()
+        self.total = 0.0
+        self.total_sq = 0.0
+
+    def push(self, ts, value):
+        self.values.append((ts, value))
+        self.total += value
+        self.total_sq += value * value
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((ts, value))
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((ts, value))
+        self.expire(ts)
+
+    def expire(self, now):
+        cutoff = now - self.seconds
+        while self.values and self.values[0][0] < cutoff:
+            _, old = self.values.popleft()
+            self.total -= old
+            self.total_sq -= old * old
+        while self.minima and self.minima[0][0] < cutoff:
+            self.minima.popleft()
+        while self.maxima and self.maxima[0][0] < cutoff:
+            self.maxima.popleft()
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def mean(self):
+        return self.total / len(self.values) if self.values else None
+
+    @property
+    def std(self):
+        count = len(self.values)
+        if count < 2:
+            return None
+        mean = self.total / count
+        return max(self.total_sq / count - mean * mean, 0.0) ** 0.5
+
+    @property
+    def min(self):
+        return self.minima[0][1] if self.minima else None
+
+    @property
+    def max(self):
+        return self.maxima[0][1] if self.maxima else None
+
+
+class PackMonitor:
+    """Per-message detector for pack imbalance, outlying packs and voltage sag
+
+    - imbalance: the spread between the highest and lowest pack, averaged
+      over SPREAD_WINDOW_SECONDS, exceeds IMBALANCE_VOLTS
+    - drift: a pack's offset from the median pack has a rolling
+      z-score beyond ZSCORE_THRESHOLD
+    - sag: under load, a pack falls SAG_VOLTS below its highest reading in
+      the last SAG_WINDOW_SECONDS
+
+    Events go to the on_event callback at most once per
+    EVENT_COOLDOWN_SECONDS for each (kind, pack).
+    """
+
+    def __init__(self, on_event=None):
+        self.on_event = on_event
+        self._lock = threading.Lock()
+        self.latest = {}  # pack field -> (ts, volts)
+        self.output_power = 0.0
+        self.spread = SlidingWindow(SPREAD_WINDOW_SECONDS)
+        self.offsets = {field: SlidingWindow(ZSCORE_WINDOW_SECONDS) for field in PACK_FIELDS}
+        self.recent = {field: SlidingWindow(SAG_WINDOW_SECONDS) for field in PACK_FIELDS}
+        self.zscores = {}
+        self.sags = {}
+        self.events = deque(maxlen=MAX_EVENTS)
+        self._last_raised = {}
+
+    def update(self, key, value, output_power=None, now=None):
+        """Feed one MQTT reading; anything but a pack voltage only updates the load"""
+        if output_power is not None:
+            self.output_power = output_power
+        if key not in PACK_FIELDS:
+            return
+        try:
+            volts = float(value)
+        except (TypeError, ValueError):
+            return
+        if volts <= 0:
+            return
+
+        now = time.time() if now is None else now
+        with self._lock:
+            self.latest[key] = (now, volts)
+            self.recent[key].push(now, volts)
+            fresh = {field: v for field, (ts, v) in self.latest.items() if now - ts <= STALE_SECONDS}
+            events = self._check_sag(key, volts, now)
+            if len(fresh) >= 2:
+                events += self._check_imbalance(fresh, now)
+                events += self._check_offset(key, volts, fresh, now)
+
+        for event in events:
+            self._raise(event)
+
+    def _check_sag(self, key, volts, now):
+        peak = self.recent[key].max
+        sag = peak - volts if peak is not None else 0.0
+        self.sags[key] = sag
+        if self.output_power >= LOAD_THRESHOLD_WATTS and sag >= SAG_VOLTS:
+            return [self._event('sag', key, now, sag_volts=round(sag, 3), volts=volts,
+                                output_power=self.output_power)]
+        return []
+
+    def _check_imbalance(self, fresh, now):
+        spread = max(fresh.values()) - min(fresh.values())
+        self.spread.push(now, spread)
+        if self.spread.mean >= IMBALANCE_VOLTS:
+            low = min(fresh, key=fresh.get)
+            return [self._event('imbalance', low, now, spread_volts=round(spread, 3),
+                                mean_spread_volts=round(self.spread.mean, 3))]
+        return []
+
+    def _check_offset(self, key, volts, fresh, now):
+        # Against the median, so one pack moving doesn't shift the others' offsets
+        ordered = sorted(fresh.values())
+        middle = len(ordered) // 2
+        median = ordered[middle] if len(ordered) % 2 else (ordered[middle - 1] + ordered[middle]) / 2
+        offset = volts - median
+        window = self.offsets[key]
+        zscore = None
+        drifting = False
+        if len(window) >= MIN_ZSCORE_SAMPLES:
+            deviation = offset - window.mean
+            zscore = deviation / max(window.std, MIN_OFFSET_STD)
+            drifting = abs(zscore) >= ZSCORE_THRESHOLD and abs(deviation) >= MIN_DRIFT_VOLTS
+        window.push(now, offset)
+        self.zscores[key] = zscore
+        if drifting:
+            return [self._event('drift', key, now, zscore=round(zscore, 2), offset_volts=round(offset, 3))]
+        return []
+
+    def _event(self, kind, field, now, **details):
+        return dict(kind=kind, pack=PACK_FIELDS.index(field) + 1, timestamp=now, **details)
+
+    def _raise(self, event):
+        key = (event['kind'], event['pack'])
+        with self._lock:
+            last = self._last_raised.get(key)
+            if last is not None and event['timestamp'] - last < EVENT_COOLDOWN_SECONDS:
+                return
+            self._last_raised[key] = event['timestamp']
+            self.events.append(event)
+        logger.warning(f"Pack {event['pack']} {event['kind']} detected: {event}")
+        if self.on_event:
+            try:
+                self.on_event(event)
+            except Exception as e:
+                logger.error(f"Error handling pack event: {e}")
+
+    def health(self, now=None):
+        """Snapshot of every pack and the spread, plus recent events"""
+        now = time.time() if now is None else now
+        with self._lock:
+            packs = []
+            for index, field in enumerate(PACK_FIELDS, start=1):
+                ts, volts = self.latest.get(field, (None, None))
+                window = self.offsets[field]
+                packs.append({
+                    'pack': index,
+                    'voltage': volts,
+                    'age_seconds': round(now - ts, 1) if ts is not None else None,
+                    'offset_volts': round(window.values[-1][1], 3) if len(window) else None,
+                    'offset_zscore': round(self.zscores[field], 2) if self.zscores.get(field) is not None else None,
+                    'sag_volts': round(self.sags.get(field, 0.0), 3)
+                })
+            recent_events = [dict(event) for event in self.events]
+            spread = {
+                'current_volts': round(self.spread.values[-1][1], 3) if len(self.spread) else None,
+                'mean_volts': round(self.spread.mean, 3) if len(self.spread) else None,
+                'max_volts': round(self.spread.max, 3) if len(self.spread) else None,
+                'window_seconds': SPREAD_WINDOW_SECONDS
+            }
+            output_power = self.output_power
+
+        active = [event for event in recent_events if now - event['timestamp'] < EVENT_COOLDOWN_SECONDS]
+        for event in recent_events:
+            event['timestamp'] = datetime.fromtimestamp(event['timestamp']).isoformat()
+        return {
+            'status': 'warning' if active else 'ok',
+            'packs': packs,
+            'spread': spread,
+            'output_power': output_power,
+            'events': recent_events
+        }
+
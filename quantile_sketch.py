@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Quantile Sketches
+Hourly DDSketch-style histograms of power and voltage readings, merged over
+any range to answer percentiles without reading raw snapshots
+"""
+
+import math
+import struct
+import logging
+import threading
+import battery_db
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+MAX_BINS = 512  # beyond this the lowest bins are collapsed together
+MIN_VALUE = 0.001  # readings below this are counted as zero
+SKETCH_FIELDS = {  # field -> relative accuracy of its quantiles
+    'total_output_power': 0.01,
+    'total_input_power': 0.01,
+    'battery_voltage': 0.0005,  # ~0.03V at 52V
+    'pack1_voltage': 0.0005,
+    'pack2_voltage': 0.0005,
+    'pack3_voltage': 0.0005
+}
+SKETCH_RETENTION_DAYS = battery_db.ROLLUP_RESOLUTIONS['1h'][1]  # same as the hourly rollup
+DEFAULT_QUANTILES = (0.5, 0.95, 0.99)
+HOUR_MS = 3600000
+
+HEADER = struct.Struct('<dIIddd')  # relative accuracy, count, zero count, min, max, sum
+
+SKETCH_UPSERT_SQL = '''
+    INSERT OR REPLACE INTO quantile_sketches (hour_start, field, sketch)
+    VALUES (?, ?, ?)
+'''
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class QuantileSketch:
+    """DDSketch: counts in logarithmically spaced bins
+
+    A reading x lands in bin ceil(log_gamma(x)), and the bin's midpoint is
+    within relative_accuracy of every reading in it, so quantiles carry the
+    same relative error whatever the range. Merging adds bin counts, so an
+    hour's sketch merged with another is exactly the sketch of both hours.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sum = 0.0
+
+    def add(self, value):
+        if value is None or value != value:
+            return
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value < MIN_VALUE:
+            self.zero_count += 1
+            return
+        index = math.ceil(math.log(value) / self.log_gamma)
+        self.bins[index] = self.bins.get(index, 0) + 1
+        if len(self.bins) > MAX_BINS:
+            self._collapse()
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can't merge sketches with different accuracy")
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if len(self.bins) > MAX_BINS:
+            self._collapse()
+        return self
+
+    def _collapse(self):
+        indexes = sorted(self.bins)
+        keep = indexes[len(indexes) - MAX_BINS]
+        for index in indexes[:len(indexes) - MAX_BINS]:
+            self.bins[keep] += self.bins.pop(index)
+
+    def quantile(self, q):
+        """Value at quantile q (0-1), or None for an empty sketch"""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero_count:
+            return max(self.min, 0.0)
+        seen = self.zero_count
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self, quantiles=DEFAULT_QUANTILES):
+        if self.count == 0:
+            return {'count': 0}
+        result = {
+            'count': self.count,
+            'min': round(self.min, 3),
+            'max': round(self.max, 3),
+            'mean': round(self.sum / self.count, 3)
+        }
+        for q in quantiles:
+            result[f'p{q * 100:g}'] = round(self.quantile(q), 3)
+        return result
+
+    def to_bytes(self):
+        """Header, then (index delta, count) varint pairs in index order"""
+        out = bytearray(HEADER.pack(self.relative_accuracy, self.count, self.zero_count, self.min, self.max, self.sum))
+        previous = None
+        for index in sorted(self.bins):
+            if previous is None:
+                _write_varint(out, (index << 1) ^ (index >> 63))  # zigzag, the first index can be negative
+            else:
+                _write_varint(out, index - previous)
+            _write_varint(out, self.bins[index])
+            previous = index
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data):
+        relative_accuracy, *header = HEADER.unpack_from(data)
+        sketch = cls(relative_accuracy)
+        sketch.count, sketch.zero_count, sketch.min, sketch.max, sketch.sum = header
+        position = HEADER.size
+        index = None
+        while position < len(data):
+            value, position = _read_varint(data, position)
+            index = (value >> 1) ^ -(value & 1) if index is None else index + value
+            sketch.bins[index], position = _read_varint(data, position)
+        return sketch
+
+
+def reading(values, field):
+    """A snapshot's value for a sketch field; input power is AC plus DC"""
+    if field == 'total_input_power':
+        return (values.get('ac_input_power') or 0.0) + (values.get('dc_input_power') or 0.0)
+    return values.get(field)
+
+
+class HourlySketches:
+    """The current hour's sketch per field
+
+    The hour's rows are written once when the next hour starts, and by
+    save_rows(), which the logger runs once per write-buffer flush (and so
+    on shutdown) so a restart carries on from the hour so far. add() runs
+    on the snapshot thread and save_rows() on the flush thread.
+    """
+
+    def __init__(self):
+        self.hour_start = None
+        self.sketches = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def load(self, conn, ts_ms):
+        """Resume the hour containing ts_ms from the database"""
+        with self._lock:
+            self.hour_start = ts_ms - ts_ms % HOUR_MS
+            self.sketches = read_hour(conn, self.hour_start)
+            self._dirty = False
+
+    def add(self, ts_ms, values):
+        """Fold one snapshot in; returns the finished hour's upserts when ts_ms starts a new hour"""
+        hour_start = ts_ms - ts_ms % HOUR_MS
+        with self._lock:
+            rows = []
+            if hour_start != self.hour_start:
+                if self._dirty:
+                    rows = self._rows()
+                self.hour_start = hour_start
+                self.sketches = {}
+            for field, accuracy in SKETCH_FIELDS.items():
+                sketch = self.sketches.get(field)
+                if sketch is None:
+                    sketch = self.sketches[field] = QuantileSketch(accuracy)
+                sketch.add(reading(values, field))
+            self._dirty = True
+            return rows
+
+    def save_rows(self):
+        """Upserts for the current hour's sketches, if they changed since the last call"""
+        with self._lock:
+            if not self._dirty:
+                return []
+            self._dirty = False
+            return self._rows()
+
+    def _rows(self):
+        return [(SKETCH_UPSERT_SQL, (self.hour_start, field, sketch.to_bytes())) for field, sketch in self.sketches.items()]
+
+
+def create_sketch_table(cursor):
+    """Create the sketch table, backfilling it from raw snapshots if it is new
+
+    Call after migrate(), like create_rollup_tables.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='quantile_sketches'")
+    if cursor.fetchone():
+        return
+
+    cursor.execute('''
+        CREATE TABLE quantile_sketches (
+            hour_start INTEGER NOT NULL,
+            field TEXT NOT NULL,
+            sketch BLOB NOT NULL,
+            PRIMARY KEY (hour_start, field)
+        ) WITHOUT ROWID
+    ''')
+
+    columns = ('ac_input_power', 'dc_input_power') + tuple(f for f in SKETCH_FIELDS if f != 'total_input_power')
+    hours = {}
+    for row in cursor.execute(f'SELECT timestamp, {", ".join(columns)} FROM battery_snapshots').fetchall():
+        values = dict(zip(columns, row[1:]))
+        sketches = hours.setdefault(row[0] - row[0] % HOUR_MS, {})
+        for field, accuracy in SKETCH_FIELDS.items():
+            if field not in sketches:
+                sketches[field] = QuantileSketch(accuracy)
+            sketches[field].add(reading(values, field))
+    cursor.executemany(SKETCH_UPSERT_SQL, [
+        (hour_start, field, sketch.to_bytes())
+        for hour_start, sketches in hours.items()
+        for field, sketch in sketches.items()
+    ])
+    logger.info(f"Created quantile_sketches ({len(hours)} hours backfilled)")
+
+
+def read_hour(conn, hour_start):
+    rows = conn.execute('SELECT field, sketch FROM quantile_sketches WHERE hour_start = ?', (hour_start,)).fetchall()
+    return {field: QuantileSketch.from_bytes(blob) for field, blob in rows}
+
+
+def merge_range(conn, start_ms, end_ms=None, fields=SKETCH_FIELDS):
+    """One merged sketch per field over the hours from start_ms up to end_ms"""
+    merged = {field: QuantileSketch(SKETCH_FIELDS[field]) for field in fields}
+    params = [start_ms - start_ms % HOUR_MS] + ([end_ms] if end_ms is not None else []) + list(merged)
+    for field, blob in conn.execute(f'''
+        SELECT field, sketch FROM quantile_sketches
+        WHERE hour_start >= ? {'AND hour_start < ?' if end_ms is not None else ''}
+        AND field IN ({', '.join('?' * len(merged))})
+    ''', params):
+        merged[field].merge(QuantileSketch.from_bytes(blob))
+    return merged
+
+
+def prune_sketches(conn, now_ms):
+    cursor = conn.execute('DELETE FROM quantile_sketches WHERE hour_start < ?',
+                          (now_ms - SKETCH_RETENTION_DAYS * 86400000,))
+    return cursor.rowcount
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+History Reprocessing
+Rebuilds charge sessions, discharge rows, rollups, quantile sketches and the
+energy ledger from raw snapshots, using the same code as the logger
+"""
+
+import json
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta
+import battery_db
+import battery_settings
+import snapshot_archive
+from charge_sessions import ChargeSessionTracker, CHARGE_SESSION_INSERT_SQL
+from discharge_estimator import DischargeEstimator, ESTIMATOR_WINDOWS
+from discharge_analysis import DISCHARGE_INSERT_SQL, discharge_row
+from quantile_sketch import QuantileSketch, SKETCH_FIELDS, SKETCH_UPSERT_SQL, HOUR_MS, create_sketch_table, reading
+from energy_ledger import EnergyLedger, ENERGY_PERIODS, MAX_GAP_MS, create_energy_tables
+
+# Setup logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Configuration
+CHUNK_ROWS = 20000  # snapshots rebuilt per transaction
+FETCH_ROWS = 5000  # rows fetched at a time from a partition
+WARMUP_HOURS = max(ESTIMATOR_WINDOWS.values())  # replayed before the start, without writing, to prime the estimator
+STATE_NAME = 'reprocess'  # estimator_state row holding the resume point
+SNAPSHOT_FIELDS = snapshot_archive.ARCHIVE_FIELDS  # live and archived rows are read in the same shape
+
+
+def _day_start_ms(day):
+    return battery_db.to_ms(datetime.combine(day, datetime.min.time()))
+
+
+def stream_snapshots(conn, start_ms, end_ms):
+    """Yield (timestamp, *SNAPSHOT_FIELDS) rows with start_ms <= timestamp < end_ms, oldest first
+
+    Days no longer in SQLite are decoded from the archive one day at a time;
+    partitions are read with fetchmany, so memory stays flat however long
+    the range is.
+    """
+    live_start = snapshot_archive.oldest_live_ms(conn)
+    if live_start is None or start_ms < live_start:
+        archive_end = end_ms if live_start is None else min(end_ms, live_start)
+        for day in snapshot_archive.archived_days():
+            day_start = max(_day_start_ms(day), start_ms)
+            day_end = min(_day_start_ms(day + timedelta(days=1)), archive_end)
+            if day_start < day_end:
+                yield from snapshot_archive.read_rows(day_start, day_end)
+
+    for day, name in battery_db.list_partitions(conn, 'battery_snapshots'):
+        if _day_start_ms(day + timedelta(days=1)) <= start_ms or _day_start_ms(day) >= end_ms:
+            continue
+        cursor = conn.execute(f'''
+            SELECT timestamp, {', '.join(SNAPSHOT_FIELDS)}
+            FROM {name}
+            WHERE timestamp >= ? AND timestamp < ?
+            ORDER BY timestamp
+        ''', (start_ms, end_ms))
+        while True:
+            rows = cursor.fetchmany(FETCH_ROWS)
+            if not rows:
+                break
+            yield from rows
+
+
+class RollupAccumulator:
+    """Folds snapshots into per-bucket min/max/sum/count in memory
+
+    Rows only go into the finest buckets; coarser ones are merged from
+    those when drained, and written with one upsert per bucket per chunk
+    instead of the live path's upsert per snapshot. NULL readings are
+    skipped, as in the SQL backfill.
+    """
+
+    def __init__(self):
+        resolutions = list(battery_db.ROLLUP_RESOLUTIONS)
+        self.finest, self.coarser = resolutions[0], resolutions[1:]
+        self.bucket_ms = battery_db.ROLLUP_RESOLUTIONS[self.finest][0] * 1000
+        self.buckets = {}
+
+    def add(self, ts_ms, values):
+        bucket = ts_ms - ts_ms % self.bucket_ms
+        entry = self.buckets.get(bucket)
+        if entry is None:
+            entry = self.buckets[bucket] = [0, 0] + [None, None, None, 0] * len(battery_db.ROLLUP_FIELDS)
+        entry[0] += 1
+        if (values['total_output_power'] or 0) > 0:
+            entry[1] += 1
+        position = 2
+        for field in battery_db.ROLLUP_FIELDS:
+            value = values[field]
+            if value is not None:
+                if entry[position] is None:
+                    entry[position] = entry[position + 1] = entry[position + 2] = value
+                else:
+                    if value < entry[position]:
+                        entry[position] = value
+                    if value > entry[position + 1]:
+                        entry[position + 1] = value
+                    entry[position + 2] += value
+                entry[position + 3] += 1
+            position += 4
+
+    @staticmethod
+    def _merge(target, entry):
+        target[0] += entry[0]
+        target[1] += entry[1]
+        for position in range(2, len(entry), 4):
+            if entry[position] is None:
+                continue
+            if target[position] is None:
+                target[position:position + 4] = entry[position:position + 4]
+            else:
+                target[position] = min(target[position], entry[position])
+                target[position + 1] = max(target[position + 1], entry[position + 1])
+                target[position + 2] += entry[position + 2]
+                target[position + 3] += entry[position + 3]
+
+    def drain(self):
+        """(sql, params) upserts for everything folded so far"""
+        rows = [(battery_db.ROLLUP_UPSERT_SQL[self.finest], (bucket, *entry)) for bucket, entry in self.buckets.items()]
+        # Each resolution is merged from the one below it, since buckets nest
+        finer = self.buckets
+        for resolution in self.coarser:
+            merged = {}
+            for bucket, entry in finer.items():
+                target = merged.get(battery_db.rollup_bucket(resolution, bucket))
+                if target is None:
+                    merged[battery_db.rollup_bucket(resolution, bucket)] = list(entry)
+                else:
+                    self._merge(target, entry)
+            rows += [(battery_db.ROLLUP_UPSERT_SQL[resolution], (bucket, *entry)) for bucket, entry in merged.items()]
+            finer = merged
+        self.buckets = {}
+        return rows
+
+
+class HistoryReprocessor:
+    """Replays snapshots from start_ms to end_ms through the live derivation code
+
+    Each chunk covers the time range [cursor, next cursor). Its transaction
+    deletes the derived rows in that range, writes the rebuilt ones and
+    saves the replay state, so an interrupted run resumes from the last
+    committed chunk. Rollup and ledger buckets are deleted by the chunk
+    their start falls in, which is always the first chunk to touch them.
+    """
+
+    def __init__(self, start_ms, end_ms, state=None):
+        state = state or {}
+        self.start_ms = start_ms
+        self.end_ms = end_ms
+        self.cursor_ms = state.get('cursor_ms', start_ms)
+        self.rows_done = state.get('rows_done', 0)
+        self.interval_ms = state.get('interval_ms', battery_settings.SettingsCache().discharge_interval() * 60000)
+        self.last_logged_ms = state.get('last_logged_ms')
+        self.tracker = ChargeSessionTracker(state.get('tracker'))
+        self.estimator = DischargeEstimator(state.get('estimator'))
+        self.ledger = EnergyLedger()
+        self.ledger.last_ts, self.ledger.last_powers = state.get('ledger', (None, None))
+        self._reset_chunk()
+
+    @classmethod
+    def load(cls, conn):
+        """Restore an interrupted run, or None if there isn't one"""
+        row = conn.execute('SELECT state FROM estimator_state WHERE name = ?', (STATE_NAME,)).fetchone()
+        if not row:
+            return None
+        state = json.loads(row[0])
+        return cls(state['start_ms'], state['end_ms'], state)
+
+    def state(self):
+        return {
+            'start_ms': self.start_ms,
+            'end_ms': self.end_ms,
+            'cursor_ms': self.cursor_ms,
+            'rows_done': self.rows_done,
+            'interval_ms': self.interval_ms,
+            'last_logged_ms': self.last_logged_ms,
+            'tracker': self.tracker.state(),
+            'estimator': self.estimator.state(),
+            'ledger': (self.ledger.last_ts, self.ledger.last_powers)
+        }
+
+    def _reset_chunk(self):
+        self.rollups = RollupAccumulator()
+        self.energy = {}
+        self.sketches = {}
+        self.charge_rows = []
+        self.discharge_rows = []
+        self.chunk_rows = 0
+
+    def _replay(self, row):
+        """Run one snapshot through every live derivation"""
+        ts_ms = row[0]
+        values = dict(zip(SNAPSHOT_FIELDS, row[1:]))
+        ac_input = values['ac_input_power'] or 0.0
+        dc_input = values['dc_input_power'] or 0.0
+        battery_percent = values['battery_percent'] or 0.0
+        output_power = values['total_output_power'] or 0.0
+        writing = self.cursor_ms <= ts_ms < self.end_ms
+
+        # The ledger integrates the interval ending at this row, which can
+        # belong to the range even when the row itself is past its end
+        for sql, params in self.ledger.add_sample(ts_ms, values):
+            if self.start_ms <= params[0] < self.end_ms:
+                entry = self.energy.setdefault((sql, params[0]), [0.0] * (len(params) - 1))
+                for index, value in enumerate(params[1:]):
+                    entry[index] += value
+        if ts_ms >= self.end_ms:
+            return
+
+        self.estimator.update(ts_ms, battery_percent, output_power, ac_input > 0 or dc_input > 0)
+        session = self.tracker.update(ts_ms, ac_input, dc_input, battery_percent, output_power)
+        if not writing:
+            return
+
+        self.chunk_rows += 1
+        self.rollups.add(ts_ms, values)
+        hour_start = ts_ms - ts_ms % HOUR_MS
+        for field, accuracy in SKETCH_FIELDS.items():
+            sketch = self.sketches.get((hour_start, field))
+            if sketch is None:
+                sketch = self.sketches[(hour_start, field)] = QuantileSketch(accuracy)
+            sketch.add(reading(values, field))
+        if session and session.worth_saving():
+            self.charge_rows.append(session.insert_params())
+        if self.last_logged_ms is None or ts_ms - self.last_logged_ms >= self.interval_ms:
+            self.discharge_rows.append(discharge_row(
+                self.estimator, ts_ms, battery_percent, values['battery_voltage'] or 0.0, output_power
+            ))
+            self.last_logged_ms = ts_ms
+
+    def _commit_chunk(self, chunk_end_ms):
+        """Swap the derived rows in [cursor, chunk_end_ms) for the rebuilt ones"""
+        lo, hi = self.cursor_ms, chunk_end_ms
+        with battery_db.transaction() as conn:
+            for resolution in battery_db.ROLLUP_RESOLUTIONS:
+                conn.execute(f'DELETE FROM {battery_db.rollup_table(resolution)} WHERE bucket_start >= ? AND bucket_start < ?', (lo, hi))
+            for table, _ in ENERGY_PERIODS.values():
+                conn.execute(f'DELETE FROM {table} WHERE period_start >= ? AND period_start < ?', (lo, hi))
+            conn.execute('DELETE FROM quantile_sketches WHERE hour_start >= ? AND hour_start < ?', (lo, hi))
+            conn.execute('DELETE FROM charge_sessions WHERE end_time >= ? AND end_time < ?', (lo, hi))
+            for _, name in battery_db.list_partitions(conn, 'discharge_sessions'):
+                conn.execute(f"DELETE FROM {name} WHERE timestamp >= ? AND timestamp < ? AND session_type = 'discharge'", (lo, hi))
+
+            for sql, params in self.rollups.drain():
+                conn.execute(sql, params)
+            for (sql, bucket), entry in self.energy.items():
+                conn.execute(sql, (bucket, *entry))
+            for (hour_start, field), sketch in self.sketches.items():
+                # An hour that began in an earlier chunk already holds that chunk's readings
+                if hour_start < lo:
+                    row = conn.execute('SELECT sketch FROM quantile_sketches WHERE hour_start = ? AND field = ?',
+                                       (hour_start, field)).fetchone()
+                    if row:
+                        sketch.merge(QuantileSketch.from_bytes(row[0]))
+                conn.execute(SKETCH_UPSERT_SQL, (hour_start, field, sketch.to_bytes()))
+            conn.executemany(CHARGE_SESSION_INSERT_SQL, self.charge_rows)
+            by_day = {}
+            for row in self.discharge_rows:
+                by_day.setdefault(battery_db.from_ms(row[0]).date(), []).append(row)
+            for day, rows in by_day.items():
+                partition = battery_db.ensure_partition(conn, 'discharge_sessions', day)
+                conn.executemany(DISCHARGE_INSERT_SQL.format(table=partition), rows)
+
+            self.rows_done += self.chunk_rows
+            self.cursor_ms = hi
+            conn.execute('INSERT OR REPLACE INTO estimator_state (name, state, updated_at) VALUES (?, ?, ?)',
+                         (STATE_NAME, json.dumps(self.state()), battery_db.now_ms()))
+        self._reset_chunk()
+
+    def run(self, warmup_hours=WARMUP_HOURS):
+        """Process everything from the cursor to end_ms and return the rows processed"""
+        started = time.monotonic()
+        resumed_rows = self.rows_done
+        # A fresh run primes the estimator, charge tracker and ledger with
+        # the history just before the range; a resumed one restored them
+        replay_from = self.cursor_ms
+        if self.cursor_ms == self.start_ms and self.estimator.last_ts is None:
+            replay_from -= warmup_hours * 3600000
+            with battery_db.connection() as conn:
+                self.last_logged_ms = self._last_discharge_before(conn, self.start_ms)
+
+        conn = battery_db.open_connection()
+        try:
+            for row in stream_snapshots(conn, replay_from, self.end_ms + MAX_GAP_MS):
+                self._replay(row)
+                if self.chunk_rows >= CHUNK_ROWS:
+                    self._commit_chunk(row[0] + 1)
+                    self._report(started, resumed_rows)
+        finally:
+            conn.close()
+
+        self._commit_chunk(self.end_ms)
+        with battery_db.transaction() as conn:
+            conn.execute('DELETE FROM estimator_state WHERE name = ?', (STATE_NAME,))
+        self._report(started, resumed_rows)
+        return self.rows_done
+
+    def _last_discharge_before(self, conn, ts_ms):
+        row = conn.execute('''
+            SELECT MAX(timestamp) FROM discharge_sessions
+            WHERE timestamp < ? AND session_type = 'discharge'
+        ''', (ts_ms,)).fetchone()
+        return row[0] if row else None
+
+    def _report(self, started, resumed_rows):
+        elapsed = time.monotonic() - started
+        rate = (self.rows_done - resumed_rows) / elapsed if elapsed > 0 else 0.0
+        span = self.end_ms - self.start_ms
+        progress = (self.cursor_ms - self.start_ms) / span * 100 if span > 0 else 100.0
+        logger.info(f"Reprocessed {self.rows_done} snapshots up to {battery_db.ms_to_iso(self.cursor_ms)} "
+                    f"({progress:.1f}%, {rate:.0f} rows/s)")
+
+
+def default_range(conn, days=None):
+    """(start, end) in epoch ms: local midnights, ending at the start of today
+
+    Today is left alone so the running logger's buckets and open session
+    are never touched.
+    """
+    end_ms = _day_start_ms(datetime.now().date())
+    if days is not None:
+        return _day_start_ms(datetime.now().date() - timedelta(days=days)), end_ms
+
+    first_days = snapshot_archive.archived_days()[:1] + [day for day, _ in battery_db.list_partitions(conn, 'battery_snapshots')[:1]]
+    start_ms = _day_start_ms(min(first_days)) if first_days else end_ms
+    return start_ms, end_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild derived tables from raw battery snapshots')
+    parser.add_argument('--days', type=int, help='only reprocess this many days before today (default: all history)')
+    parser.add_argument('--restart', action='store_true', help='discard an interrupted run instead of resuming it')
+    args = parser.parse_args()
+
+    battery_db.migrate()
+    with battery_db.transaction() as conn:
+        battery_db.create_rollup_tables(conn.cursor())
+        create_energy_tables(conn.cursor())
+        create_sketch_table(conn.cursor())
+    # Charge session starts would otherwise be logged for every replayed session
+    logging.getLogger('charge_sessions').setLevel(logging.WARNING)
+
+    with battery_db.connection() as conn:
+        reprocessor = None if args.restart else HistoryReprocessor.load(conn)
+        if reprocessor:
+            logger.info(f"Resuming reprocessing from {battery_db.ms_to_iso(reprocessor.cursor_ms)}")
+        else:
+            start_ms, end_ms = default_range(conn, args.days)
+            reprocessor = HistoryReprocessor(start_ms, end_ms)
+            logger.info(f"Reprocessing snapshots from {battery_db.ms_to_iso(start_ms)} to {battery_db.ms_to_iso(end_ms)}")
+
+    rows = reprocessor.run()
+    logger.info(f"Reprocessing complete: {rows} snapshots")
+
+
+if __name__ == "__main__":
+    main()
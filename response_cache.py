@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Response Cache
+Rendered GET responses kept per route and query string until the database
+changes, served with strong ETags so repeat polls can get a 304
+"""
+
+import time
+import hashlib
+import threading
+import functools
+import logging
+from collections import OrderedDict
+from flask import request, make_response
+import battery_db
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+CACHE_POLL_INTERVAL = 1.0  # seconds between PRAGMA data_version checks
+CACHE_MAX_AGE = 60  # seconds; relative windows ("last 24h") slide even when nothing is written
+CACHE_MAX_ENTRIES = 256  # least recently used responses beyond this are dropped
+
+
+class _Entry:
+    __slots__ = ('version', 'created', 'body', 'etag', 'mimetype')
+
+    def __init__(self, version, created, body, mimetype=None, etag=None):
+        self.version = version
+        self.created = created
+        self.body = body
+        self.etag = etag
+        self.mimetype = mimetype
+
+
+class ResponseCache:
+    """Write-versioned cache of successful JSON responses
+
+    The version is a counter bumped whenever a DataVersionWatcher sees a
+    commit from any connection, which covers the logger's group commits and
+    the API's own writes. A cached body is reused while the version (plus
+    the route's optional extra version) is unchanged and it is younger than
+    CACHE_MAX_AGE. Serving a hit, or a 304 for a matching If-None-Match,
+    costs a dict lookup and at most one throttled PRAGMA.
+    """
+
+    def __init__(self, poll_interval=CACHE_POLL_INTERVAL, max_age=CACHE_MAX_AGE, max_entries=CACHE_MAX_ENTRIES):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._watcher = battery_db.DataVersionWatcher(poll_interval)
+        self._version = 0
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def version(self):
+        """Current write version"""
+        with self._lock:
+            try:
+                if self._watcher.changed():
+                    self._version += 1
+            except Exception as e:
+                # Can't tell whether anything changed, so nothing cached can be trusted
+                self._watcher.reset()
+                self._version += 1
+                logger.warning(f"Error checking data version: {e}")
+            return self._version
+
+    def _lookup(self, key, version, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version or now - entry.created > self.max_age:
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'version': self._version}
+
+    def value(self, key, build, extra_version=None):
+        """Cached result of build() under the same write version as the responses
+
+        For composing several cached payloads into one response; values are
+        shared between callers, so treat them as read-only.
+        """
+        version = self.version()
+        if extra_version is not None:
+            version = (version, extra_version)
+        now = time.time()
+
+        entry = self._lookup(key, version, now)
+        if entry is None:
+            entry = _Entry(version, now, build())
+            self._store(key, entry)
+        return entry.body
+
+    def cached(self, extra_version=None):
+        """Decorator for GET routes whose body depends only on the database and query args
+
+        extra_version, if given, is called per request and folded into the
+        version, for routes that also read something outside SQLite.
+        Streamed responses pass through uncached.
+        """
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                version = self.version()
+                if extra_version is not None:
+                    version = (version, extra_version())
+                key = (request.path, tuple(sorted(request.args.items(multi=True))))
+                now = time.time()
+
+                entry = self._lookup(key, version, now)
+                if entry is None:
+                    response = make_response(view(*args, **kwargs))
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    body = response.get_data()
+                    entry = _Entry(version, now, body, response.mimetype, hashlib.sha1(body).hexdigest())
+                    self._store(key, entry)
+
+                response = make_response(entry.body)
+                response.mimetype = entry.mimetype
+                response.set_etag(entry.etag)
+                response.last_modified = int(entry.created)
+                response.headers['Cache-Control'] = 'no-cache'
+                return response.make_conditional(request)
+            return wrapper
+        return decorator
+
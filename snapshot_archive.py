@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Snapshot Archive
+Compressed columnar files holding battery snapshots after their day
+partition has been dropped from SQLite
+"""
+
+import os
+import zlib
+import struct
+import logging
+from itertools import accumulate
+from datetime import datetime
+import battery_db
+
+try:
+    import numpy as np
+except ImportError:  # Pure-Python decoding is slower but gives the same result
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+ARCHIVE_DIR = os.path.join(battery_db.DATA_DIR, "archive")
+BLOCK_ROWS = 1440  # rows per block (12 hours at the snapshot interval)
+COMPRESSION_LEVEL = 9
+
+# Archived after the timestamp, in this order, as float64 (NULL becomes NaN)
+ARCHIVE_FIELDS = (
+    'battery_percent', 'battery_voltage',
+    'ac_output_power', 'dc_output_power', 'total_output_power',
+    'ac_input_power', 'dc_input_power', 'time_remaining_hours',
+    'pack1_voltage', 'pack2_voltage', 'pack3_voltage'
+)
+
+# File layout: header, blocks, block index, trailer. Each block is a table
+# of compressed column lengths followed by the columns themselves.
+MAGIC = b'BLTARC01'
+VERSION = 1
+HEADER = struct.Struct('<8sHH')  # magic, version, field count
+INDEX_ENTRY = struct.Struct('<qqIQI')  # first ts, last ts, rows, offset, length
+TRAILER = struct.Struct('<QI8s')  # index offset, block count, magic
+
+
+def archive_path(day):
+    return os.path.join(ARCHIVE_DIR, f"snapshots_{day.strftime('%Y%m%d')}.bca")
+
+
+def archived_days():
+    """Days that have an archive file, oldest first"""
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    days = []
+    for name in os.listdir(ARCHIVE_DIR):
+        if name.startswith('snapshots_') and name.endswith('.bca'):
+            try:
+                days.append(datetime.strptime(name[10:18], '%Y%m%d').date())
+            except ValueError:
+                continue
+    return sorted(days)
+
+
+def _shuffle(raw):
+    """Group the n-th byte of every 8-byte value together so zlib sees long runs"""
+    if np is not None:
+        return np.frombuffer(raw, dtype=np.uint8).reshape(-1, 8).T.tobytes()
+    return b''.join(raw[i::8] for i in range(8))
+
+
+def _unshuffle(raw):
+    if np is not None:
+        return np.frombuffer(raw, dtype=np.uint8).reshape(8, -1).T.tobytes()
+    count = len(raw) // 8
+    planes = [raw[i * count:(i + 1) * count] for i in range(8)]
+    return bytes(b for value in zip(*planes) for b in value)
+
+
+def _encode_timestamps(timestamps):
+    """First value, first delta, then delta-of-deltas (mostly zero at a fixed interval)"""
+    encoded = timestamps[:1] + [b - a for a, b in zip(timestamps, timestamps[1:])][:1]
+    encoded += [
+        (c - b) - (b - a)
+        for a, b, c in zip(timestamps, timestamps[1:], timestamps[2:])
+    ]
+    return zlib.compress(_shuffle(struct.pack(f'<{len(encoded)}q', *encoded)), COMPRESSION_LEVEL)
+
+
+def _decode_timestamps(payload, count):
+    raw = _unshuffle(zlib.decompress(payload))
+    if np is not None:
+        encoded = np.frombuffer(raw, dtype='<i8')
+        if count < 2:
+            return encoded.copy()
+        deltas = np.cumsum(encoded[1:])
+        return np.concatenate((encoded[:1], encoded[0] + np.cumsum(deltas)))
+    encoded = struct.unpack(f'<{count}q', raw)
+    if count < 2:
+        return list(encoded)
+    deltas = accumulate(encoded[1:])
+    return list(accumulate(deltas, initial=encoded[0]))
+
+
+def _encode_floats(values):
+    """XOR each value's bits with the previous one; unchanged readings become zero"""
+    bits = struct.unpack(f'<{len(values)}Q', struct.pack(f'<{len(values)}d', *values))
+    xored = bits[:1] + tuple(a ^ b for a, b in zip(bits, bits[1:]))
+    return zlib.compress(_shuffle(struct.pack(f'<{len(xored)}Q', *xored)), COMPRESSION_LEVEL)
+
+
+def _decode_floats(payload, count):
+    raw = _unshuffle(zlib.decompress(payload))
+    if np is not None:
+        return np.bitwise_xor.accumulate(np.frombuffer(raw, dtype='<u8')).view('<f8')
+    bits = list(accumulate(struct.unpack(f'<{count}Q', raw), lambda a, b: a ^ b))
+    return list(struct.unpack(f'<{count}d', struct.pack(f'<{count}Q', *bits)))
+
+
+def _encode_block(rows):
+    columns = [_encode_timestamps([row[0] for row in rows])]
+    for index in range(len(ARCHIVE_FIELDS)):
+        columns.append(_encode_floats([
+            float('nan') if row[index + 1] is None else row[index + 1]
+            for row in rows
+        ]))
+    lengths = struct.pack(f'<{len(columns)}I', *(len(column) for column in columns))
+    return lengths + b''.join(columns)
+
+
+def write_day(rows, day):
+    """Write one day of (timestamp, *ARCHIVE_FIELDS) rows, sorted by timestamp
+
+    The file is written next to its final name and renamed into place, so a
+    crash never leaves a partial archive that would be mistaken for a
+    complete one. Returns the size of the file.
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    path = archive_path(day)
+    tmp_path = path + '.tmp'
+
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(ARCHIVE_FIELDS)))
+        index = []
+        for start in range(0, len(rows), BLOCK_ROWS):
+            block = rows[start:start + BLOCK_ROWS]
+            payload = _encode_block(block)
+            index.append((block[0][0], block[-1][0], len(block), f.tell(), len(payload)))
+            f.write(payload)
+
+        index_offset = f.tell()
+        for entry in index:
+            f.write(INDEX_ENTRY.pack(*entry))
+        f.write(TRAILER.pack(index_offset, len(index), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def archive_partition(conn, partition, day):
+    """Copy a day partition into its archive file and return the row count"""
+    rows = conn.execute(f'''
+        SELECT timestamp, {', '.join(ARCHIVE_FIELDS)}
+        FROM {partition}
+        ORDER BY timestamp
+    ''').fetchall()
+    if not rows:
+        return 0
+
+    size = write_day(rows, day)
+    logger.info(f"Archived {len(rows)} snapshots from {partition} ({size} bytes)")
+    return len(rows)
+
+
+def _read_index(f):
+    f.seek(-TRAILER.size, os.SEEK_END)
+    index_offset, block_count, magic = TRAILER.unpack(f.read(TRAILER.size))
+    if magic != MAGIC:
+        raise ValueError(f"{f.name} is not a snapshot archive")
+    f.seek(index_offset)
+    raw = f.read(block_count * INDEX_ENTRY.size)
+    return [entry for entry in INDEX_ENTRY.iter_unpack(raw)]
+
+
+def _read_block(f, offset, length, count):
+    f.seek(offset)
+    raw = f.read(length)
+    column_count = len(ARCHIVE_FIELDS) + 1
+    lengths = struct.unpack_from(f'<{column_count}I', raw)
+    position = column_count * 4
+
+    payloads = []
+    for length in lengths:
+        payloads.append(raw[position:position + length])
+        position += length
+
+    columns = {'timestamp': _decode_timestamps(payloads[0], count)}
+    for field, payload in zip(ARCHIVE_FIELDS, payloads[1:]):
+        columns[field] = _decode_floats(payload, count)
+    return columns
+
+
+def read_columns(start_ms, end_ms=None):
+    """Decode archived snapshots with start_ms <= timestamp < end_ms
+
+    Only blocks whose index range overlaps the request are decompressed.
+    Returns a dict of column name to numpy array (lists without numpy),
+    oldest first.
+    """
+    start_day = battery_db.from_ms(start_ms).date()
+    end_day = battery_db.from_ms(end_ms).date() if end_ms is not None else None
+
+    parts = []
+    for day in archived_days():
+        if day < start_day or (end_day is not None and day > end_day):
+            continue
+        with open(archive_path(day), 'rb') as f:
+            for first_ts, last_ts, count, offset, length in _read_index(f):
+                if last_ts < start_ms or (end_ms is not None and first_ts >= end_ms):
+                    continue
+                parts.append(_read_block(f, offset, length, count))
+
+    names = ('timestamp',) + ARCHIVE_FIELDS
+    if np is not None:
+        if not parts:
+            return {name: np.empty(0) for name in names}
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in names}
+        mask = columns['timestamp'] >= start_ms
+        if end_ms is not None:
+            mask &= columns['timestamp'] < end_ms
+        return {name: column[mask] for name, column in columns.items()}
+
+    columns = {name: [value for part in parts for value in part[name]] for name in names}
+    keep = [
+        index for index, ts in enumerate(columns['timestamp'])
+        if ts >= start_ms and (end_ms is None or ts < end_ms)
+    ]
+    return {name: [column[index] for index in keep] for name, column in columns.items()}
+
+
+def _rows(columns):
+    names = ('timestamp',) + ARCHIVE_FIELDS
+    if np is not None:
+        columns = {name: column.tolist() for name, column in columns.items()}
+    return [
+        (int(row[0]),) + tuple(None if value != value else value for value in row[1:])
+        for row in zip(*(columns[name] for name in names))
+    ]
+
+
+def read_rows(start_ms, end_ms=None):
+    """Archived snapshots as (timestamp, *ARCHIVE_FIELDS) tuples, oldest first
+
+    NaN values are returned as None, like the NULLs they were archived from.
+    """
+    return _rows(read_columns(start_ms, end_ms))
+
+
+def iter_rows_desc(start_ms, end_ms=None):
+    """Archived snapshots with start_ms <= timestamp < end_ms, newest first
+
+    Decodes one block at a time, so memory stays bounded by BLOCK_ROWS
+    however long the range is.
+    """
+    start_day = battery_db.from_ms(start_ms).date()
+    end_day = battery_db.from_ms(end_ms).date() if end_ms is not None else None
+
+    for day in reversed(archived_days()):
+        if day < start_day:
+            return
+        if end_day is not None and day > end_day:
+            continue
+        with open(archive_path(day), 'rb') as f:
+            blocks = _read_index(f)
+            for first_ts, last_ts, count, offset, length in reversed(blocks):
+                if last_ts < start_ms or (end_ms is not None and first_ts >= end_ms):
+                    continue
+                for row in reversed(_rows(_read_block(f, offset, length, count))):
+                    if row[0] >= start_ms and (end_ms is None or row[0] < end_ms):
+                        yield row
+
+
+def oldest_live_ms(conn):
+    """Start of the oldest snapshot partition still in SQLite, or None"""
+    partitions = battery_db.list_partitions(conn, 'battery_snapshots')
+    if not partitions:
+        return None
+    return battery_db.to_ms(datetime.combine(partitions[0][0], datetime.min.time()))
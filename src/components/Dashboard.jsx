@@ -89,7 +89,7 @@ export default function Dashboard() {
 
   // Extract key metrics with safe property access
   const batteryPercentage = parseFloat(deviceData?.total_battery_percent) || 0;
-  const batteryCapacity = 6144; // Total capacity in Wh
+  const batteryCapacity = parseFloat(currentStatus?.total_capacity_wh) || 6144; // Estimated effective capacity in Wh
   const timeRemaining = currentStatus?.time_remaining || {
     hours: 0,
     days: 0,
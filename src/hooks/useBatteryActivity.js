@@ -1,4 +1,5 @@
 import { useState, useEffect, useCallback } from "react";
+import { subscribeToStream } from "../utils/eventStream";
 
 const API_BASE = "http://192.168.1.145:8083";
 
@@ -96,11 +97,24 @@ export function useBatteryActivity() {
     refreshAll();
   }, [refreshAll]);
 
-  // Auto-refresh current status every 10 seconds
+  // Live current status pushed over the event stream
+  const [streaming, setStreaming] = useState(false);
+  useEffect(
+    () =>
+      subscribeToStream(
+        `${API_BASE}/api/stream`,
+        { status: setCurrentStatus },
+        setStreaming
+      ),
+    []
+  );
+
+  // Fall back to refreshing current status every 10 seconds while the stream is down
   useEffect(() => {
+    if (streaming) return undefined;
     const interval = setInterval(fetchCurrentStatus, 10000);
     return () => clearInterval(interval);
-  }, [fetchCurrentStatus]);
+  }, [streaming, fetchCurrentStatus]);
 
   // Auto-refresh other data every 60 seconds
   useEffect(() => {
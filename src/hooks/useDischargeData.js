@@ -1,4 +1,5 @@
 import { useState, useEffect, useCallback } from "react";
+import { subscribeToStream } from "../utils/eventStream";
 
 const API_BASE = "http://192.168.1.145:8083";
 
@@ -73,12 +74,32 @@ export function useDischargeData() {
     }
   }, [fetchCurrentDischarge, fetchDischargeHistory, fetchDischargeStats]);
 
+  // Live discharge analysis pushed over the event stream
+  const [streaming, setStreaming] = useState(false);
+  useEffect(
+    () =>
+      subscribeToStream(
+        `${API_BASE}/api/stream`,
+        { discharge: setCurrentDischarge },
+        setStreaming
+      ),
+    []
+  );
+
   useEffect(() => {
     refreshAll();
-    const interval = setInterval(refreshAll, 30000); // Refresh every 30 seconds
-    return () => clearInterval(interval);
   }, [refreshAll]);
 
+  // Refresh every 30 seconds; current discharge only while the stream is down
+  useEffect(() => {
+    const interval = setInterval(() => {
+      if (!streaming) fetchCurrentDischarge();
+      fetchDischargeHistory();
+      fetchDischargeStats();
+    }, 30000);
+    return () => clearInterval(interval);
+  }, [streaming, fetchCurrentDischarge, fetchDischargeHistory, fetchDischargeStats]);
+
   return {
     currentDischarge,
     dischargeHistory,
@@ -0,0 +1,48 @@
+// One EventSource per stream URL, shared by every hook that subscribes to it,
+// so the dashboard holds a single /api/stream connection
+const streams = new Map();
+
+function setConnected(stream, connected) {
+  stream.connected = connected;
+  stream.subscribers.forEach((subscriber) =>
+    subscriber.onConnectionChange?.(connected)
+  );
+}
+
+function openStream(url) {
+  const stream = {
+    source: new EventSource(url),
+    connected: false,
+    subscribers: new Set(),
+  };
+  stream.source.onopen = () => setConnected(stream, true);
+  stream.source.onerror = () => setConnected(stream, false);
+  streams.set(url, stream);
+  return stream;
+}
+
+// Calls handlers[event] with the parsed data of each matching message and
+// onConnectionChange whenever the connection opens or drops. Returns an
+// unsubscribe function; the connection closes with its last subscriber.
+export function subscribeToStream(url, handlers, onConnectionChange) {
+  const stream = streams.get(url) || openStream(url);
+  const subscriber = { onConnectionChange };
+  const listeners = Object.entries(handlers).map(([event, handler]) => {
+    const listener = (message) => handler(JSON.parse(message.data));
+    stream.source.addEventListener(event, listener);
+    return [event, listener];
+  });
+  stream.subscribers.add(subscriber);
+  onConnectionChange?.(stream.connected);
+
+  return () => {
+    listeners.forEach(([event, listener]) =>
+      stream.source.removeEventListener(event, listener)
+    );
+    stream.subscribers.delete(subscriber);
+    if (stream.subscribers.size === 0) {
+      stream.source.close();
+      streams.delete(url);
+    }
+  };
+}
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Telemetry Ring Buffer
+Fixed-size ring of recent battery snapshots in a memory-mapped file, written
+by the battery logger and read by the API server without touching SQLite
+"""
+
+import os
+import mmap
+import struct
+import time
+import logging
+import battery_db
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+RING_PATH = "/dev/shm/bluetti_telemetry.ring" if os.path.isdir("/dev/shm") else "/home/pi/bluetti-monitor/telemetry.ring"
+RING_HOURS = 24  # hours of snapshots kept
+RING_CAPACITY = RING_HOURS * 3600 // battery_db.SNAPSHOT_INTERVAL
+READ_RETRIES = 100  # attempts before a reader gives up on a busy writer
+
+# Stored after the epoch-ms timestamp in every record, all as doubles
+RECORD_FIELDS = (
+    'battery_percent', 'battery_voltage',
+    'ac_output_power', 'dc_output_power', 'total_output_power',
+    'ac_input_power', 'dc_input_power', 'time_remaining_hours',
+    'pack1_voltage', 'pack2_voltage', 'pack3_voltage'
+)
+
+MAGIC = b'BLTRING1'
+# magic, record count capacity, record size, seqlock sequence, records ever written
+HEADER = struct.Struct('<8sIIQQ')
+HEADER_SIZE = 64
+SEQ_OFFSET = 16
+COUNT_OFFSET = 24
+COUNTER = struct.Struct('<Q')
+RECORD = struct.Struct('<q' + 'd' * len(RECORD_FIELDS))
+TIMESTAMP = struct.Struct('<q')  # leading field of a record
+
+
+def _file_size(capacity):
+    return HEADER_SIZE + capacity * RECORD.size
+
+
+class TelemetryRingWriter:
+    """Single writer side of the ring, owned by the battery logger
+
+    Every append is bracketed by a seqlock: the sequence number is odd while
+    a record is being written and even otherwise, so readers in other
+    processes can detect and retry a torn read without taking any lock.
+    """
+
+    def __init__(self, path=RING_PATH, capacity=RING_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = _file_size(capacity)
+            reuse = os.fstat(fd).st_size == size
+            if not reuse:
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        magic, ring_capacity, record_size, seq, count = HEADER.unpack_from(self._mm, 0)
+        if reuse and magic == MAGIC and ring_capacity == capacity and record_size == RECORD.size:
+            # Keep the records from before a restart; a crash mid-write leaves seq odd
+            self._seq = seq + (seq & 1)
+            self._count = count
+            COUNTER.pack_into(self._mm, SEQ_OFFSET, self._seq)
+            logger.info(f"Reusing telemetry ring at {path} ({min(count, capacity)} records)")
+        else:
+            self._seq = 0
+            self._count = 0
+            HEADER.pack_into(self._mm, 0, MAGIC, capacity, RECORD.size, 0, 0)
+            logger.info(f"Created telemetry ring at {path} ({capacity} records)")
+
+    def append(self, ts_ms, values):
+        """Write one snapshot, overwriting the oldest once the ring is full"""
+        record = [values.get(field, 0.0) for field in RECORD_FIELDS]
+        slot = self._count % self.capacity
+
+        self._seq += 1
+        COUNTER.pack_into(self._mm, SEQ_OFFSET, self._seq)
+        RECORD.pack_into(self._mm, HEADER_SIZE + slot * RECORD.size, ts_ms, *record)
+        self._count += 1
+        COUNTER.pack_into(self._mm, COUNT_OFFSET, self._count)
+        self._seq += 1
+        COUNTER.pack_into(self._mm, SEQ_OFFSET, self._seq)
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+
+
+class TelemetryRingReader:
+    """Lock-free reader for the API server
+
+    The file is opened lazily and re-opened if the logger recreates it, so a
+    reader can start before the logger has written anything. Every read
+    returns None while no ring is available and callers fall back to SQLite.
+    """
+
+    def __init__(self, path=RING_PATH):
+        self.path = path
+        self._mm = None
+        self._inode = None
+        self._capacity = 0
+
+    def _mapping(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._close()
+            return None
+
+        if self._mm is None or st.st_ino != self._inode or st.st_size != len(self._mm):
+            self._close()
+            if st.st_size < HEADER_SIZE:
+                return None
+            with open(self.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), st.st_size, access=mmap.ACCESS_READ)
+            magic, capacity, record_size, _, _ = HEADER.unpack_from(mm, 0)
+            if magic != MAGIC or record_size != RECORD.size or st.st_size != _file_size(capacity):
+                mm.close()
+                return None
+            self._mm, self._inode, self._capacity = mm, st.st_ino, capacity
+        return self._mm
+
+    def _close(self):
+        if self._mm is not None:
+            self._mm.close()
+        self._mm = None
+        self._inode = None
+
+    def _consistent_read(self, read):
+        """Run read(mm, count) until it completes without a concurrent write"""
+        mm = self._mapping()
+        if mm is None:
+            return None
+
+        for attempt in range(READ_RETRIES):
+            seq = COUNTER.unpack_from(mm, SEQ_OFFSET)[0]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            count = COUNTER.unpack_from(mm, COUNT_OFFSET)[0]
+            result = read(mm, count)
+            if COUNTER.unpack_from(mm, SEQ_OFFSET)[0] == seq:
+                return result
+
+        logger.warning("Telemetry ring stayed busy, giving up on read")
+        return None
+
+    def latest(self):
+        """Newest record as a tuple (ts_ms, *RECORD_FIELDS) or None"""
+        def read(mm, count):
+            if count == 0:
+                return None
+            slot = (count - 1) % self._capacity
+            return RECORD.unpack_from(mm, HEADER_SIZE + slot * RECORD.size)
+        return self._consistent_read(read)
+
+    def appended(self):
+        """Records ever appended, a cheap change counter; None if no ring is available"""
+        return self._consistent_read(lambda mm, count: count)
+
+    def records(self, since_ms=None):
+        """All records newer than since_ms, oldest first
+
+        Returns (records, oldest_ts_ms) where oldest_ts_ms is the oldest
+        timestamp still held, so callers can tell whether the ring covers
+        the window they want; None if no ring is available.
+        """
+        def read(mm, count):
+            held = min(count, self._capacity)
+            if held == 0:
+                return None, ()
+            start = (count - held) % self._capacity
+
+            def timestamp(index):
+                slot = (start + index) % self._capacity
+                return TIMESTAMP.unpack_from(mm, HEADER_SIZE + slot * RECORD.size)[0]
+
+            # Records are appended in time order, so binary search for the first one after since_ms
+            low, high = 0, held
+            if since_ms is not None:
+                while low < high:
+                    middle = (low + high) // 2
+                    if timestamp(middle) > since_ms:
+                        high = middle
+                    else:
+                        low = middle + 1
+
+            # Copy only the wanted slots, in two pieces when they wrap past the end
+            first = (start + low) % self._capacity
+            wanted = held - low
+            pieces = [(first, min(wanted, self._capacity - first))]
+            if pieces[0][1] < wanted:
+                pieces.append((0, wanted - pieces[0][1]))
+            raw = [
+                mm[HEADER_SIZE + slot * RECORD.size:HEADER_SIZE + (slot + length) * RECORD.size]
+                for slot, length in pieces if length
+            ]
+            return timestamp(0), raw
+
+        snapshot = self._consistent_read(read)
+        if snapshot is None:
+            return None
+
+        oldest, raw = snapshot
+        if oldest is None:
+            return [], None
+        return [row for piece in raw for row in RECORD.iter_unpack(piece)], oldest
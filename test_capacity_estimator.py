@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Tests for the battery capacity and state-of-health estimator
+
+Run with: python -m unittest test_capacity_estimator
+"""
+
+import json
+import math
+import unittest
+from capacity_estimator import CapacityEstimator, NOMINAL_CAPACITY_WH, MAX_GAP_MS
+
+START_MS = 1700000000000
+INTERVAL_MS = 30000
+
+
+class SimulatedBattery:
+    """A battery of a known capacity that reports whole percent, like the AC200MAX"""
+
+    def __init__(self, capacity_wh, percent=100.0, ts_ms=START_MS):
+        self.capacity_wh = capacity_wh
+        self.energy_wh = capacity_wh * percent / 100
+        self.ts_ms = ts_ms
+
+    @property
+    def reported_percent(self):
+        return float(math.floor(self.energy_wh / self.capacity_wh * 100))
+
+    def run(self, estimator, input_w, output_w, until_percent, interval_ms=INTERVAL_MS):
+        """Step at a constant power until the reported percent reaches until_percent; returns accepted segments"""
+        rows = []
+        charging = input_w > output_w
+        while (self.reported_percent < until_percent) if charging else (self.reported_percent > until_percent):
+            self.ts_ms += interval_ms
+            self.energy_wh += (input_w - output_w) * interval_ms / 3600000
+            row = estimator.update(self.ts_ms, self.reported_percent, input_w, output_w)
+            if row:
+                rows.append(row)
+        return rows
+
+
+class CapacityEstimatorTest(unittest.TestCase):
+    def test_fresh_estimator_reports_nominal(self):
+        estimator = CapacityEstimator()
+        self.assertEqual(estimator.capacity_wh, NOMINAL_CAPACITY_WH)
+        self.assertEqual(estimator.confidence, 0.0)
+
+    def test_learns_known_capacity_from_discharge(self):
+        battery = SimulatedBattery(5200.0)
+        estimator = CapacityEstimator()
+        for _ in range(6):
+            rows = battery.run(estimator, 0.0, 650.0, until_percent=15)
+            battery.run(estimator, 1500.0, 0.0, until_percent=100)
+            self.assertTrue(rows)
+            for row in rows:
+                # Each accepted segment measures the true capacity to within one percent step
+                self.assertAlmostEqual(row[5], 5200.0, delta=5200.0 * 0.01)
+
+        summary = estimator.summary()
+        self.assertAlmostEqual(summary['discharge_capacity_wh'], 5200.0, delta=5200.0 * 0.005)
+        # The nominal prior still pulls a little, but the evidence dominates
+        self.assertLess(abs(estimator.capacity_wh - 5200.0), abs(NOMINAL_CAPACITY_WH - 5200.0) * 0.15)
+        self.assertAlmostEqual(estimator.state_of_health, estimator.capacity_wh / NOMINAL_CAPACITY_WH)
+        self.assertGreater(estimator.confidence, 0.85)
+
+    def test_charge_segments_are_tracked_separately(self):
+        battery = SimulatedBattery(5000.0, percent=20.0)
+        estimator = CapacityEstimator()
+        battery.run(estimator, 1200.0, 0.0, until_percent=95)
+        self.assertIsNotNone(estimator.summary()['charge_capacity_wh'])
+        self.assertIsNone(estimator.summary()['discharge_capacity_wh'])
+        # Charge evidence is used until discharge evidence exists
+        self.assertLess(estimator.capacity_wh, NOMINAL_CAPACITY_WH)
+
+    def test_gap_abandons_the_segment(self):
+        battery = SimulatedBattery(5000.0)
+        estimator = CapacityEstimator()
+        battery.run(estimator, 0.0, 800.0, until_percent=96)
+        battery.ts_ms += MAX_GAP_MS + 1
+        battery.energy_wh -= 5000.0 * 0.5  # half the battery used while the logger was down
+        estimator.update(battery.ts_ms, battery.reported_percent, 0.0, 800.0)
+        self.assertEqual(estimator.sums['discharge']['segments'], 0)
+
+    def test_state_round_trip(self):
+        battery = SimulatedBattery(5500.0)
+        estimator = CapacityEstimator()
+        battery.run(estimator, 0.0, 700.0, until_percent=47)
+        restored = CapacityEstimator(json.loads(json.dumps(estimator.state())))
+        twin = SimulatedBattery(5500.0)
+        twin.energy_wh, twin.ts_ms = battery.energy_wh, battery.ts_ms
+        battery.run(estimator, 0.0, 700.0, until_percent=10)
+        twin.run(restored, 0.0, 700.0, until_percent=10)
+        self.assertEqual(restored.summary(), estimator.summary())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Tests for the streaming discharge-rate estimator
+
+Run with: python -m unittest test_discharge_estimator
+"""
+
+import json
+import unittest
+from discharge_estimator import DischargeEstimator, ESTIMATOR_WINDOWS, MIN_SPAN_HOURS
+
+START_MS = 1700000000000
+INTERVAL_MS = 30000
+
+
+def feed(estimator, hours, rate, start_percent=100.0, start_ms=START_MS, power=250.0, charging=False):
+    """Samples every INTERVAL_MS along a straight line falling rate %/h; returns the next timestamp"""
+    steps = int(hours * 3600000 / INTERVAL_MS)
+    for i in range(steps + 1):
+        ts = start_ms + i * INTERVAL_MS
+        estimator.update(ts, start_percent - rate * (ts - start_ms) / 3600000, power, charging)
+    return start_ms + (steps + 1) * INTERVAL_MS
+
+
+class DischargeEstimatorTest(unittest.TestCase):
+    def test_known_slope(self):
+        estimator = DischargeEstimator()
+        feed(estimator, 30, 2.5, power=300.0)
+        for window in ESTIMATOR_WINDOWS:
+            with self.subTest(window=window):
+                self.assertAlmostEqual(estimator.discharge_rate(window), 2.5, places=6)
+                self.assertAlmostEqual(estimator.avg_power(window), 300.0, places=6)
+
+    def test_irregular_intervals_keep_the_slope(self):
+        estimator = DischargeEstimator()
+        ts = START_MS
+        for i in range(2000):
+            ts += (15000, 30000, 90000, 31000)[i % 4]
+            estimator.update(ts, 90.0 - 1.2 * (ts - START_MS) / 3600000, 100.0)
+        for window in ESTIMATOR_WINDOWS:
+            with self.subTest(window=window):
+                self.assertAlmostEqual(estimator.discharge_rate(window), 1.2, places=6)
+
+    def test_needs_min_span(self):
+        estimator = DischargeEstimator()
+        feed(estimator, MIN_SPAN_HOURS / 2, 3.0)
+        self.assertIsNone(estimator.discharge_rate('1h'))
+
+    def test_rising_line_gives_zero(self):
+        estimator = DischargeEstimator()
+        feed(estimator, 5, -1.0, start_percent=20.0)
+        self.assertEqual(estimator.discharge_rate('4h'), 0.0)
+
+    def test_charging_restarts_the_regression(self):
+        estimator = DischargeEstimator()
+        next_ms = feed(estimator, 10, 5.0)
+        next_ms = feed(estimator, 0.5, -20.0, start_percent=50.0, start_ms=next_ms, charging=True)
+        self.assertIsNone(estimator.discharge_rate('24h'))
+
+        # Only the discharge after charging counts, even for the longest window
+        feed(estimator, 3, 1.0, start_percent=60.0, start_ms=next_ms)
+        self.assertAlmostEqual(estimator.discharge_rate('24h'), 1.0, places=6)
+
+    def test_out_of_order_samples_are_ignored(self):
+        estimator = DischargeEstimator()
+        feed(estimator, 3, 2.0)
+        before = json.dumps(estimator.state())
+        estimator.update(START_MS, 0.0, 5000.0)
+        self.assertEqual(json.dumps(estimator.state()), before)
+
+    def test_state_round_trip(self):
+        estimator = DischargeEstimator()
+        next_ms = feed(estimator, 3, 2.0)
+        restored = DischargeEstimator(json.loads(json.dumps(estimator.state())))
+        for e in (estimator, restored):
+            feed(e, 2, 2.0, start_percent=100.0 - 2.0 * (next_ms - START_MS) / 3600000, start_ms=next_ms)
+        for window in ESTIMATOR_WINDOWS:
+            with self.subTest(window=window):
+                self.assertAlmostEqual(restored.discharge_rate(window), estimator.discharge_rate(window), places=9)
+
+
+if __name__ == "__main__":
+    unittest.main()
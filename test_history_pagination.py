@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Tests that history cursors page through rows sharing a timestamp, including
+when a page from the telemetry ring is followed by one from SQLite
+
+Run with: python -m unittest test_history_pagination
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import battery_db
+import snapshot_archive
+import telemetry_ring
+import api_server
+
+TIES = 3  # rows per timestamp
+
+
+class HistoryPaginationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.originals = (battery_db.DB_PATH, api_server.BATTERY_DB_PATH, snapshot_archive.ARCHIVE_DIR, api_server.telemetry)
+        battery_db.DB_PATH = api_server.BATTERY_DB_PATH = os.path.join(self.tmp, 'battery.db')
+        snapshot_archive.ARCHIVE_DIR = os.path.join(self.tmp, 'archive')
+        with battery_db.transaction() as conn:
+            battery_db.create_partitioned_tables(conn)
+
+        # Ties at every timestamp over the last 40 minutes, inserted and appended oldest first
+        now_ms = battery_db.now_ms()
+        ring_path = os.path.join(self.tmp, 'ring')
+        ring = telemetry_ring.TelemetryRingWriter(ring_path, capacity=1000)
+        ring.append(now_ms - 3 * 3600000, {})  # so the ring covers the window
+        self.percents = []
+        with battery_db.transaction() as conn:
+            for step in range(80, 0, -1):
+                ts = now_ms - step * 30000
+                day = battery_db.from_ms(ts).date()
+                partition = battery_db.ensure_partition(conn, 'battery_snapshots', day)
+                for tie in range(TIES):
+                    percent = float(len(self.percents))
+                    conn.execute(f'INSERT INTO {partition} (timestamp, battery_percent) VALUES (?, ?)', (ts, percent))
+                    ring.append(ts, {'battery_percent': percent})
+                    self.percents.append(percent)
+        ring.close()
+        self.ring = telemetry_ring.TelemetryRingReader(ring_path)
+        self.no_ring = telemetry_ring.TelemetryRingReader(os.path.join(self.tmp, 'missing'))
+        self.percents.reverse()  # newest first
+
+    def tearDown(self):
+        battery_db.close_all()
+        battery_db.DB_PATH, api_server.BATTERY_DB_PATH, snapshot_archive.ARCHIVE_DIR, api_server.telemetry = self.originals
+        shutil.rmtree(self.tmp)
+
+    def page_through(self, limit, sources):
+        """Follow next_cursor, reading each page from the next reader in sources"""
+        percents, cursor = [], None
+        for page in range(1000):
+            api_server.telemetry = sources[min(page, len(sources) - 1)]
+            result = api_server._activity_history(2, limit, before=api_server._parse_cursor(cursor))
+            percents += [entry['battery_percent'] for entry in result['history']]
+            cursor = result['next_cursor']
+            if cursor is None:
+                return percents
+        self.fail("pages never ended")
+
+    def test_ring_then_sqlite(self):
+        for limit in (1, 2, TIES, 4, 7):
+            with self.subTest(limit=limit):
+                self.assertEqual(self.page_through(limit, [self.ring, self.no_ring]), self.percents)
+
+    def test_sqlite_then_ring(self):
+        # An id cursor from SQLite keeps paging SQLite even once the ring is back
+        for limit in (1, 2, 4):
+            with self.subTest(limit=limit):
+                self.assertEqual(self.page_through(limit, [self.no_ring, self.ring]), self.percents)
+
+    def test_ring_only(self):
+        self.assertEqual(self.page_through(5, [self.ring]), self.percents)
+
+    def test_invalid_cursors(self):
+        for cursor in ('abc', '1:x', '1:0', '1:p-2', '1:-3', ':5'):
+            with self.subTest(cursor=cursor):
+                with self.assertRaises(ValueError):
+                    api_server._parse_cursor(cursor)
+
+
+if __name__ == "__main__":
+    unittest.main()
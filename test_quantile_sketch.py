@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Accuracy and serialization tests for the DDSketch quantile sketches
+
+Run with: python -m unittest test_quantile_sketch
+"""
+
+import random
+import sqlite3
+import unittest
+import quantile_sketch
+from quantile_sketch import QuantileSketch, HourlySketches, HOUR_MS, SKETCH_FIELDS
+
+QUANTILES = (0.0, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1.0)
+
+
+def exact_quantile(values, q):
+    """The same rank convention as QuantileSketch.quantile (lower of the two at a fractional rank)"""
+    ordered = sorted(values)
+    return ordered[int(q * (len(ordered) - 1))]
+
+
+class QuantileSketchTest(unittest.TestCase):
+    def assertWithinRelativeError(self, sketch, values):
+        bound = sketch.relative_accuracy
+        for q in QUANTILES:
+            exact = exact_quantile(values, q)
+            estimate = sketch.quantile(q)
+            with self.subTest(q=q, exact=exact, estimate=estimate):
+                self.assertLessEqual(abs(estimate - exact), bound * abs(exact) + 1e-9)
+
+    def test_relative_error_bound(self):
+        rng = random.Random(7)
+        distributions = {
+            'uniform': [rng.uniform(0, 3000) for _ in range(20000)],
+            'lognormal': [rng.lognormvariate(4, 1.5) for _ in range(20000)],
+            'voltage': [rng.gauss(52.0, 0.4) for _ in range(20000)]
+        }
+        for name, values in distributions.items():
+            for accuracy in (0.01, 0.05):
+                with self.subTest(distribution=name, accuracy=accuracy):
+                    sketch = QuantileSketch(accuracy)
+                    for value in values:
+                        sketch.add(value)
+                    self.assertWithinRelativeError(sketch, values)
+
+    def test_zero_readings(self):
+        values = [0.0] * 300 + [100.0] * 700
+        sketch = QuantileSketch()
+        for value in values:
+            sketch.add(value)
+        self.assertEqual(sketch.quantile(0.1), 0.0)
+        self.assertAlmostEqual(sketch.quantile(0.5), 100.0, delta=1.0)
+
+    def test_none_and_nan_are_skipped(self):
+        sketch = QuantileSketch()
+        for value in (None, float('nan'), 5.0):
+            sketch.add(value)
+        self.assertEqual(sketch.count, 1)
+        self.assertIsNone(QuantileSketch().quantile(0.5))
+
+    def test_merge_equals_single_sketch(self):
+        rng = random.Random(11)
+        values = [rng.expovariate(1 / 400) for _ in range(10000)]
+        whole = QuantileSketch()
+        parts = [QuantileSketch() for _ in range(4)]
+        for i, value in enumerate(values):
+            whole.add(value)
+            parts[i % 4].add(value)
+        merged = parts[0]
+        for part in parts[1:]:
+            merged.merge(part)
+        self.assertEqual(merged.bins, whole.bins)
+        self.assertEqual(merged.count, whole.count)
+        self.assertWithinRelativeError(merged, values)
+
+    def test_merge_rejects_different_accuracy(self):
+        with self.assertRaises(ValueError):
+            QuantileSketch(0.01).merge(QuantileSketch(0.02))
+
+    def test_bytes_round_trip(self):
+        rng = random.Random(5)
+        sketch = QuantileSketch()
+        for value in [0.0, 0.001] + [rng.uniform(0.01, 5000) for _ in range(5000)]:
+            sketch.add(value)
+        restored = QuantileSketch.from_bytes(sketch.to_bytes())
+        self.assertEqual(restored.bins, sketch.bins)
+        self.assertEqual(restored.summary(), sketch.summary())
+        self.assertEqual(QuantileSketch.from_bytes(QuantileSketch().to_bytes()).count, 0)
+
+
+class HourlySketchesTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('''
+            CREATE TABLE quantile_sketches (
+                hour_start INTEGER NOT NULL, field TEXT NOT NULL, sketch BLOB NOT NULL,
+                PRIMARY KEY (hour_start, field)
+            ) WITHOUT ROWID
+        ''')
+
+    def write(self, rows):
+        for sql, params in rows:
+            self.conn.execute(sql, params)
+
+    def test_rows_only_at_rollover_and_flush(self):
+        sketches = HourlySketches()
+        start = 1700000000000 - 1700000000000 % HOUR_MS
+        values = {field: 10.0 for field in SKETCH_FIELDS}
+        for i in range(100):
+            self.assertEqual(sketches.add(start + i * 30000, values), [])
+        self.assertEqual(len(sketches.save_rows()), len(SKETCH_FIELDS))
+        self.assertEqual(sketches.save_rows(), [])
+
+        sketches.add(start + 101 * 30000, values)
+        finished = sketches.add(start + HOUR_MS, values)
+        self.assertEqual({params[0] for _, params in finished}, {start})
+        self.write(finished)
+        self.assertEqual(quantile_sketch.read_hour(self.conn, start)['battery_voltage'].count, 101)
+
+    def test_merge_range_reads_only_the_requested_fields(self):
+        sketches = HourlySketches()
+        sketches.add(0, {field: 5.0 for field in SKETCH_FIELDS})
+        self.write(sketches.save_rows())
+        merged = quantile_sketch.merge_range(self.conn, 0, fields=('battery_voltage',))
+        self.assertEqual(list(merged), ['battery_voltage'])
+        self.assertEqual(merged['battery_voltage'].count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
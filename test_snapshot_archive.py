@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Round-trip tests for the snapshot archive codec
+
+Run with: python -m unittest test_snapshot_archive
+"""
+
+import math
+import random
+import shutil
+import tempfile
+import unittest
+from datetime import date, datetime
+import battery_db
+import snapshot_archive
+
+DAY = date(2024, 3, 10)
+DAY_START_MS = battery_db.to_ms(datetime(2024, 3, 10))
+
+
+def make_rows(count, interval_ms=30000, seed=1):
+    """Snapshot rows at a mostly fixed interval with some jitter, NULLs and repeats"""
+    rng = random.Random(seed)
+    rows = []
+    ts = DAY_START_MS
+    percent = 100.0
+    for i in range(count):
+        ts += interval_ms + (rng.choice((0, 0, 0, 1, -1, 250)) if i else 0)
+        percent = max(0.0, percent - rng.choice((0.0, 0.0, 1.0)))
+        values = [
+            percent, 52.0 + rng.random(),
+            rng.choice((0.0, 120.5, 300.0)), 0.0, rng.uniform(0, 500),
+            None if i % 7 == 0 else 0.0, rng.choice((0.0, -0.0, 1e-300, 1e300)),
+            rng.uniform(0, 100),
+            52.1, None, float(i)
+        ]
+        rows.append((ts,) + tuple(values))
+    return rows
+
+
+def same_value(a, b):
+    if a is None or b is None:
+        return a is None and b is None
+    return a == b and math.copysign(1, a) == math.copysign(1, b)
+
+
+class ArchiveRoundTripTest(unittest.TestCase):
+    def setUp(self):
+        self.original_dir = snapshot_archive.ARCHIVE_DIR
+        self.original_np = snapshot_archive.np
+        self.original_block_rows = snapshot_archive.BLOCK_ROWS
+        self.tmp = tempfile.mkdtemp()
+        snapshot_archive.ARCHIVE_DIR = self.tmp
+
+    def tearDown(self):
+        snapshot_archive.ARCHIVE_DIR = self.original_dir
+        snapshot_archive.np = self.original_np
+        snapshot_archive.BLOCK_ROWS = self.original_block_rows
+        shutil.rmtree(self.tmp)
+
+    def assertRowsEqual(self, actual, expected):
+        self.assertEqual(len(actual), len(expected))
+        for got, want in zip(actual, expected):
+            self.assertEqual(got[0], want[0])
+            self.assertIsInstance(got[0], int)
+            for a, b in zip(got[1:], want[1:]):
+                self.assertTrue(same_value(a, b), f"{a!r} != {b!r} at {want[0]}")
+
+    def round_trip(self, rows):
+        snapshot_archive.write_day(rows, DAY)
+        return snapshot_archive.read_rows(DAY_START_MS)
+
+    def test_empty_day(self):
+        self.assertEqual(self.round_trip([]), [])
+        self.assertEqual(list(snapshot_archive.iter_rows_desc(DAY_START_MS)), [])
+
+    def test_one_row(self):
+        rows = make_rows(1)
+        self.assertRowsEqual(self.round_trip(rows), rows)
+
+    def test_two_rows(self):
+        rows = make_rows(2)
+        self.assertRowsEqual(self.round_trip(rows), rows)
+
+    def test_null_and_zero_values(self):
+        rows = [
+            (DAY_START_MS + 1000, None, 0.0, -0.0, float('nan'), None, 0.0, None, 5.0, None, None, None),
+            (DAY_START_MS + 2000, 0.0, None, 0.0, 0.0, -0.0, None, 0.0, None, 1.0, None, 0.0),
+            (DAY_START_MS + 3000, None, None, None, None, None, None, None, None, None, None, None)
+        ]
+        # NaN is how NULL is stored, so it reads back as None
+        expected = [tuple(None if value != value else value for value in row) for row in rows]
+        self.assertRowsEqual(self.round_trip(rows), expected)
+
+    def test_multi_block_day(self):
+        snapshot_archive.BLOCK_ROWS = 100
+        rows = make_rows(1234)
+        self.assertRowsEqual(self.round_trip(rows), rows)
+
+        # Ranges that start and end mid-block only return rows inside them
+        start, end = rows[150][0], rows[1020][0]
+        self.assertRowsEqual(snapshot_archive.read_rows(start, end), rows[150:1020])
+        self.assertRowsEqual(list(snapshot_archive.iter_rows_desc(start, end)), rows[150:1020][::-1])
+
+    def test_numpy_and_pure_python_decode_match(self):
+        if self.original_np is None:
+            self.skipTest("numpy not installed")
+        snapshot_archive.BLOCK_ROWS = 100
+        rows = make_rows(345)
+        snapshot_archive.write_day(rows, DAY)
+
+        with_numpy = snapshot_archive.read_rows(DAY_START_MS)
+        snapshot_archive.np = None
+        without_numpy = snapshot_archive.read_rows(DAY_START_MS)
+
+        self.assertRowsEqual(with_numpy, rows)
+        self.assertRowsEqual(without_numpy, with_numpy)
+
+    def test_small_days_without_numpy(self):
+        snapshot_archive.np = None
+        for count in (0, 1, 2):
+            with self.subTest(rows=count):
+                rows = make_rows(count)
+                self.assertRowsEqual(self.round_trip(rows), rows)
+
+    def test_file_written_without_numpy_reads_with_numpy(self):
+        if self.original_np is None:
+            self.skipTest("numpy not installed")
+        rows = make_rows(50)
+        snapshot_archive.np = None
+        snapshot_archive.write_day(rows, DAY)
+        snapshot_archive.np = self.original_np
+        self.assertRowsEqual(snapshot_archive.read_rows(DAY_START_MS), rows)
+
+
+if __name__ == "__main__":
+    unittest.main()